@@ -4,8 +4,6 @@ if __name__ != "__main__":
     raise Exception()
 
 from pathlib import Path
-from pywikibot import Site as PWB_Site
-from metabot.OsmFamily import OsmFamily
 from metabot import Caches, P_INSTANCE_OF, Q_KEY, P_KEY_TYPE, Q_ENUM_KEY_TYPE, P_KEY_ID
 from metabot.Processor import Processor
 from metabot.TagInfoDb import TagInfoDb
@@ -13,8 +11,7 @@ from metabot.utils import get_osm_site, batches
 
 site = get_osm_site()
 use_bot_limits = False
-pb_site = PWB_Site(fam=OsmFamily(), user='Yurikbot')
-caches = Caches(site, pb_site, use_bot_limits=False)
+caches = Caches(site, use_bot_limits=False)
 
 password = Path('./password').read_text().strip()
 site.login(user='Yurikbot', password=password, on_demand=True)
@@ -46,7 +43,6 @@ proc = Processor(opts, caches, site)
 proc.run([
     caches.itemByQid.get_item('Q682'),
 ])
-# proc.del_params()
 # proc.run(('Key', 'yh:WIDTH_RANK'))
 # proc.run(('Tag', 'highway=path'))
 
@@ -1,5 +1,8 @@
 import json
+import mmap
+import os
 import os.path
+from functools import lru_cache
 
 from pywikiapi import AttrDict
 
@@ -51,7 +54,14 @@ class CacheJsonl(Cache):
                 items.append(json.loads(line, object_hook=AttrDict))
             return items
 
-    def iter(self):
+    def stamp(self):
+        """Identifies the current content of the data file"""
+        if not os.path.isfile(self.filename):
+            self.regenerate()
+        st = os.stat(self.filename)
+        return [st.st_size, st.st_mtime_ns]
+
+    def iter(self, object_hook=None):
         if not os.path.isfile(self.filename):
             self.regenerate()
 
@@ -59,7 +69,129 @@ class CacheJsonl(Cache):
             for line in file:
                 line = line.rstrip()
                 if line:
-                    yield json.loads(line)
+                    yield json.loads(line, object_hook=object_hook)
+
+
+class CacheIndexedJsonl(CacheJsonl):
+    """
+    JSON Lines cache with a sidecar index file (<filename>.idx) of every record's position, keyed by the record's id,
+    plus any secondary keys returned by secondary_keys(). Single records are read from the memory-mapped file
+    and decoded on demand, so looking up a few items does not require loading the whole file.
+    The index is rebuilt whenever the size or modification time of the data file changes.
+    """
+    index_version = 1
+
+    def __init__(self, filename, cache_size=10000):
+        super().__init__(filename)
+        self.index_filename = filename + '.idx'
+        self._index = None
+        self._file = None
+        self._mmap = None
+        self.get_by_id = lru_cache(maxsize=cache_size)(self._get_by_id)
+
+    def secondary_keys(self, item):
+        """Returns a dict of index name -> key (or None) for the given item"""
+        return {}
+
+    def stamp(self):
+        return [self.index_version] + super().stamp()
+
+    def _ensure_index(self):
+        stamp = self.stamp()
+        if self._index is not None and self._index['stamp'] == stamp:
+            return
+        self._close_mmap()
+        self.get_by_id.cache_clear()
+        index = None
+        try:
+            with open(self.index_filename, "r") as file:
+                index = json.load(file)
+        except (IOError, ValueError):
+            pass
+        if not index or index.get('stamp') != stamp:
+            index = self._build_index(stamp)
+        self._index = {
+            'stamp': stamp,
+            'offsets': {k: (o, ln) for k, o, ln in index['offsets']},
+            'keys': {name: {tuple(k) if type(k) is list else k: v for k, v in values}
+                     for name, values in index['keys'].items()},
+            'duplicates': {name: [(tuple(k) if type(k) is list else k, v) for k, v in values]
+                           for name, values in index['duplicates'].items()},
+        }
+        if stamp[1] > 0:
+            self._file = open(self.filename, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _build_index(self, stamp):
+        print(f'Indexing {self.filename}')
+        offsets = []
+        keys = {}
+        duplicates = {}
+        with open(self.filename, "rb") as file:
+            offset = 0
+            for line in file:
+                if line.strip():
+                    item = json.loads(line, object_hook=AttrDict)
+                    offsets.append((item.id, offset, len(line)))
+                    for name, key in self.secondary_keys(item).items():
+                        values = keys.setdefault(name, {})
+                        if key is None:
+                            continue
+                        if key in values:
+                            duplicates.setdefault(name, []).append((key, item.id))
+                        else:
+                            values[key] = item.id
+                offset += len(line)
+        index = {
+            'stamp': stamp,
+            'offsets': offsets,
+            'keys': {name: list(values.items()) for name, values in keys.items()},
+            'duplicates': duplicates,
+        }
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, "w") as file:
+            json.dump(index, file, ensure_ascii=False)
+        os.replace(tmp_filename, self.index_filename)
+        return index
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def _get_by_id(self, id):
+        self._ensure_index()
+        pos = self._index['offsets'].get(id)
+        if pos is None:
+            return None
+        offset, length = pos
+        return json.loads(self._mmap[offset:offset + length], object_hook=AttrDict)
+
+    def get_item(self, id):
+        """Returns a single record by its id, or None if it does not exist"""
+        self._ensure_index()
+        return self.get_by_id(id)
+
+    def get_by(self, name, key):
+        """Returns a single record by one of its secondary keys, or None if it does not exist"""
+        id = self.lookup(name).get(key)
+        return self.get_item(id) if id is not None else None
+
+    def ids(self):
+        self._ensure_index()
+        return self._index['offsets'].keys()
+
+    def lookup(self, name):
+        """Returns a secondary key -> record id dictionary. Do not modify it"""
+        self._ensure_index()
+        return self._index['keys'].get(name, {})
+
+    def duplicates(self, name):
+        """Returns a list of (secondary key, record id) that were ignored because the key was already used"""
+        self._ensure_index()
+        return self._index['duplicates'].get(name, [])
 
 
 class CacheInMemory:
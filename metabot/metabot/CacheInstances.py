@@ -4,64 +4,82 @@ from typing import Union, List
 from metabot.TagInfoDb import TagInfoDb
 from metabot.WikiFeatures import WikiFeatures
 from .Properties import P_TAG_KEY, P_INSTANCE_OF
-from .utils import list_to_dict_of_lists, get_instance_of
 from .DescriptionParser import DescriptionParser
 from .consts import Q_GROUP, Q_STATUS, Q_TAG
 from .CachedFilteredDescription import CachedFilteredDescription, RelationRolesDescription
 from .DataItems import DataItems, DataItemsByQid, DataItemDescByQid, DataItemsKeysByStrid, DataItemsByName, \
-    RegionByLangCode, DataItemBySitelink
+    RegionByLangCode, DataItemBySitelink, DataItemsByInstanceOf, DataItemsByStridClaim, DataItemIndexer
 from .WikiPagesWithTemplate import WikiPagesWithTemplate
 from .DataItemContributors import DataItemContributors
 from .WikiTagTemplateUsage import WikiTagTemplateUsage
 from .WikiPageTitles import WikiPageTitles
+from .WikiTitles import WikiTitles
+from .Fetcher import Fetcher
+from .ProcessorIndex import ProcessorIndex
 from .TagInfo import TagInfoKeys
-from pywikibot import Site as PWB_Site
 from pywikiapi import Site
 
 
 class Caches:
-    def __init__(self, site: Site, pwb_site: PWB_Site, use_bot_limits):
+    def __init__(self, site: Site, use_bot_limits):
 
         os.makedirs("_cache", exist_ok=True)
 
+        # All cache generators share the same pool of API workers and the same maxlag backoff
+        self.fetcher = Fetcher(site)
+
         self.taginfo = TagInfoKeys('_cache/taginfo.txt')
-        self.tagusage = WikiTagTemplateUsage('_cache/tagusage.txt', site)
+        self.tagusage = WikiTagTemplateUsage('_cache/tagusage.txt', site, self.fetcher)
+
+        self.contributed = DataItemContributors('_cache/contributed.json', site, self.fetcher)
+
+        # Namespaces and URLs of the wiki, used to normalize page and file titles
+        self.wikiTitles = WikiTitles('_cache/wiki_siteinfo.json', site, self.fetcher)
 
-        self.contributed = DataItemContributors('_cache/contributed.json', site)
+        self.mapfeatures = WikiFeatures('_cache/wiki_map_features.json', site, self.wikiTitles, self.fetcher)
 
-        self.mapfeatures = WikiFeatures('_cache/wiki_map_features.json', site, pwb_site)
+        self.data_items = DataItems('_cache/data_items.json', site, use_bot_limits, self.fetcher)
 
-        self.data_items = DataItems('_cache/data_items.json', site, use_bot_limits)
+        # Derived caches that need to look at every item are built together, in a single pass
+        self.itemIndexer = DataItemIndexer(self.data_items, '_cache/data_items_indexes.json')
 
         self.itemByQid = DataItemsByQid(self.data_items)
-        self.itemDescByQid = DataItemDescByQid(self.data_items)
+        self.itemDescByQid = DataItemDescByQid(self.data_items, self.itemIndexer)
         self.itemQidBySitelink = DataItemBySitelink(self.data_items)
         self.itemKeysByStrid = DataItemsKeysByStrid(self.data_items)
-        self.regionByLangCode = RegionByLangCode(self.data_items)
-        self.groupsByName = DataItemsByName(self.data_items, Q_GROUP)
-        self.statusesByName = DataItemsByName(self.data_items, Q_STATUS)
-
-        self.tags_per_key = list_to_dict_of_lists(self.data_items.get(), get_instance_of)
+        self.regionByLangCode = RegionByLangCode(self.data_items, self.itemIndexer)
+        self.groupsByName = DataItemsByName(self.data_items, self.itemIndexer, Q_GROUP)
+        self.statusesByName = DataItemsByName(self.data_items, self.itemIndexer, Q_STATUS)
+        self.itemsByInstanceOf = DataItemsByInstanceOf(self.data_items, self.itemIndexer)
+        self.itemQidByStridClaim = DataItemsByStridClaim(self.data_items, self.itemIndexer)
 
         self.description = WikiPagesWithTemplate(
             '_cache/wiki_raw_descriptions.json', site,
             ['Template:Description'],
             ['KeyDescription', 'ValueDescription', 'RelationDescription', 'Deprecated', 'Pl:KeyDescription',
-             'Pl:ValueDescription', 'Tag', 'Key', 'TagKey', 'TagValue'])
+             'Pl:ValueDescription', 'Tag', 'Key', 'TagKey', 'TagValue'],
+            self.fetcher)
+
+        self.descriptionParsed = DescriptionParser('_cache/wiki_parsed_descriptions.json', self.description,
+                                                   self.wikiTitles, self.itemKeysByStrid)
 
-        self.descriptionParsed = DescriptionParser('_cache/wiki_parsed_descriptions.json', self.description, pwb_site,
-                                                   self.itemKeysByStrid)
+        self.processorIndex = ProcessorIndex('_cache/processor_index.json', self.descriptionParsed, self.data_items,
+                                             self.itemKeysByStrid)
 
         self.keydescription = CachedFilteredDescription(self.descriptionParsed, 'Key')
         self.tagdescription = CachedFilteredDescription(self.descriptionParsed, 'Tag')
         self.reldescription = CachedFilteredDescription(self.descriptionParsed, 'Relation')
         self.relroledescriptions = RelationRolesDescription(self.descriptionParsed)
 
-        self.wikiPageTitles = WikiPageTitles('_cache/wiki_page_titles.json', site)
+        self.wikiPageTitles = WikiPageTitles('_cache/wiki_page_titles.json', site, self.fetcher)
 
         self.tagInfoDb = TagInfoDb('_cache/tag_info_db.json', '_cache/taginfo-db.db', self.data_items)
 
 
+    @property
+    def tags_per_key(self):
+        return self.itemsByInstanceOf.get()
+
     def qitem(self, qid: Union[str, List[str]]):
         if not qid: return '[New Item]'
         ids = self.itemDescByQid.get()
@@ -1,9 +1,11 @@
 import json
 import re
+import threading
 from collections import defaultdict
 
 from pywikiapi import Site, AttrDict
 
+from .Fetcher import Fetcher
 from .utils import to_json
 
 reComment = re.compile(r'^/\* wb(?P<cmd>[a-z]+)(?:-(?P<subcmd>[a-z]+))?:(?:[0-9|]+)?(?:\|(?P<lang>[a-z-]+))? \*/ (?P<text>.*)$')
@@ -12,10 +14,13 @@ reProperty = re.compile(r'\[\[Property:(?P<prop>P[0-9]+)\]\]')
 
 class DataItemContributors():
 
-    def __init__(self, filename: str, site: Site):
+    def __init__(self, filename: str, site: Site, fetcher: Fetcher = None):
         self.filename = filename
         self.site = site
+        self.fetcher = fetcher or Fetcher(site)
         self.data = {}
+        # Items are processed by multiple threads
+        self.lock = threading.Lock()
 
         try:
             with open(self.filename, "r") as file:
@@ -36,11 +41,11 @@ class DataItemContributors():
 
         if qid not in self.data:
             # Ensure we only get a single page result
-            (page,) = self.site.query_pages(prop='contributors', pclimit='max', titles=item_qid)
+            (page,) = self.fetcher.query_pages(prop='contributors', pclimit='max', titles=item_qid)
             if [v.name for v in page.contributors] == ['Yurikbot']:
                 return {}
 
-        (page,) = self.site.query_pages(prop='revisions', titles=item_qid, rvprop=['user', 'comment'], rvlimit='max')
+        (page,) = self.fetcher.query_pages(prop='revisions', titles=item_qid, rvprop=['user', 'comment'], rvlimit='max')
 
         data = defaultdict(set)
         for v in page.revisions:
@@ -70,11 +75,12 @@ class DataItemContributors():
             print(f'Unable to find any user contributions for {qid}')
         else:
             data = {'qid': qid, **{k: list(v) for k, v in data.items()}}
-            self.data[qid] = data
-            # with open(self.filename, "a") as file:
-            #     print(to_json({'qid': qid}), file=file)
-            with open(self.filename, "w+") as file:
-                for v in self.data.values():
-                    print(to_json(v), file=file)
+            with self.lock:
+                self.data[qid] = data
+                # with open(self.filename, "a") as file:
+                #     print(to_json({'qid': qid}), file=file)
+                with open(self.filename, "w+") as file:
+                    for v in self.data.values():
+                        print(to_json(v), file=file)
 
         return data
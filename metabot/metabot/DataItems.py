@@ -1,13 +1,18 @@
+import json
+import os
 from collections import defaultdict
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
 
-from pywikiapi import Site
+from pywikiapi import Site, AttrDict
 
 from .utils import strid_from_item, batches, get_instance_of
 from .consts import elements, Q_KEY, Q_LOCALE_INSTANCE
 from .Cache import CacheInMemory
-from .Properties import P_INSTANCE_OF, P_LANG_CODE
+from .Properties import P_INSTANCE_OF, P_LANG_CODE, P_KEY_ID, P_TAG_ID, P_REL_ID
 
-from .Cache import CacheJsonl
+from .Cache import CacheIndexedJsonl
+from .Fetcher import Fetcher
 from .utils import to_json, get_entities
 
 ignore_qids = {
@@ -15,30 +20,120 @@ ignore_qids = {
 }
 
 
-class DataItems(CacheJsonl):
+class DataItems(CacheIndexedJsonl):
+    """
+    All data items as JSON Lines. Besides the full regeneration, the cache can be brought up to date with sync(),
+    which only downloads the items created, edited or deleted since the last recent changes cursor,
+    stored next to the cache file.
+    """
 
-    def __init__(self, filename: str, site: Site, use_bot_limits: bool):
+    # Recent changes are only kept by MediaWiki for a limited time, do a full regeneration if the cursor is older
+    max_sync_age = timedelta(days=25)
+
+    def __init__(self, filename: str, site: Site, use_bot_limits: bool, fetcher: Fetcher = None):
         super().__init__(filename)
         self.site = site
         self.use_bot_limits = use_bot_limits
+        self.fetcher = fetcher or Fetcher(site)
+        self.state_filename = filename + '.state'
 
     def generate(self):
-        with open(self.filename, "w+") as file:
-            # For bots this might need to be smaller because the total download could exceed maximum allowed
-            batch_size = 500 if self.use_bot_limits else 50
-            for batch in batches(self.items(), batch_size):
-                entities = get_entities(self.site, ids=batch)
-                if entities:
-                    # JSON Lines format
-                    print('\n'.join(to_json(item) for item in entities), file=file)
+        cursor = datetime.utcnow().replace(tzinfo=timezone.utc)
+        self.fetcher.write_jsonl(self.filename, self.fetcher.map(
+            lambda batch: get_entities(self.fetcher, ids=batch), batches(self.items(), self.batch_size())))
+        self.save_cursor(cursor)
+
+    def secondary_keys(self, item):
+        sitelink = item.sitelinks.wiki.title if 'sitelinks' in item and 'wiki' in item.sitelinks else None
+        return {'sitelink': sitelink, 'strid': strid_from_item(item)}
+
+    def batch_size(self):
+        # For bots this might need to be smaller because the total download could exceed maximum allowed
+        return 500 if self.use_bot_limits else 50
 
     def items(self):
-        for q in self.site.query(list='allpages', apnamespace=120, apfilterredir='nonredirects', aplimit='max'):
+        for q in self.fetcher.query(list='allpages', apnamespace=120, apfilterredir='nonredirects', aplimit='max'):
             for p in q.allpages:
                 qid = p.title[len('Item:'):]
                 if qid not in ignore_qids:
                     yield qid
 
+    def load_cursor(self):
+        try:
+            with open(self.state_filename, "r") as file:
+                return datetime.fromisoformat(json.load(file)['cursor'].replace('Z', '+00:00'))
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def save_cursor(self, cursor):
+        with open(self.state_filename, "w") as file:
+            file.write(to_json({'cursor': cursor.strftime('%Y-%m-%dT%H:%M:%SZ')}))
+
+    def sync(self):
+        """Update the cache with the items changed since the last sync, or regenerate it if that is not possible"""
+        cursor = self.load_cursor()
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        if cursor is None or not os.path.isfile(self.filename) or now - cursor > self.max_sync_age:
+            self.regenerate()
+            return
+
+        changed = set()
+        for res in self.fetcher.query(list='recentchanges', rcnamespace=120, rcstart=cursor, rcdir='newer',
+                                      rcprop=['title', 'timestamp'], rctype=['edit', 'new', 'log'], rclimit='max'):
+            for change in res.recentchanges:
+                qid = change.title[len('Item:'):]
+                if qid not in ignore_qids:
+                    changed.add(qid)
+                cursor = max(cursor, datetime.fromisoformat(change.timestamp.replace('Z', '+00:00')))
+        if not changed:
+            print(f'No data item changes since {cursor}')
+            self.save_cursor(cursor)
+            return
+
+        revisions = {}
+        with open(self.filename, "r") as file:
+            for line in file:
+                if line.strip():
+                    item = json.loads(line)
+                    revisions[item['id']] = item.get('lastrevid')
+
+        updated = {}
+        existing = set()
+        fetch = lambda batch: get_entities(self.fetcher, ids=batch)
+        qid_batches = list(batches(sorted(changed), self.batch_size()))
+        for index, entities in self.fetcher.map(fetch, qid_batches):
+            if entities is None:
+                # Otherwise all of these items would be treated as deleted, and the cursor would move past them
+                raise ValueError(f'Unable to get data items {", ".join(qid_batches[index])}, '
+                                 f'the cache was not updated')
+            for item in entities:
+                # Merged items become redirects, and are removed from the cache together with the deleted ones
+                if 'redirects' in item:
+                    continue
+                existing.add(item['id'])
+                if item.get('lastrevid') != revisions.get(item['id']):
+                    updated[item['id']] = item
+        deleted = {qid for qid in changed if qid in revisions and qid not in existing}
+
+        tmp_filename = self.filename + '.tmp'
+        with open(self.filename, "r") as src, open(tmp_filename, "w") as file:
+            for line in src:
+                if not line.strip():
+                    continue
+                qid = json.loads(line)['id']
+                if qid in deleted:
+                    continue
+                if qid in updated:
+                    print(to_json(updated.pop(qid)), file=file)
+                else:
+                    file.write(line if line.endswith('\n') else line + '\n')
+            for item in updated.values():
+                print(to_json(item), file=file)
+        os.replace(tmp_filename, self.filename)
+        self.save_cursor(cursor)
+        self._data = None
+        print(f'Synced {len(changed)} changed data items, {len(deleted)} removed')
+
 
 class DataItemCache(CacheInMemory):
     def __init__(self, items):
@@ -46,38 +141,138 @@ class DataItemCache(CacheInMemory):
         self.items = items
 
 
+class DataItemIndexer:
+    """
+    Builds all registered DataItemIndex caches in a single pass over the data items, computing the values
+    they share (e.g. instance-of) only once per item. The result is saved to a JSON file together with
+    the stamp of the data items file, so a restart with unchanged data items does not rebuild anything.
+    """
+    version = 1
+
+    def __init__(self, items: DataItems, filename: str):
+        self.items = items
+        self.filename = filename
+        self.indexes = []
+        self.stamp = None
+        self.data = None
+
+    def register(self, index: 'DataItemIndex'):
+        self.indexes.append(index)
+        self.stamp = None
+
+    def get(self, name):
+        self.ensure()
+        return self.data[name]
+
+    def ensure(self):
+        stamp = [self.version, self.items.stamp(), sorted(v.name for v in self.indexes)]
+        if stamp == self.stamp:
+            return
+        data = None
+        try:
+            with open(self.filename, "r") as file:
+                saved = json.load(file)
+            if saved['stamp'] == stamp:
+                data = saved['indexes']
+        except (IOError, ValueError, KeyError):
+            pass
+        if data is None:
+            data = self.build()
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, "w") as file:
+                json.dump({'stamp': stamp, 'indexes': data}, file, ensure_ascii=False)
+            os.replace(tmp_filename, self.filename)
+        self.data = data
+        self.stamp = stamp
+        for index in self.indexes:
+            index.regenerate()
+
+    def build(self):
+        print(f'Building {len(self.indexes)} data item indexes')
+        data = {index.name: {} for index in self.indexes}
+        for item in self.items.iter(AttrDict):
+            instance_of = get_instance_of(item)
+            for index in self.indexes:
+                index.add(data[index.name], item, instance_of)
+        return data
+
+
+class DataItemIndex(DataItemCache):
+    """A derived cache that is built by DataItemIndexer, must set name and implement add()"""
+    name = None
+
+    def __init__(self, items, indexer: DataItemIndexer):
+        super().__init__(items)
+        self.indexer = indexer
+        indexer.register(self)
+
+    def get(self):
+        # Reloads the data if the data items have changed
+        self.indexer.ensure()
+        return super().get()
+
+    def generate(self):
+        return self.load(self.indexer.get(self.name))
+
+    def add(self, result, item, instance_of):
+        """Add a single item to the result, which must stay JSON-serializable"""
+        raise Exception('Not implemented by derived class')
+
+    def load(self, data):
+        """Convert the stored data into the value returned by get()"""
+        return data
+
+
+class ItemsByQidView(Mapping):
+    """Read-only qid -> item dictionary that reads items from the indexed cache on demand"""
+
+    def __init__(self, items):
+        self.items = items
+
+    def __getitem__(self, qid):
+        item = self.items.get_item(qid)
+        if item is None:
+            raise KeyError(qid)
+        return item
+
+    def __contains__(self, qid):
+        return qid in self.items.ids()
+
+    def __iter__(self):
+        return iter(self.items.ids())
+
+    def __len__(self):
+        return len(self.items.ids())
+
+
 class DataItemsByQid(DataItemCache):
     def generate(self):
-        result = {}
-        for item in self.items.get():
-            result[item['id']] = item
-        return result
+        return ItemsByQidView(self.items)
 
     def get_item(self, qid):
         return self.get()[qid]
 
 
-class DataItemDescByQid(DataItemCache):
-    def generate(self):
-        result = {}
-        ignore_ids = set(elements.values())
-        for item in self.items.get():
-            if 'en' in item['labels']:
-                value = item['labels']['en']['value']
-            else:
-                value = next(iter(item['labels'].values()), {'value': ''})['value']
-            if item['id'] not in ignore_ids:
-                value += ' (' + item['id'] + ')'
-            result[item['id']] = value
-        return result
+class DataItemDescByQid(DataItemIndex):
+    name = 'desc'
+    ignore_ids = set(elements.values())
+
+    def add(self, result, item, instance_of):
+        if 'en' in item['labels']:
+            value = item['labels']['en']['value']
+        else:
+            value = next(iter(item['labels'].values()), {'value': ''})['value']
+        if item['id'] not in self.ignore_ids:
+            value += ' (' + item['id'] + ')'
+        result[item['id']] = value
 
 
 class DataItemBySitelink(DataItemCache):
     def generate(self):
-        result = {}
-        for item in self.items.get():
-            if 'sitelinks' in item and 'wiki' in item['sitelinks']:
-                result[item['sitelinks']['wiki']['title']] = item['id']
+        result = dict(self.items.lookup('sitelink'))
+        # The index keeps the first item of a sitelink, but the last one has always been used here
+        for sitelink, qid in self.items.duplicates('sitelink'):
+            result[sitelink] = qid
         return result
 
 
@@ -87,16 +282,12 @@ class DataItemsKeysByStrid(DataItemCache):
         self.duplicate_strids = defaultdict(set)
 
     def generate(self):
-        result = {}
+        # A copy, because new items are added to it as they are created
+        result = dict(self.items.lookup('strid'))
         self.duplicate_strids.clear()
-        for item in self.items.get():
-            strid = strid_from_item(item)
-            if strid:
-                if strid in result:
-                    self.duplicate_strids[strid].add(result[strid])
-                    self.duplicate_strids[strid].add(item['id'])
-                else:
-                    result[strid] = item['id']
+        for strid, qid in self.items.duplicates('strid'):
+            self.duplicate_strids[strid].add(result[strid])
+            self.duplicate_strids[strid].add(qid)
         if self.duplicate_strids:
             print('#### DUPLICATE STRIDs')
             for strid, lst in self.duplicate_strids.items():
@@ -110,31 +301,87 @@ class DataItemsKeysByStrid(DataItemCache):
             return None
 
 
-class RegionByLangCode(DataItemCache):
-    def generate(self):
-        result = {}
-        for item in self.items.get():
-            if get_instance_of(item) == Q_LOCALE_INSTANCE:
-                result[P_LANG_CODE.get_claim_value(item)] = item
-        return result
+class RegionByLangCode(DataItemIndex):
+    name = 'regions'
 
+    def add(self, result, item, instance_of):
+        if instance_of == Q_LOCALE_INSTANCE:
+            result[P_LANG_CODE.get_claim_value(item)] = item['id']
 
-class DataItemsByName(DataItemCache):
-    def __init__(self, items, instanceof):
-        super().__init__(items)
+    def load(self, data):
+        return {k: self.items.get_item(v) for k, v in data.items()}
+
+
+class DataItemsByName(DataItemIndex):
+    def __init__(self, items, indexer, instanceof):
+        self.name = 'names-' + instanceof
         self.instanceof = instanceof
+        super().__init__(items, indexer)
 
-    def generate(self):
+    def add(self, result, item, instance_of):
+        if instance_of != self.instanceof:
+            return
+        qid = item['id']
+        labels = item['labels']
+        aliases = item['aliases']
+        for k, v in labels.items():
+            result[v['value'].lower()] = qid
+        for k, v in aliases.items():
+            for vv in v:
+                result[vv['value'].lower()] = qid
+
+
+class DataItemsByStridClaim(DataItemIndex):
+    """Key, tag and relation id claim value -> qid, ignoring items with multiple values of the same claim"""
+    name = 'strid_claims'
+    props = [P_KEY_ID, P_TAG_ID, P_REL_ID]
+
+    def add(self, result, item, instance_of):
+        for prop in self.props:
+            try:
+                values = prop.get_claim_value(item, allow_multiple=True)
+                if not values:
+                    continue
+                if len(values) > 1:
+                    raise ValueError('Found multiple key ids ')
+                result.setdefault(prop.id, {})[values[0]] = item['id']
+            except ValueError as err:
+                print(f'Error parsing key id from {item["id"]}: {err}')
+
+    def load(self, data):
+        # Later properties take precedence if the same value is used by more than one of them
         result = {}
-        for item in self.items.get():
-            if get_instance_of(item) != self.instanceof:
-                continue
-            qid = item['id']
-            labels = item['labels']
-            aliases = item['aliases']
-            for k, v in labels.items():
-                result[v['value'].lower()] = qid
-            for k, v in aliases.items():
-                for vv in v:
-                    result[vv['value'].lower()] = qid
+        for prop in self.props:
+            result.update(data.get(prop.id, {}))
         return result
+
+
+class DataItemsByInstanceOf(DataItemIndex):
+    name = 'instance_of'
+
+    def add(self, result, item, instance_of):
+        if instance_of:
+            result.setdefault(instance_of, []).append(item['id'])
+
+    def load(self, data):
+        return ItemListsView(self.items, data)
+
+
+class ItemListsView(Mapping):
+    """Read-only key -> list of items dictionary, items are read from the indexed cache when a list is accessed"""
+
+    def __init__(self, items, qids_by_key):
+        self.items = items
+        self.qids_by_key = qids_by_key
+
+    def __getitem__(self, key):
+        return [self.items.get_item(v) for v in self.qids_by_key[key]]
+
+    def __contains__(self, key):
+        return key in self.qids_by_key
+
+    def __iter__(self):
+        return iter(self.qids_by_key)
+
+    def __len__(self):
+        return len(self.qids_by_key)
@@ -1,38 +1,140 @@
-import pywikibot as pb
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 from pywikiapi import AttrDict
 
 from .WikiPagesWithTemplate import WikiPagesWithTemplate
 from .Cache import CacheJsonl
 from .DescriptionParserItem import ItemParser
+from .WikiTitles import WikiTitles
 from .utils import to_json
 
+# Set in the parent process before forking the parsing workers
+_worker_parser = None
+
+
+def _parse_in_worker(page):
+    return _worker_parser.parse_entry(page)
+
+
+class RecordingStrids:
+    """Stands in for the strid cache given to ItemParser, and records every lookup and its result"""
+
+    def __init__(self, data_item_cache):
+        self.strids = data_item_cache.get()
+        self.checked = []
+
+    def get(self):
+        return self
+
+    def __contains__(self, strid):
+        found = strid in self.strids
+        self.checked.append([list(strid), found])
+        return found
+
 
 class DescriptionParser(CacheJsonl):
+    """
+    Parsed description templates. Parsing results are memoized in <filename>.memo, keyed by a hash of the page's
+    title, template, parameters and the parser version, together with the data item lookups the parser made,
+    so only the pages that changed since the last run are parsed again, using all CPU cores.
+    Increase parser_version whenever ItemParser output changes.
+    """
+    parser_version = 2
 
-    def __init__(self, filename: str, pages: WikiPagesWithTemplate, pwb_site: pb.Site, data_item_cache):
+    def __init__(self, filename: str, pages: WikiPagesWithTemplate, titles: WikiTitles, data_item_cache):
         super().__init__(filename)
         self.pages = pages
-        self.pwb_site = pwb_site
+        self.titles = titles
         self.data_item_cache = data_item_cache
+        self.memo_filename = filename + '.memo'
+        self.memo = None
 
     def generate(self):
+        global _worker_parser
+
+        pages = list(self.pages.iter())
+        keys = [self.memo_key(page) for page in pages]
+        memo = self.load_memo()
+        entries = [memo.get(key) for key in keys]
+        todo = [i for i, entry in enumerate(entries) if not self.is_valid(entry)]
+        print(f'Parsing {len(todo)} changed pages, reusing {len(pages) - len(todo)} previous results')
+
+        if len(todo) < 100:
+            parsed = [self.parse_entry(pages[i]) for i in todo]
+        else:
+            # Workers are forked so that they inherit the site and the loaded caches without pickling them
+            self.data_item_cache.get()
+            self.titles.get()
+            _worker_parser = self
+            try:
+                with ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as executor:
+                    parsed = list(executor.map(_parse_in_worker, [pages[i] for i in todo], chunksize=64))
+            finally:
+                _worker_parser = None
+        for i, entry in zip(todo, parsed):
+            entries[i] = entry
+
         with open(self.filename, "w+") as file:
-            for page in self.pages.iter():
-                res = self.parse_item(page)
-                if res:
-                    print(to_json(res), file=file)
+            for page, entry in zip(pages, entries):
+                self.print_messages(page, entry)
+                if entry['result']:
+                    print(to_json(entry['result']), file=file)
 
-    def parse_item(self, page):
+        # Only keep the results of the current pages, so the memo does not grow forever
+        self.memo = dict(zip(keys, entries))
+        tmp_filename = self.memo_filename + '.tmp'
+        with open(tmp_filename, "w") as file:
+            json.dump(self.memo, file, ensure_ascii=False)
+        os.replace(tmp_filename, self.memo_filename)
+
+    def load_memo(self):
+        if self.memo is None:
+            try:
+                with open(self.memo_filename, "r") as file:
+                    self.memo = json.load(file)
+            except (IOError, ValueError):
+                self.memo = {}
+        return self.memo
+
+    def memo_key(self, page):
+        data = [self.parser_version, page['ns'], page['title'], page['template'], page['params']]
+        return hashlib.blake2b(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def is_valid(self, entry):
+        """A memoized result can be reused if all data item lookups it depended on still give the same answer"""
+        if entry is None:
+            return False
+        strids = self.data_item_cache.get()
+        return all((tuple(strid) in strids) == found for strid, found in entry['depends'])
+
+    def parse_entry(self, page):
         if page['ns'] % 2 != 1 and page['ns'] != 2: # and 'Proposed features/' not in page['title']:
-            item = ItemParser(self.pwb_site, page['ns'], page['title'], page['template'], page['params'], self.data_item_cache)
+            strids = RecordingStrids(self.data_item_cache)
+            item = ItemParser(self.titles, page['ns'], page['title'], page['template'], page['params'], strids)
             result = item.parse()
-            if item.messages:
-                print(f'#### {page["title"]}')
-                item.print_messages()
-            if result:
-                return result
+            return {'result': result or None, 'messages': item.messages, 'depends': strids.checked}
         # print(f'Skipping {page["title"]}')
-        return None
+        return {'result': None, 'messages': [], 'depends': []}
+
+    @staticmethod
+    def print_messages(page, entry):
+        if entry['messages']:
+            print(f'#### {page["title"]}')
+            print('  ' + '\n  '.join(entry['messages']))
+
+    def parse_item(self, page):
+        key = self.memo_key(page)
+        entry = self.load_memo().get(key)
+        if not self.is_valid(entry):
+            entry = self.parse_entry(page)
+            self.memo[key] = entry
+        self.print_messages(page, entry)
+        return entry['result']
 
     def parse_manual(self, pages):
         return [AttrDict(v) for v in [self.parse_item(p) for p in pages] if v]
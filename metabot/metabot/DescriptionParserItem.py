@@ -2,12 +2,11 @@ from typing import Union
 
 import re
 
-from pywikibot import textlib
-
 from .utils import remove_wikimarkup, re_wikidata, re_tag_link, goodValue, sitelink_normalizer, \
     parse_wiki_page_title, parse_members
 from .consts import languages
-import pywikibot as pb
+from .wikitext import extract_templates_and_params
+from .WikiTitles import WikiTitles, InvalidTitle
 
 templ_param_map = {
     'descrizione': 'description',
@@ -35,10 +34,10 @@ bad_images = ['osm element key.svg', 'mf key.svg', 'none yet.jpg', 'fi none yet.
 
 class ItemParser:
 
-    def __init__(self, pwb_site: pb.Site, ns, title, template, template_params,
+    def __init__(self, titles: WikiTitles, ns, title, template, template_params,
                  data_item_cache, print_info=False):
         self.print_info = print_info
-        self.pwb_site = pwb_site
+        self.titles = titles
         self.ns = ns
         self.title = title
         self.template = template.lower()
@@ -140,8 +139,8 @@ class ItemParser:
                 tval = (tval[2:-2].split('|')[0]).strip()
             if tval:
                 try:
-                    return tkey, pb.Page(self.pwb_site, tval).full_url()
-                except pb.exceptions.InvalidTitle:
+                    return tkey, self.titles.full_url(tval)
+                except InvalidTitle:
                     self.print(f'Unparsable {tkey}={tval}')
         elif tkey in ['image', 'osmcarto-rendering']:
             tval2 = tval.lower()
@@ -153,8 +152,8 @@ class ItemParser:
                         tval = 'File:' + tval[len('Image:'):]
                     elif tval.startswith('file:'):
                         tval = 'File:' + tval[len('file:'):]
-                    return tkey, pb.FilePage(self.pwb_site, tval).titleWithoutNamespace()
-                except:
+                    return tkey, self.titles.file_name(tval)
+                except InvalidTitle:
                     self.print(f'image="{tval}" cannot be processed')
         elif tkey in ['combination', 'implies', 'seealso', 'requires']:
             tags = self.parse_combinations(tkey, tval)
@@ -174,7 +173,7 @@ class ItemParser:
 
     def parse_combinations(self, tkey, tval):
         items = []
-        for template in textlib.extract_templates_and_params(tval, True, True):
+        for template in extract_templates_and_params(tval):
             for k, v in self.parse_tag(template):
                 if v:
                     items.append(('Tag', f'{k}={v}'))
@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable
+
+import requests
+from pywikiapi import Site, AttrDict
+
+from .Fetcher import Fetcher
+from .utils import to_json, get_entities
+
+
+class EditQueue:
+    """
+    Data item edits waiting to be uploaded, saved to a JSON Lines file as soon as they are submitted.
+    A single writer thread uploads them in order, no faster than the edit rate limit of the logged-in user,
+    and pauses together with the other API requests of the fetcher when the server is lagging.
+    Edits that were not uploaded when the process stopped are uploaded first on the next start().
+    on_done(strid, qid) is called on the writer thread after each successful edit.
+    """
+
+    def __init__(self, filename: str, site: Site, fetcher: Fetcher = None, on_done: Callable = None,
+                 throw=True, max_pending=100, min_interval=1.0):
+        self.filename = filename
+        self.site = site
+        self.fetcher = fetcher or Fetcher(site)
+        self.on_done = on_done
+        self.throw = throw
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.interval = min_interval
+        self.pending = deque()
+        self.last_id = 0
+        self.done_id = 0
+        self.error = None
+        self.stopping = False
+        self.thread = None
+        self.file = None
+        self.cond = threading.Condition()
+
+    @property
+    def active(self):
+        return self.thread is not None
+
+    def start(self):
+        """Loads the edits left from the previous run, and starts the writer thread"""
+        self.load()
+        self.interval = self.get_edit_interval()
+        self.stopping = False
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, name='EditQueue', daemon=True)
+        self.thread.start()
+        if self.pending:
+            print(f'Resuming {len(self.pending)} edits from the previous run')
+
+    def stop(self):
+        """Stops the writer thread after the current edit, unfinished edits stay in the file"""
+        if not self.thread:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+        self.file = None
+        if not self.pending:
+            os.remove(self.filename)
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.filename, "r") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line, object_hook=AttrDict)
+                        if 'done' in entry:
+                            entries.pop(entry.done, None)
+                        else:
+                            entries[entry.id] = entry
+        except IOError:
+            pass
+        self.pending = deque(entries.values())
+        for entry in self.pending:
+            entry.strid = tuple(entry.strid) if entry.strid else None
+        self.last_id = max(entries.keys(), default=0)
+        self.done_id = self.pending[0].id - 1 if self.pending else self.last_id
+        # Compact the file, keeping only the unfinished edits
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, "w") as file:
+            for entry in self.pending:
+                print(to_json(entry), file=file)
+        os.replace(tmp_filename, self.filename)
+        self.file = open(self.filename, "a")
+
+    def get_edit_interval(self):
+        """Seconds between edits, so that the edit rate limits of the logged-in user are never reached"""
+        resp = self.fetcher('query', meta='userinfo', uiprop=['ratelimits', 'rights'])
+        userinfo = resp.query.userinfo
+        if 'noratelimit' in userinfo.get('rights', []):
+            return self.min_interval
+        limits = userinfo.get('ratelimits', {}).get('edit', {}).values()
+        return max([self.min_interval] + [v['seconds'] / v['hits'] for v in limits if v.get('hits')])
+
+    def queued_strids(self):
+        with self.cond:
+            return {entry.strid for entry in self.pending}
+
+    def submit(self, strid, data, summary, qid=None, baserevid=None, wait=False):
+        """
+        Adds an edit to the queue, waiting if too many edits are already pending.
+        If wait is set, returns after the edit and all the edits submitted before it are done.
+        """
+        with self.cond:
+            while len(self.pending) >= self.max_pending and not self.error:
+                self.cond.wait()
+            self.raise_error()
+            self.last_id += 1
+            entry = AttrDict(id=self.last_id, strid=strid, summary=summary, qid=qid, baserevid=baserevid,
+                             data=data)
+            print(to_json(entry), file=self.file, flush=True)
+            self.pending.append(entry)
+            self.cond.notify_all()
+        if wait:
+            self.wait(entry.id)
+
+    def wait(self, upto=None):
+        """Waits until all edits submitted so far (or up to the given id) are done"""
+        with self.cond:
+            if upto is None:
+                upto = self.last_id
+            while self.done_id < upto and not self.error:
+                self.cond.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error:
+            raise self.error
+
+    def writer(self):
+        last_edit = 0
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                entry = self.pending[0]
+            delay = last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                qid = self.edit(entry)
+                if qid and self.on_done:
+                    self.on_done(entry.strid, qid)
+            except Exception as err:
+                if self.is_conflict(err):
+                    print(f'Skipping the edit of {entry.qid} {entry.strid}, '
+                          f'it was modified after the changes were computed')
+                else:
+                    print(f'\n\n\n\nCrashed with {err} while uploading\n{entry.strid} {entry.qid or ""}\n')
+                    traceback.print_tb(err.__traceback__)
+                    print('\n\n\n\n')
+                    if self.throw:
+                        with self.cond:
+                            self.error = err
+                            self.cond.notify_all()
+                        return
+            # The limit is counted from the end of the previous edit, which might have been retried for a while
+            last_edit = time.monotonic()
+            with self.cond:
+                self.pending.popleft()
+                self.done_id = entry.id
+                print(to_json({'done': entry.id}), file=self.file, flush=True)
+                self.cond.notify_all()
+
+    def edit(self, entry):
+        params = AttrDict()
+        params.summary = entry.summary
+        params.data = to_json(entry.data)
+        params.bot = 1
+        params.POST = 1
+        if entry.qid:
+            params.id = entry.qid
+            params.clear = 1
+            if entry.baserevid:
+                # The changes were computed from this revision, do not overwrite newer edits
+                params.baserevid = entry.baserevid
+        else:
+            params.new = 'item'
+        if entry.qid:
+            result = self.fetcher('wbeditentity', token=self.site.token(), **params)
+        else:
+            result = self.create(entry, params)
+        if not result.success:
+            return None
+        print(f'+++ Data item {entry.strid[0] + " " + entry.strid[1] if entry.strid else ""} '
+              f'({result.entity.id}) updated!')
+        return result.entity.id
+
+    def create(self, entry, params):
+        """Creates a new item. Not retried on timeouts, because a repeated request could create a duplicate"""
+        try:
+            return self.fetcher.edit('wbeditentity', token=self.site.token(), **params)
+        except (requests.ConnectionError, requests.Timeout):
+            # The item might have been saved before the connection was lost
+            sitelink = entry.data.get('sitelinks', {}).get('wiki', {}).get('title')
+            item = get_entities(self.fetcher, titles=sitelink) if sitelink else None
+            if not item:
+                raise
+            print(f'Data item {item["id"]} for {sitelink} was created before the connection was lost')
+            return AttrDict(success=1, entity=AttrDict(id=item['id']))
+
+    @staticmethod
+    def is_conflict(err):
+        data = getattr(err, 'data', None)
+        return isinstance(data, dict) and data.get('code') == 'editconflict'
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable
+
+import requests
+from pywikiapi import Site, ApiError
+
+from .utils import to_json
+
+# API errors that mean "the server is busy, try again later"
+retry_codes = {'maxlag', 'ratelimited', 'readonly', 'internal_api_error_DBQueryError'}
+
+
+class Fetcher:
+    """
+    Runs MediaWiki API requests of the cache generators on a few threads. Every request is sent with
+    the maxlag parameter, and when the server reports that it is lagging or overloaded (maxlag errors,
+    HTTP 429/503 with Retry-After), all workers pause before retrying, with a growing backoff.
+    Can be used instead of a Site with get_entities().
+
+    The site's own maxlag retries are disabled, so that every thread pauses together. Requests to the same site
+    should therefore be made through a fetcher. pywikiapi does not expose the failed responses, so the Retry-After
+    header is recorded for each thread by a session hook.
+    """
+
+    def __init__(self, site: Site, workers=4, maxlag=5, max_retries=8, max_backoff=300):
+        self.site = site
+        self.workers = workers
+        self.maxlag = maxlag
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.last_response = threading.local()
+        site.retry_on_lag_error = 0
+        site.session.hooks['response'].append(self.on_response)
+
+    def __call__(self, *args, **kwargs):
+        return self.retry(lambda: self.site(*args, maxlag=self.maxlag, **kwargs))
+
+    def edit(self, *args, **kwargs):
+        """
+        Same as calling the fetcher, but for requests that must not be sent twice, e.g. creating a new item.
+        A request that timed out or lost its connection is not retried, because the server might have saved it.
+        """
+        return self.retry(lambda: self.site(*args, maxlag=self.maxlag, **kwargs), idempotent=False)
+
+    def query(self, **kwargs):
+        """Same as Site.query, but returns a list of all results, retrying the whole query on errors"""
+        return self.retry(lambda: list(self.site.query(maxlag=self.maxlag, **kwargs)))
+
+    def query_pages(self, **kwargs):
+        """Same as Site.query_pages, but returns a list of all pages, retrying the whole query on errors"""
+        return self.retry(lambda: list(self.site.query_pages(maxlag=self.maxlag, **kwargs)))
+
+    def on_response(self, response, *args, **kwargs):
+        self.last_response.retry_after = response.headers.get('Retry-After')
+
+    def retry(self, func, idempotent=True):
+        attempt = 0
+        while True:
+            self.wait()
+            self.last_response.retry_after = None
+            try:
+                return func()
+            except Exception as err:
+                delay = self.get_retry_delay(err, self.last_response.retry_after, idempotent)
+                attempt += 1
+                if delay is None or attempt > self.max_retries:
+                    raise
+                delay = min(self.max_backoff, max(delay, 2 ** attempt))
+                print(f'Server is busy ({err}), pausing for {delay} seconds, retry #{attempt}')
+                with self.lock:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    @staticmethod
+    def get_retry_delay(err, retry_after=None, idempotent=True):
+        """
+        Returns the number of seconds to wait before retrying, or None if the error should not be retried.
+        retry_after is the Retry-After header of the failed response, if any.
+        """
+        try:
+            retry_after = max(0, int(float(retry_after))) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        if isinstance(err, requests.exceptions.RetryError):
+            # The session's own retries of 5xx errors were exhausted
+            return 0
+        if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+            # A request that could not connect was never sent
+            if idempotent or isinstance(err, requests.ConnectTimeout):
+                return 0
+            return None
+        if not isinstance(err, ApiError) or not isinstance(err.data, dict):
+            return None
+        if 'status_code' in err.data:
+            # Site.request() failed with an HTTP error
+            if err.data['status_code'] in (429, 503):
+                return retry_after or 0
+            return None
+        if err.data.get('code') in retry_codes:
+            return retry_after if retry_after is not None else 5
+        return None
+
+    def map(self, func: Callable, items: Iterable):
+        """
+        Calls func(item) for each item on the worker threads, and yields (index, result) in completion order.
+        Only a limited number of items is taken from the iterable at a time.
+        """
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = {}
+            for index, item in enumerate(items):
+                pending[executor.submit(func, item)] = index
+                if len(pending) >= self.workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+    def write_jsonl(self, filename: str, results: Iterable):
+        """
+        Writes (index, list of objects) results, as produced by map(), into a JSON Lines file.
+        Results are written to a temporary file as soon as they arrive, and then copied to the final file
+        ordered by index, so that the output does not depend on the order in which requests completed.
+        """
+        tmp_filename = filename + '.tmp'
+        chunks = []
+        with open(tmp_filename, 'w+b') as tmp:
+            for index, objects in results:
+                if objects:
+                    data = ''.join(to_json(v) + '\n' for v in objects).encode('utf-8')
+                    chunks.append((index, tmp.tell(), len(data)))
+                    tmp.write(data)
+            with open(filename, 'wb') as file:
+                for _, offset, length in sorted(chunks):
+                    tmp.seek(offset)
+                    file.write(tmp.read(length))
+        os.remove(tmp_filename)
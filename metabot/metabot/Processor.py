@@ -1,18 +1,19 @@
+import threading
 import traceback
-from time import sleep
-import pywikibot as pb
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import re
-from collections import defaultdict
-
 from pywikiapi import Site, AttrDict
 
 from .consts import Q_LOCALE_INSTANCE, Q_GROUP
 from .ItemFromConcept import ItemFromConcept
 from .CacheInstances import Caches
+from .EditQueue import EditQueue
 from .ItemFromWiki import ItemFromWiki
 from .UploadItem import UploadItem
-from .Properties import P_KEY_ID, P_TAG_ID, P_INSTANCE_OF, P_SUBCLASS_OF, P_REL_ID
-from .utils import get_entities, list_to_dict_of_lists, sitelink_normalizer, strid_from_item, id_to_sitelink
+from .Properties import P_INSTANCE_OF, P_SUBCLASS_OF
+from .utils import get_entities, strid_from_item, id_to_sitelink, batches, sitelink_normalizer
 
 known_ignored_types = {
     Q_GROUP
@@ -20,6 +21,9 @@ known_ignored_types = {
 
 
 class Processor:
+    # Items are processed in windows: all changes of a window are computed first, and then the changed items
+    # are downloaded together. wbgetentities and page queries accept up to 50 ids or titles per request.
+    window_size = 50
 
     def __init__(self, opts, caches: Caches, site: Site) -> None:
         self.opts = AttrDict({
@@ -32,73 +36,29 @@ class Processor:
             'overwrite_user_claims': False,
             'print_user_edits': False,
             'force_all': False,
+            # Number of threads computing the changes, while the edits are uploaded by a single writer thread
+            'workers': 2,
             **(opts or {})
         })
         self.caches = caches
         self.site = site
 
-        wiki_items = (
-            []
-            + self.caches.keydescription.get()
-            + self.caches.tagdescription.get()
-            + self.caches.reldescription.get()
-            # + self.caches.relroledescriptions.get()
-        )
-
-        # For each variant of str_id, count how many variants there are.
-        # Ideally should be 1 for each, but if something defines two variants,
-        # e.g. "Key:blah_blah" and "Key:blah blah",
-        # each of the values will have 2 or more
-        self.str_id_variants_count = defaultdict(int)
-        for s in [
-            set(lst)
-            for k, lst in list_to_dict_of_lists(
-                set([(v.type, v.str_id) for v in self.caches.descriptionParsed.get() if v.str_id] +
-                [v for v in self.caches.itemKeysByStrid.get().keys() if v[1]]),
-                lambda v: (v[0], sitelink_normalizer(v[1], v[0] + ':'))).items()
-        ]:
-            for v in s:
-                self.str_id_variants_count[v] = len(s)
-            if len(s) > 1:
-                print('Ambiguous entries: "' + '", "'.join([str(v) for v in s]) + '"')
-
-        self.existing_items_strids = set(self.caches.itemKeysByStrid.get().keys())
-        self.wiki_items_by_norm_id = list_to_dict_of_lists(wiki_items, lambda v: id_to_sitelink(v.type, v.str_id) if v.str_id else None)
-        wiki_items_by_id = list_to_dict_of_lists(wiki_items, lambda v: (v.type, v.str_id) if v.str_id else None)
-        self.new_items_strids = {k:v for k,v in wiki_items_by_id.items() if k not in self.existing_items_strids}
-
-        self.all_items_by_strid = {
-            **self.items_by_strid(P_KEY_ID),
-            **self.items_by_strid(P_TAG_ID),
-            **self.items_by_strid(P_REL_ID),
-        }
-
-    def items_by_strid(self, prop, fix_multiple=False):
-        result = {}
-        for item in self.caches.data_items.get():
-            qid = item.id
-            try:
-                values = prop.get_claim_value(item, allow_multiple=True)
-                if not values or len(values) == 0:
-                    continue
-                if len(values) == 1:
-                    result[values[0]] = item
-                    continue
-                if not fix_multiple:
-                    raise ValueError('Found multiple key ids ')
-                if len(set(values)) > 1:
-                    raise ValueError('Found multiple different keys')
-
-                print(f'Removing multiple duplicate keys from { self.caches.qitem(qid)}...')
-                raise ValueError('Not implemented')
-            except ValueError as err:
-                print(f'Error parsing key id from { self.caches.qitem(qid)}: {err}')
+        # Lookup tables are persisted, and shared by all processors using the same caches
+        self.index = self.caches.processorIndex
 
-        return result
+        self.edits = EditQueue('_cache/edit_queue.json', site, self.caches.fetcher, self.item_uploaded,
+                               self.opts.throw)
+        # Items that are created while computing the changes of other items are processed one at a time
+        self.nested_lock = threading.RLock()
+        self.resumed_strids = set()
+        # Sitelink -> strid of the new items that are queued, but not created yet. Another window could
+        # otherwise queue the same item again, because it is only added to the caches once it is uploaded.
+        self.pending_creations = {}
+        self.pending_lock = threading.Lock()
 
     def run(self, mode):
         if mode == 'new':
-            items = self.new_items_strids
+            items = self.index.get_new_strids()
         elif mode == 'old':
             items = self.caches.itemKeysByStrid.get()
         elif mode == 'taginfo_keys':
@@ -108,29 +68,95 @@ class Processor:
         elif mode == 'taginfo-tags':
             items = [('Tag', v.k+'='+v.v) for v in self.caches.tagInfoDb.get()]
         elif mode == 'relations':
-            items = filter(lambda v: v and v.type == 'Relation', self.new_items_strids)
+            items = filter(lambda v: v and v[0] == 'Relation', self.index.get_new_strids())
         elif mode == 'relroles':
             items = map(lambda v: v.str_id, self.caches.relroledescriptions.get())
         else:
             items = [mode] if type(mode) == tuple else mode
             mode = f'single object - {mode}'
 
+        if self.edits.active:
+            # Called from ItemFromWiki or UploadItem to create a missing item, which is needed right away
+            with self.nested_lock:
+                self.edits.wait()
+                for window in batches(items, self.window_size):
+                    self.run_window(window, True)
+            return
+
         print(f'********** Running in {mode} mode')
-        for obj in items:
-            try:
-                self.do_item(obj)
-            except Exception as err:
-                print(f'\n\n\n\nCrashed with {err} while processing\n{obj}\n')
-                traceback.print_tb(err.__traceback__)
-                print('\n\n\n\n')
-                if self.opts['throw']:
-                    raise
-                else:
-                    sleep(15)
-
-    def do_item(self, obj):
-        if not obj:
+        self.preload()
+        self.edits.start()
+        try:
+            # Edits left from an interrupted run are uploaded first, do not compute them again
+            self.resumed_strids = self.edits.queued_strids()
+            # Compute the changes of a limited number of windows ahead of the edit queue
+            with ThreadPoolExecutor(self.opts.workers) as executor:
+                futures = deque()
+                try:
+                    for window in batches(items, self.window_size):
+                        futures.append(executor.submit(self.run_window, window))
+                        if len(futures) >= self.opts.workers * 2:
+                            futures.popleft().result()
+                    while futures:
+                        futures.popleft().result()
+                finally:
+                    for future in futures:
+                        future.cancel()
+            self.edits.wait()
+        finally:
+            self.edits.stop()
+            self.index.save()
+            # Creations that failed can be tried again by the next run
+            self.pending_creations.clear()
+
+    def preload(self):
+        """Load the shared caches before they are used by multiple threads"""
+        self.index.ensure()
+        self.caches.data_items.ids()
+        self.caches.itemKeysByStrid.get()
+        self.caches.itemQidByStridClaim.get()
+        self.caches.itemDescByQid.get()
+
+    def item_uploaded(self, strid, qid):
+        if strid:
+            with self.pending_lock:
+                for sitelink in [k for k, v in self.pending_creations.items() if v == strid]:
+                    del self.pending_creations[sitelink]
+            self.caches.itemKeysByStrid.get()[strid] = qid
+            self.caches.itemQidByStridClaim.get()[strid[1]] = qid
+            self.index.item_uploaded(strid)
+
+    @contextmanager
+    def crash_handler(self, obj):
+        try:
+            yield
+        except Exception as err:
+            print(f'\n\n\n\nCrashed with {err} while processing\n{obj}\n')
+            traceback.print_tb(err.__traceback__)
+            print('\n\n\n\n')
+            if self.opts['throw']:
+                raise
+
+    def run_window(self, objects, wait_for_edits=False):
+        todo = []
+        for obj in objects:
+            with self.crash_handler(obj):
+                task = self.prepare_item(obj)
+                if task:
+                    todo.append(task)
+        if not todo:
             return
+        fetched = None
+        with self.crash_handler(objects):
+            fetched = self.prefetch(todo)
+        for obj, strid, item, wiki_pages in fetched or []:
+            with self.crash_handler(obj):
+                self.do_item_run(strid, item, wiki_pages, False, wait_for_edits)
+
+    def prepare_item(self, obj):
+        """Computes the changes without editing, and returns the values needed to update the item, or None"""
+        if not obj:
+            return None
         item = None
         wiki_pages = None
 
@@ -142,34 +168,79 @@ class Processor:
         if strid:
             if strid[0] == 'Locale':
                 print(f'Skipping "{strid}"')
-                return
-            if strid in self.str_id_variants_count and self.str_id_variants_count[strid] > 1 and not self.opts.force_all:
+                return None
+            if strid in self.resumed_strids:
+                print(f'Skipping "{strid}", its edit was resumed from the previous run')
+                return None
+            if self.is_being_created(strid):
+                print(f'Skipping "{strid}", its data item is waiting to be created')
+                return None
+            if self.index.variants_count(strid) > 1 and not self.opts.force_all:
                 print(f'Skipping ambiguous "{strid}"')
-                return
+                return None
             sl = id_to_sitelink(strid[0], strid[1])
-            if sl in self.wiki_items_by_norm_id:
-                wiki_pages = self.wiki_items_by_norm_id[sl]
-            if strid in self.all_items_by_strid:
-                item2 = self.all_items_by_strid[strid]
+            wiki_pages = self.index.wiki_pages(sl)
+            strid_claims = self.caches.itemQidByStridClaim.get()
+            if strid in strid_claims:
+                item2 = self.caches.data_items.get_item(strid_claims[strid])
                 if not item:
                     item = item2
                 elif item2 and item != item2:
                     print(f'Skipping {strid} because it matched {item.id} and {item2.id}')
-                    return
+                    return None
         change, sitelink = self.do_item_run(strid, item, wiki_pages, True)
         if change or self.opts.force_all:
+            return obj, strid, item, wiki_pages, sitelink
+        return None
+
+    def is_being_created(self, strid):
+        with self.pending_lock:
+            return strid in self.pending_creations.values()
+
+    def reserve_creation(self, strid, sitelink):
+        """Returns False if a new item with the same sitelink is already queued"""
+        with self.pending_lock:
+            if sitelink in self.pending_creations:
+                return False
+            self.pending_creations[sitelink] = strid
+            return True
+
+    def prefetch(self, todo):
+        """
+        Re-downloads the description pages and the data items of all the items that need to be updated,
+        in batches, and returns a list of (obj, strid, fresh item or None, fresh wiki pages)
+        """
+        titles = {p.full_title: None
+                  for _, strid, _, wiki_pages, _ in todo if wiki_pages and strid and strid[0] != 'Role'
+                  for p in wiki_pages}
+        unparsed = defaultdict(list)
+        for batch in batches(titles, self.window_size):
+            for page in self.caches.description.get_new_pages(batch):
+                unparsed[page['title']].append(page)
+
+        by_qid = {}
+        qids = {item.id: None for _, _, item, _, _ in todo if item}
+        for batch in batches(qids, self.window_size):
+            for entity in get_entities(self.caches.fetcher, ids=batch) or []:
+                by_qid[entity['id']] = entity
+
+        by_sitelink = {}
+        sitelinks = {sitelink: None for _, _, item, _, sitelink in todo if not item and sitelink}
+        for batch in batches(sitelinks, self.window_size):
+            for entity in get_entities(self.caches.fetcher, titles=batch) or []:
+                if 'wiki' in entity.get('sitelinks', {}):
+                    by_sitelink[sitelink_normalizer(entity['sitelinks']['wiki']['title'])] = entity
+
+        result = []
+        for obj, strid, item, wiki_pages, sitelink in todo:
             if wiki_pages and strid and strid[0] != 'Role':
-                unparsed = self.caches.description.get_new_pages([p.full_title for p in wiki_pages])
-                wiki_pages = self.caches.descriptionParsed.parse_manual(unparsed)
-            if item:
-                item = get_entities(self.site, ids=item.id)
-            else:
-                item = get_entities(self.site, titles=sitelink)
-            if item:
-                item = AttrDict(item)
-            self.do_item_run(strid, item, wiki_pages, False)
+                wiki_pages = self.caches.descriptionParsed.parse_manual(
+                    [page for p in wiki_pages for page in unparsed[p.full_title]])
+            entity = by_qid.get(item.id) if item else by_sitelink.get(sitelink)
+            result.append((obj, strid, AttrDict(entity) if entity else None, wiki_pages))
+        return result
 
-    def do_item_run(self, strid, item, wiki_pages, dry_run):
+    def do_item_run(self, strid, item, wiki_pages, dry_run, wait_for_edits=False):
         status_id = self.caches.qitem(item.id) if item else ''
         if item and P_SUBCLASS_OF.get_claim_value(item):
             return None, None
@@ -198,13 +269,17 @@ class Processor:
                 parsed_item.print_messages()
                 uploader.print_messages()
         else:
+            if uploader.needs_changes and not item and strid[0] != 'Role' and \
+                    not self.reserve_creation(strid, parsed_item.sitelink):
+                print(f'Skipping {status_id}, a data item for {parsed_item.sitelink} is waiting to be created')
+                return None, None
             if uploader.needs_changes:
                 print(f'==== Updating {status_id} ====')
                 parsed_item.print_messages()
                 uploader.print_messages()
                 if strid[0] != 'Role':
                     # FIXME: !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                    uploader.upload_item_updates()
+                    uploader.upload_item_updates(self.edits, wait_for_edits)
                 uploader.print_messages()
                 print(f'==== Done updating {status_id} ====')
             else:
@@ -214,7 +289,7 @@ class Processor:
         return uploader.needs_changes, parsed_item.sitelink
 
     def get_nonbot_editors(self, qid):
-        resp = self.site('query', prop='contributors', pclimit='max', titles='Item:' + qid)
+        resp = self.caches.fetcher('query', prop='contributors', pclimit='max', titles='Item:' + qid)
         contributors = [v.name for v in resp.query.pages[0].contributors]
         return ', '.join([c for c in contributors if c != 'Yurikbot']) if contributors != ['Yurikbot'] else False
 
@@ -228,17 +303,3 @@ class Processor:
                 continue
             if count_all > 5000 or (count_all > 50 and re_key.match(key)):
                 yield key
-
-    # def del_params(self):
-    #     pwb_site = self.caches.descriptionParsed.pwb_site
-    #     for wp in self.caches.descriptionParsed.get():
-    #         if not wp.del_params:
-    #             continue
-    #         page = pb.Page(pwb_site, wp.full_title)
-    #         text = page.get()
-    #         re.sub()
-    #         # page.raw_extracted_templates
-    #         # pb.textlib.glue_template_and_params()
-    #         # print(text)
-    #
-    #
@@ -0,0 +1,146 @@
+import json
+import os
+from collections import defaultdict
+
+from pywikiapi import AttrDict
+
+from .DataItems import DataItems, DataItemsKeysByStrid
+from .DescriptionParser import DescriptionParser
+from .utils import sitelink_normalizer, id_to_sitelink
+
+
+class ProcessorIndex:
+    """
+    Lookup tables used by the Processor, built from the parsed descriptions and the data items.
+    They are saved to a JSON file together with the stamps of both caches, so they are only rebuilt
+    when one of them changes. Wiki items are stored as their positions in the parsed descriptions file,
+    and are read from it on demand. Call save() to persist the changes made by item_uploaded().
+    """
+    version = 1
+
+    # Same order as the Key, Tag and Relation filtered descriptions
+    wiki_item_types = ['Key', 'Tag', 'Relation']
+
+    def __init__(self, filename: str, descriptions: DescriptionParser, items: DataItems,
+                 items_by_strid: DataItemsKeysByStrid):
+        self.filename = filename
+        self.descriptions = descriptions
+        self.items = items
+        self.items_by_strid = items_by_strid
+        self.stamp = None
+        self.variants = None
+        self.wiki_items = None
+        self.new_strids = None
+        self.modified = False
+
+    def ensure(self):
+        stamp = [self.version, self.descriptions.stamp(), self.items.stamp()]
+        if stamp == self.stamp:
+            return
+        data = None
+        try:
+            with open(self.filename, "r") as file:
+                saved = json.load(file)
+            if saved['stamp'] == stamp:
+                data = saved
+        except (IOError, ValueError, KeyError):
+            pass
+        if data is None:
+            data = self.build()
+            data['stamp'] = stamp
+            self.write(data)
+        self.variants = {(typ, strid): count for typ, strid, count in data['variants']}
+        self.wiki_items = data['wiki_items']
+        # dict preserves the order, and allows removing the items that have been created
+        self.new_strids = {tuple(v): None for v in data['new_strids']}
+        self.stamp = stamp
+        self.modified = False
+
+    def build(self):
+        print('Building processor index')
+        strids = set()
+        wiki_items = {typ: [] for typ in self.wiki_item_types}
+        with open(self.descriptions.filename, "rb") as file:
+            offset = 0
+            for line in file:
+                if line.strip():
+                    item = json.loads(line, object_hook=AttrDict)
+                    if item.str_id:
+                        strids.add((item.type, item.str_id))
+                        if item.type in wiki_items:
+                            wiki_items[item.type].append((item.type, item.str_id, offset, len(line)))
+                offset += len(line)
+
+        # For each variant of str_id, count how many variants there are.
+        # Ideally should be 1 for each, but if something defines two variants,
+        # e.g. "Key:blah_blah" and "Key:blah blah",
+        # each of the values will have 2 or more. Only the ambiguous ones are stored.
+        existing_strids = set(self.items_by_strid.get().keys())
+        variants = defaultdict(set)
+        for v in strids.union(v for v in existing_strids if v[1]):
+            variants[(v[0], sitelink_normalizer(v[1], v[0] + ':'))].add(v)
+        ambiguous = []
+        for s in variants.values():
+            if len(s) > 1:
+                print('Ambiguous entries: "' + '", "'.join([str(v) for v in s]) + '"')
+                ambiguous.extend([typ, strid, len(s)] for typ, strid in s)
+
+        by_norm_id = defaultdict(list)
+        new_strids = {}
+        for typ in self.wiki_item_types:
+            for _, strid, offset, length in wiki_items[typ]:
+                by_norm_id[id_to_sitelink(typ, strid)].append([offset, length])
+                if (typ, strid) not in existing_strids:
+                    new_strids[(typ, strid)] = None
+
+        return {
+            'variants': ambiguous,
+            'wiki_items': by_norm_id,
+            'new_strids': list(new_strids),
+        }
+
+    def write(self, data):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, "w") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_filename, self.filename)
+
+    def save(self):
+        if self.modified:
+            self.write({
+                'stamp': self.stamp,
+                'variants': [[typ, strid, count] for (typ, strid), count in self.variants.items()],
+                'wiki_items': self.wiki_items,
+                'new_strids': list(self.new_strids),
+            })
+            self.modified = False
+
+    def variants_count(self, strid):
+        """Number of different strids that normalize to the same wiki page, 1 if it is not ambiguous"""
+        self.ensure()
+        return self.variants.get(tuple(strid), 1)
+
+    def wiki_pages(self, sitelink):
+        """All parsed description pages of the given normalized id, or None"""
+        self.ensure()
+        positions = self.wiki_items.get(sitelink)
+        if not positions:
+            return None
+        with open(self.descriptions.filename, "rb") as file:
+            result = []
+            for offset, length in positions:
+                file.seek(offset)
+                result.append(json.loads(file.read(length), object_hook=AttrDict))
+            return result
+
+    def get_new_strids(self):
+        """Strids that are described on the wiki, but do not have a data item yet"""
+        self.ensure()
+        return list(self.new_strids)
+
+    def item_uploaded(self, strid):
+        """The data item of the strid has been created or updated"""
+        self.ensure()
+        if strid in self.new_strids:
+            del self.new_strids[strid]
+            self.modified = True
@@ -6,6 +6,7 @@ from typing import List
 
 from metabot import known_non_enums
 from metabot.utils import to_item_sitelink, id_to_sitelink
+from .EditQueue import EditQueue
 from .Sorter import Sorter, claim_order
 from .Properties import *
 from .consts import Q_KEY, Q_TAG, Q_ENUM_KEY_TYPE, Q_LOCALE_INSTANCE, Q_REL_MEMBER_ROLE
@@ -76,19 +77,19 @@ class UploadItem:
         self.force_contribs = False
         return type in contribs and value in contribs[type]
 
-    def upload_item_updates(self):
+    def upload_item_updates(self, edits: EditQueue, wait=False):
+        """Queues the edit, and if wait is set, waits until it is uploaded"""
         self.print(('Updating ' if not self.is_new else 'Creating ') + \
                    (self.strid or '') + ' ' + self.qitem(self.qid))
         self.print_messages()
 
-        id = self.edit_entity(
+        edits.submit(
+            (self.type, self.strid),
             self.item,
             'Auto-updating from Wiki pages',
-            self.item['id'] if 'id' in self.item else None)
-
-        self.print_messages()
-        self.caches.itemKeysByStrid.get()[(self.type, self.strid)] = id
-        self.print(f'+++ Data item {self.type} {self.strid} ({id}) updated!')
+            self.item['id'] if 'id' in self.item else None,
+            self.item.get('lastrevid'),
+            wait)
 
     def update_i18n(self, type, overwrite_user):
         if type not in self.header:
@@ -1,11 +1,13 @@
 import re
 from typing import List
-from pywikibot import textlib
 from pywikiapi import Site
 
 from .consts import NS_USER, NS_TEMPLATE, LANG_NS, LANG_NS_REVERSE
 from .Cache import CacheJsonl
-from .utils import to_json, batches, parse_members
+from .Fetcher import Fetcher
+from .utils import batches, parse_members
+from .wikitext import extract_templates_and_params
+from .WikiTitles import WikiTitles
 
 map_feature_pages = [
     'Ar:Map Features',
@@ -54,31 +56,34 @@ map_feature_pages = [
 
 
 class WikiFeatures(CacheJsonl):
-    def __init__(self, filename: str, site: Site, pwb_site):
+    def __init__(self, filename: str, site: Site, titles: WikiTitles, fetcher: Fetcher = None):
         super().__init__(filename)
         self.site = site
-        self.pwb_site = pwb_site
+        self.fetcher = fetcher or Fetcher(site)
+        self.titles = titles
 
     def generate(self):
-        titles = set()
-        with open(self.filename, "w+") as file:
-            for batch in batches(self.get_all_relevant_pages(), 50):
-                for page in self.site.query_pages(
-                        prop=['revisions', 'info'],
-                        rvprop='content',
-                        titles=batch,
-                ):
-                    if page.title in titles:
-                        print(f'Duplicate title {page.title}')
+        def fetch(batch):
+            pages = self.fetcher.query_pages(prop=['revisions', 'info'], rvprop='content', titles=batch)
+            return [(page.title, list(self.parse_page(page))) for page in pages]
+
+        def results():
+            titles = set()
+            for index, pages in self.fetcher.map(fetch, batches(sorted(self.get_all_relevant_pages()), 50)):
+                result = []
+                for title, items in pages:
+                    if title in titles:
+                        print(f'Duplicate title {title}')
                         continue
-                    else:
-                        titles.add(page.title)
-                    for res in self.parse_page(page):
-                        print(to_json(res), file=file)
+                    titles.add(title)
+                    result.extend(items)
+                yield index, result
+
+        self.fetcher.write_jsonl(self.filename, results())
 
     def get_new_pages(self, titles):
         result = []
-        for page in self.site.query_pages(
+        for page in self.fetcher.query_pages(
                 prop='revisions',
                 rvprop='content',
                 titles=titles,
@@ -96,11 +101,12 @@ class WikiFeatures(CacheJsonl):
         #                 titles.add(t.title)
         # for res in self.site.query(apprefix='Template:Map Features:')
         templates = set()
-        for res in self.site.query(list='allpages', apprefix='Map Features:', apnamespace=10, aplimit='max'):
+        for res in self.fetcher.query(list='allpages', apprefix='Map Features:', apnamespace=10, aplimit='max'):
             templates.update([v.title for v in res.allpages if '/' not in v.title])
 
-        for batch in batches(templates, 50):
-            for page in self.site.query_pages(prop=['revisions'], rvprop='content', titles=batch):
+        fetch = lambda batch: self.fetcher.query_pages(prop=['revisions'], rvprop='content', titles=batch)
+        for _, pages in sorted(self.fetcher.map(fetch, batches(sorted(templates), 50)), key=lambda v: v[0]):
+            for page in pages:
                 content = page.revisions[0].content
                 tbl_start = [m.end() for m in re.finditer(r'^ *{\|', content, re.MULTILINE)]
                 tbl_end = [m.end() for m in re.finditer(r'^ *\|} *$', content, re.MULTILINE)]
@@ -139,8 +145,7 @@ class WikiFeatures(CacheJsonl):
     def parse_file(self, val):
         param, file = parse_param(val)
         if param:
-            m = textlib._get_regexes(['file'], self.pwb_site)[0].match(file)
-            file = m.group(1) if m else None
+            file = self.titles.file_link_name(file)
         if not file:
             print(f'Unparsable {val}')
         return param, file
@@ -150,7 +155,7 @@ class WikiFeatures(CacheJsonl):
             return
         if 'revisions' in page and len(page.revisions) == 1 and 'content' in page.revisions[0]:
             found = False
-            for (t, p) in textlib.extract_templates_and_params(page.revisions[0].content, True, True):
+            for (t, p) in extract_templates_and_params(page.revisions[0].content):
                 if t.lower() in self.filters:
                     found = True
                     yield {
@@ -3,13 +3,15 @@ from collections import defaultdict
 
 from .consts import LANG_NS
 from .Cache import CacheJsonl
+from .Fetcher import Fetcher
 from .utils import to_json, parse_wiki_page_title, id_to_sitelink, list_to_dict_of_lists, batches
 
 
 class WikiPageTitles(CacheJsonl):
-    def __init__(self, filename: str, site: Site):
+    def __init__(self, filename: str, site: Site, fetcher: Fetcher = None):
         super().__init__(filename)
         self.site = site
+        self.fetcher = fetcher or Fetcher(site)
 
     def generate(self):
         with open(self.filename, "w+") as file:
@@ -18,23 +20,30 @@ class WikiPageTitles(CacheJsonl):
     def get_all_relevant_pages(self):
         titles = defaultdict(list)
         redirect_titles = {}
-        for ns in LANG_NS.values():
-            for redirects in [True, False]:
-                for res in self.site.query(generator='allpages', gapnamespace=ns, gaplimit='max',
-                                           gapfilterredir='redirects' if redirects else 'nonredirects'):
-                    for p in res.pages:
-                        type_from_title, lang, id_from_title, has_suspect_lang = parse_wiki_page_title(ns, p.title)
-                        if not id_from_title:
-                            if has_suspect_lang:
-                                print(f'Possible language: {p.title}')
-                            continue
-                        good_title = f'{type_from_title}:{id_from_title}'
-                        if lang != 'en':
-                            good_title = (lang if ns == 0 else lang.upper()) + ':' + good_title
-                        good_title = good_title[0].upper() + good_title[1:]
-                        if not redirects and p.title != good_title:
-                            print(f'Suspicious page, might need to be renamed {p.title} -> {good_title}')
-                        titles[id_to_sitelink(type_from_title, id_from_title)].append((lang, p.title, redirects, good_title))
+
+        def list_pages(args):
+            ns, redirects = args
+            return self.fetcher.query(generator='allpages', gapnamespace=ns, gaplimit='max',
+                                      gapfilterredir='redirects' if redirects else 'nonredirects')
+
+        # Results are processed in the same order as they were requested, to keep the output stable
+        namespaces = [(ns, redirects) for ns in LANG_NS.values() for redirects in [True, False]]
+        for index, results in sorted(self.fetcher.map(list_pages, namespaces), key=lambda v: v[0]):
+            ns, redirects = namespaces[index]
+            for res in results:
+                for p in res.pages:
+                    type_from_title, lang, id_from_title, has_suspect_lang = parse_wiki_page_title(ns, p.title)
+                    if not id_from_title:
+                        if has_suspect_lang:
+                            print(f'Possible language: {p.title}')
+                        continue
+                    good_title = f'{type_from_title}:{id_from_title}'
+                    if lang != 'en':
+                        good_title = (lang if ns == 0 else lang.upper()) + ':' + good_title
+                    good_title = good_title[0].upper() + good_title[1:]
+                    if not redirects and p.title != good_title:
+                        print(f'Suspicious page, might need to be renamed {p.title} -> {good_title}')
+                    titles[id_to_sitelink(type_from_title, id_from_title)].append((lang, p.title, redirects, good_title))
 
         result = {}
         for k, itms in titles.items():
@@ -64,8 +73,11 @@ class WikiPageTitles(CacheJsonl):
             if len(res) > 0:
                 result[k] = res
 
-        for batch in batches(redirect_titles.keys(), 100):
-            for res in self.site.query(titles=batch, redirects=True):
+        redirect_batches = list(batches(redirect_titles.keys(), 100))
+        resolve = lambda batch: self.fetcher.query(titles=batch, redirects=True)
+        for index, results in sorted(self.fetcher.map(resolve, redirect_batches), key=lambda v: v[0]):
+            batch = redirect_batches[index]
+            for res in results:
                 pages = {v.title: 'missing' in v for v in res.pages}
                 redirs = {v['from']: (v.to, v.tofragment if 'tofragment' in v else None, v.to in pages) for v in res.redirects}
                 redir_hop = True
@@ -1,17 +1,22 @@
+import json
+import os
+from collections import defaultdict
 from typing import List
-from pywikibot import textlib
 from pywikiapi import Site
 
 from .consts import NS_USER, NS_TEMPLATE, LANG_NS, LANG_NS_REVERSE
 from .Cache import CacheJsonl
+from .Fetcher import Fetcher
 from .utils import to_json, parse_wiki_page_title, batches
+from .wikitext import extract_templates_and_params
 
 
 class WikiPagesWithTemplate(CacheJsonl):
     def __init__(self, filename: str, site: Site, template: List[str],
-                 template_filters: List[str]):
+                 template_filters: List[str], fetcher: Fetcher = None):
         super().__init__(filename)
         self.site = site
+        self.fetcher = fetcher or Fetcher(site)
         self.template = set(template)
         self.template.update(['Template:' + flt for flt in template_filters])
         self.filters = set(template_filters)
@@ -23,25 +28,86 @@ class WikiPagesWithTemplate(CacheJsonl):
         self.filters = set([v.lower() for v in self.filters])
 
     def generate(self):
-        titles = set()
-        with open(self.filename, "w+") as file:
-            for batch in batches(self.get_all_relevant_pages(), 50):
-                for page in self.site.query_pages(
-                        prop=['revisions', 'info'],
-                        rvprop='content',
-                        titles=batch,
-                ):
-                    if page.title in titles:
-                        print(f'Duplicate title {page.title}')
-                        continue
-                    else:
-                        titles.add(page.title)
-                    for res in self.parse_page(page):
-                        print(to_json(res), file=file)
+        revisions = {}
+        self.fetcher.write_jsonl(self.filename, self.fetch_pages(sorted(self.get_all_relevant_pages()), revisions))
+        self.save_revisions(revisions)
+
+    def sync(self):
+        """
+        Update the cache by comparing the latest revision of every relevant page with the one stored
+        in the <filename>.revs file, and only downloading and parsing the pages that have changed.
+        """
+        old_revisions = self.load_revisions()
+        if old_revisions is None or not os.path.isfile(self.filename):
+            self.regenerate()
+            return
+
+        revisions = {}
+        list_revisions = lambda batch: self.fetcher.query_pages(prop='info', titles=batch)
+        for _, pages in self.fetcher.map(list_revisions, batches(sorted(self.get_all_relevant_pages()), 50)):
+            for page in pages:
+                if 'missing' not in page and 'invalid' not in page:
+                    revisions[page.title] = page.lastrevid
+        changed = sorted(t for t, rev in revisions.items() if old_revisions.get(t) != rev)
+        removed = set(old_revisions) - set(revisions)
+        if not changed and not removed:
+            print(f'No changes in {len(revisions)} pages')
+            return
+
+        replaced = removed.union(changed)
+        new_revisions = {t: r for t, r in old_revisions.items() if t not in replaced}
+        lines_by_title = defaultdict(list)
+        for _, items in self.fetch_pages(changed, new_revisions):
+            for item in items:
+                lines_by_title[item['title']].append(to_json(item) + '\n')
+        with open(self.filename, "r") as file:
+            for line in file:
+                if line.strip():
+                    title = json.loads(line)['title']
+                    if title not in replaced:
+                        lines_by_title[title].append(line if line.endswith('\n') else line + '\n')
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, "w") as file:
+            for title in sorted(lines_by_title):
+                file.writelines(lines_by_title[title])
+        os.replace(tmp_filename, self.filename)
+        self.save_revisions(new_revisions)
+        self._data = None
+        print(f'Updated {len(changed)} changed pages, removed {len(removed)} out of {len(revisions)} pages')
+
+    def fetch_pages(self, titles, revisions):
+        """Yields (index, parsed items) for each batch of titles, and records the revision of every page"""
+        def fetch(batch):
+            pages = self.fetcher.query_pages(prop=['revisions', 'info'], rvprop='content', titles=batch)
+            return [(page.title, page.get('lastrevid'), list(self.parse_page(page))) for page in pages]
+
+        for index, pages in self.fetcher.map(fetch, batches(titles, 50)):
+            result = []
+            for title, revision, items in pages:
+                if title in revisions:
+                    print(f'Duplicate title {title}')
+                    continue
+                revisions[title] = revision
+                result.extend(items)
+            yield index, result
+
+    def load_revisions(self):
+        try:
+            with open(self.filename + '.revs', "r") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return None
+
+    def save_revisions(self, revisions):
+        tmp_filename = self.filename + '.revs.tmp'
+        with open(tmp_filename, "w") as file:
+            json.dump(revisions, file, ensure_ascii=False)
+        os.replace(tmp_filename, self.filename + '.revs')
 
     def get_new_pages(self, titles):
         result = []
-        for page in self.site.query_pages(
+        for page in self.fetcher.query_pages(
                 prop='revisions',
                 rvprop='content',
                 titles=titles,
@@ -52,8 +118,9 @@ class WikiPagesWithTemplate(CacheJsonl):
 
     def get_all_relevant_pages(self):
         titles = set()
-        for ns in LANG_NS.values():
-            for res in self.site.query(list='allpages', apnamespace=ns, aplimit='max'):
+        list_pages = lambda ns: (ns, self.fetcher.query(list='allpages', apnamespace=ns, aplimit='max'))
+        for _, (ns, results) in self.fetcher.map(list_pages, LANG_NS.values()):
+            for res in results:
                 for p in res.allpages:
                     type_from_title, lang, id_from_title, has_suspect_lang = parse_wiki_page_title(ns, p.title)
                     if not id_from_title:
@@ -61,7 +128,7 @@ class WikiPagesWithTemplate(CacheJsonl):
                             print(f'Possible language: {p.title}')
                         continue
                     titles.add(p.title)
-        for page in self.site.query_pages(
+        for page in self.fetcher.query_pages(
                 prop='transcludedin',
                 tilimit='max',
                 titles=self.template):
@@ -76,7 +143,7 @@ class WikiPagesWithTemplate(CacheJsonl):
             return
         if 'revisions' in page and len(page.revisions) == 1 and 'content' in page.revisions[0]:
             found = False
-            for (t, p) in textlib.extract_templates_and_params(page.revisions[0].content, True, True):
+            for (t, p) in extract_templates_and_params(page.revisions[0].content):
                 if t.lower() in self.filters:
                     found = True
                     yield {
@@ -1,16 +1,18 @@
 from collections import defaultdict
 
 from pywikiapi import Site
-from pywikibot import textlib
 
 from metabot.Cache import Cache
+from metabot.Fetcher import Fetcher
+from metabot.wikitext import extract_templates_and_params
 
 
 class WikiTagTemplateUsage(Cache):
 
-    def __init__(self, filename: str, site: Site):
+    def __init__(self, filename: str, site: Site, fetcher: Fetcher = None):
         super().__init__(filename)
         self.site = site
+        self.fetcher = fetcher or Fetcher(site)
 
     def load(self):
         data = defaultdict(lambda: defaultdict(int))
@@ -25,7 +27,7 @@ class WikiTagTemplateUsage(Cache):
 
     def generate(self):
         with open(self.filename, "w+") as file:
-            for resp in self.site.query(
+            for resp in self.fetcher.query(
                     prop='revisions',
                     rvprop='content',
                     redirects='no',
@@ -39,7 +41,7 @@ class WikiTagTemplateUsage(Cache):
                 for page in resp['pages']:
                     if 'revisions' in page and len(page['revisions']) == 1 and 'content' in page['revisions'][0]:
                         content = page['revisions'][0]['content']
-                        for template in textlib.extract_templates_and_params(content, True, True):
+                        for template in extract_templates_and_params(content):
                             for key, value in parse_tag(template, page['title']):
                                 result[(key, value)] += 1
                 for k, count in result.items():
@@ -0,0 +1,172 @@
+import html
+import json
+import re
+import unicodedata
+from functools import lru_cache
+from urllib.parse import quote, unquote
+
+from pywikiapi import Site
+
+from .Cache import Cache
+from .Fetcher import Fetcher
+from .consts import NS_FILE
+from .utils import to_json
+
+re_title_spaces = re.compile('[_ \xa0 ᠎ -     　]+')
+re_illegal_title = re.compile(
+    r'[\x00-\x1f\x23\x3c\x3e\x5b\x5d\x7b\x7c\x7d\x7f]'
+    r'|%[0-9A-Fa-f]{2}'
+    r'|&[A-Za-z0-9\x80-\xff]+;'
+    r'|&#[0-9]+;'
+    r'|&#x[0-9A-Fa-f]+;')
+
+
+class InvalidTitle(ValueError):
+    pass
+
+
+class WikiTitles(Cache):
+    """
+    Normalizes page titles with the wiki's namespace, case and character rules, the same way as
+    pywikibot's Page does, but without creating pywikibot objects. The wiki's namespaces and URLs are stored
+    in the cache file. Results are memoized, because the same few titles appear on thousands of pages.
+    """
+
+    def __init__(self, filename: str, site: Site, fetcher: Fetcher = None, cache_size=10000):
+        super().__init__(filename)
+        self.site = site
+        self.fetcher = fetcher or Fetcher(site)
+        self.parse = lru_cache(maxsize=cache_size)(self._parse)
+        self.full_url = lru_cache(maxsize=cache_size)(self._full_url)
+        self.file_name = lru_cache(maxsize=cache_size)(self._file_name)
+        self.file_link_name = lru_cache(maxsize=cache_size)(self._file_link_name)
+
+    def generate(self):
+        resp = self.fetcher('query', meta='siteinfo',
+                            siprop=['general', 'namespaces', 'namespacealiases', 'interwikimap'])
+        with open(self.filename, "w") as file:
+            file.write(to_json(resp.query, pretty=True))
+
+    def load(self):
+        with open(self.filename, "r") as file:
+            info = json.load(file)
+        namespaces = {v['id']: v for v in info['namespaces'].values()}
+        names = {}
+        for ns in namespaces.values():
+            for name in [ns['name'], ns.get('canonical', '')] + \
+                        [v['alias'] for v in info['namespacealiases'] if v['id'] == ns['id']]:
+                if name:
+                    names.setdefault(ns['id'], []).append(name)
+        server = info['general']['server']
+        if server.startswith('//'):
+            server = 'https:' + server
+        # Same as pywikibot's file link regex, namespace names are case-sensitive
+        file_link = re.compile(r'\[\[\s*(?:' + '|'.join(re.escape(v) for v in names[NS_FILE]) +
+                               r')\s*:([^]|]*+)(?:\|(?:(?>\[\[.*?\]\])?[^\[\]]*+|\[[^]]*+\])*?)??\]\]')
+        self.parse.cache_clear()
+        self.full_url.cache_clear()
+        self.file_name.cache_clear()
+        self.file_link_name.cache_clear()
+        return {
+            'namespaces': namespaces,
+            'ns_by_name': {v.lower(): ns for ns, lst in names.items() for v in lst},
+            'interwiki': {v['prefix'].lower(): v['url'] for v in info.get('interwikimap', [])},
+            'url': server + info['general']['articlepath'],
+            'file_link': file_link,
+        }
+
+    def _parse(self, text: str, default_ns=0):
+        """
+        Parses a link target like "Key:highway#Values", and returns (namespace id, normalized title
+        without the namespace, section or None, interwiki prefix or None). Raises InvalidTitle.
+        """
+        info = self.get()
+        try:
+            text = unquote(text.split('|', 1)[0], errors='strict')
+        except UnicodeDecodeError:
+            raise InvalidTitle(f'{text!r} is not a valid URL-encoded title')
+        t = unicodedata.normalize('NFC', html.unescape(text))
+        if '�' in t:
+            raise InvalidTitle(f'{t!r} contains an illegal character')
+        t = re_title_spaces.sub(' ', t).strip().replace('‎', '').replace('‏', '')
+
+        ns = default_ns
+        ns_prefix = False
+        interwiki = None
+        pos = 1 if t.startswith(':') else 0
+        colon = t.find(':', pos)
+        while colon >= 0:
+            prefix = t[pos:colon].strip().lower()
+            colon += 1
+            while colon < len(t) and t[colon] == ' ':
+                colon += 1
+            if interwiki is None and prefix in info['ns_by_name']:
+                if colon >= len(t):
+                    raise InvalidTitle(f'{text!r} has no title')
+                ns = info['ns_by_name'][prefix]
+                ns_prefix = True
+                pos = colon
+                break
+            if interwiki is not None or prefix not in info['interwiki']:
+                break
+            # The rest of the title belongs to the other wiki, its namespaces are unknown here
+            interwiki = prefix
+            pos = colon
+            break
+        t = t[pos:]
+
+        section = None
+        if '#' in t:
+            t, section = t.split('#', 1)
+            t, section = t.rstrip(), section.lstrip()
+
+        if ns_prefix:
+            if not t:
+                raise InvalidTitle(f'{text!r} has no title')
+            if ':' in t and ns >= 0:
+                other_ns = info['namespaces'].get(ns - 1 if ns % 2 else ns + 1)
+                if other_ns and other_ns['id'] == 0 and t[:t.index(':')].strip().lower() in info['ns_by_name']:
+                    raise InvalidTitle(f'The (non-)talk page of {text!r} is a valid title in another namespace')
+        m = re_illegal_title.search(t)
+        if m:
+            raise InvalidTitle(f'{t!r} contains illegal char(s) {m.group(0)!r}')
+        if '.' in t and (t in ('.', '..') or t.startswith(('./', '../')) or '/./' in t or '/../' in t or
+                         t.endswith(('/.', '/..'))):
+            raise InvalidTitle(f'{text!r} contains . / combinations')
+        if '~~~' in t:
+            raise InvalidTitle(f'{text!r} contains ~~~')
+        if ns != -1 and len(t) > 255:
+            raise InvalidTitle(f'{t!r} is over 255 bytes')
+        if not t.strip(' ') and interwiki is None:
+            raise InvalidTitle(f'{text!r} does not contain a page title')
+
+        if interwiki is None and info['namespaces'][ns]['case'] == 'first-letter':
+            first = t[:1].upper()
+            if len(first) == 1:
+                t = first + t[1:]
+        return ns, t, section, interwiki
+
+    def _full_url(self, text: str) -> str:
+        """Same as pywikibot.Page(site, text).full_url()"""
+        info = self.get()
+        ns, title, section, interwiki = self.parse(text)
+        if ns != 0:
+            title = info['namespaces'][ns]['name'] + ':' + title
+        if section:
+            title += '#' + section
+        title = quote(title.replace(' ', '_'), safe='')
+        if interwiki:
+            return info['interwiki'][interwiki].replace('$1', title)
+        return info['url'].replace('$1', title)
+
+    def _file_name(self, text: str) -> str:
+        """Same as pywikibot.FilePage(site, text).titleWithoutNamespace()"""
+        ns, title, section, interwiki = self.parse(text, NS_FILE)
+        if ns != NS_FILE or interwiki:
+            raise InvalidTitle(f'{text!r} is not in the file namespace')
+        return title + '#' + section if section else title
+
+    def _file_link_name(self, text: str):
+        """Returns the file name of a [[File:...]] link at the start of the text, or None"""
+        m = self.get()['file_link'].match(text)
+        return m.group(1) if m else None
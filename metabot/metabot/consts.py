@@ -84,6 +84,7 @@ reLanguagesClause = '(?:' + '|'.join([re.escape(l) for l in languages]) + ')'
 
 NS_USER = 2
 NS_USER_TALK = 3
+NS_FILE = 6
 NS_TEMPLATE = 10
 NS_TEMPLATE_TALK = 11
 known_non_enums = {
@@ -7,11 +7,11 @@ import requests
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 from collections import defaultdict
-from pywikibot import textlib
 
 from pywikiapi import Site, AttrDict
 
 from .Properties import P_INSTANCE_OF, P_KEY_ID, P_TAG_ID, P_SUBCLASS_OF, P_REL_ID, P_ROLE_ID, P_LANG_CODE
+from .wikitext import extract_templates_and_params
 from .consts import reLanguagesClause, Q_KEY, Q_TAG, LANG_NS, ignoreLangSuspects, Q_RELATION, Q_REL_MEMBER_ROLE, \
     Q_LOCALE_INSTANCE
 
@@ -24,7 +24,8 @@ def to_json(obj, pretty=False):
 
 
 def get_osm_site() -> Site:
-    retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
+    # 429 and 503 are retried by the Fetcher, which pauses all of its workers for the requested time
+    retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 504])
     session = requests.Session()
     session.mount('https://', HTTPAdapter(max_retries=retries))
 
@@ -230,7 +231,7 @@ def to_item_sitelink(sitelink):
 
 def parse_members(line, printer, info):
     vals = {}
-    for vt in textlib.extract_templates_and_params(line, True, True):
+    for vt in extract_templates_and_params(line):
         name, params = vt
         m = re_lang_template.match(name)
         if m:
@@ -0,0 +1,293 @@
+"""
+Fast extraction of templates and their parameters from wikitext, without importing pywikibot.
+
+extract_templates_and_params(text) returns the same result as pywikibot's
+textlib.extract_templates_and_params(text, True, True) with the wikitextparser backend. It follows the
+MediaWiki preprocessor: the innermost templates, parser functions, template parameters and links are
+found first and masked in an ASCII "shadow" copy of the text, so that the | and = characters they
+contain are not mistaken for separators of the templates around them. Only the template spans
+and their separators are computed, no parse tree is built. Results can only differ for broken markup
+where a [[link]] and a {{{parameter}}} overlap.
+
+Run this module to compare the results with pywikibot on the full content of all description pages.
+The pages are downloaded into a JSON Lines file first (by default _cache/wiki_raw_pages.json), and the
+same revisions are compared again on the following runs, until the file is deleted.
+"""
+import re
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+# Same as pywikibot's removeDisabledParts() defaults, comments are removed first
+disabled_tags = ['includeonly', 'nowiki', 'pre', 'syntaxhighlight', 'source']
+re_comment = re.compile(r'<!--[\s\S]*?-->')
+re_disabled_tags = [re.compile(r'<{0}(?:>|\s+[^>]*(?<!/)>)[\s\S]*?</{0}\s*>'.format(
+    ''.join(f'[{c.upper()}{c}]' for c in tag))) for tag in disabled_tags]
+
+# Tag extensions whose content is still parsed for templates, and the ones whose content is opaque
+parsable_tags = [
+    'categorytree', 'gallery', 'imagemap', 'includeonly', 'indicator', 'inputbox', 'noinclude', 'onlyinclude',
+    'poem', 'ref', 'references', 'section']
+unparsable_tags = [
+    'ce', 'charinsert', 'chem', 'graph', 'hiero', 'languages', 'mapframe', 'maplink', 'math', 'nowiki',
+    'pagelist', 'pagequality', 'pages', 'pre', 'score', 'source', 'syntaxhighlight', 'templatedata',
+    'templatestyles', 'timeline']
+
+# Magic words that make {{NAME}} and {{NAME:...}} a parser function rather than a template
+parser_functions = [
+    'ARTICLEPAGENAME', 'ARTICLEPAGENAMEE', 'ARTICLESPACE', 'ARTICLESPACEE', 'BASEPAGENAME', 'BASEPAGENAMEE',
+    'CASCADINGSOURCES', 'CONTENTLANG', 'CONTENTLANGUAGE', 'CURRENTDAY', 'CURRENTDAY2', 'CURRENTDAYNAME',
+    'CURRENTDOW', 'CURRENTHOUR', 'CURRENTMONTH', 'CURRENTMONTH1', 'CURRENTMONTHABBREV', 'CURRENTMONTHNAME',
+    'CURRENTMONTHNAMEGEN', 'CURRENTTIME', 'CURRENTTIMESTAMP', 'CURRENTVERSION', 'CURRENTWEEK', 'CURRENTYEAR',
+    'DEFAULTCATEGORYSORT', 'DEFAULTSORT', 'DEFAULTSORTKEY', 'DIRECTIONMARK', 'DIRMARK', 'DISPLAYTITLE',
+    'FULLPAGENAME', 'FULLPAGENAMEE', 'LOCALDAY', 'LOCALDAY2', 'LOCALDAYNAME', 'LOCALDOW', 'LOCALHOUR',
+    'LOCALMONTH', 'LOCALMONTH1', 'LOCALMONTHABBREV', 'LOCALMONTHNAME', 'LOCALMONTHNAMEGEN', 'LOCALTIME',
+    'LOCALTIMESTAMP', 'LOCALWEEK', 'LOCALYEAR', 'NAMESPACE', 'NAMESPACEE', 'NAMESPACENUMBER', 'NUMBERINGROUP',
+    'NUMBEROFACTIVEUSERS', 'NUMBEROFADMINS', 'NUMBEROFARTICLES', 'NUMBEROFEDITS', 'NUMBEROFFILES',
+    'NUMBEROFPAGES', 'NUMBEROFUSERS', 'NUMBEROFVIEWS', 'NUMINGROUP', 'PAGEID', 'PAGELANGUAGE', 'PAGENAME',
+    'PAGENAMEE', 'PAGESINCAT', 'PAGESINCATEGORY', 'PAGESINNAMESPACE', 'PAGESINNS', 'PAGESIZE',
+    'PROTECTIONEXPIRY', 'PROTECTIONLEVEL', 'REVISIONDAY', 'REVISIONDAY2', 'REVISIONID', 'REVISIONMONTH',
+    'REVISIONMONTH1', 'REVISIONTIMESTAMP', 'REVISIONUSER', 'REVISIONYEAR', 'ROOTPAGENAME', 'ROOTPAGENAMEE',
+    'SCRIPTPATH', 'SERVER', 'SERVERNAME', 'SITENAME', 'STYLEPATH', 'SUBJECTPAGENAME', 'SUBJECTPAGENAMEE',
+    'SUBJECTSPACE', 'SUBJECTSPACEE', 'SUBPAGENAME', 'SUBPAGENAMEE', 'TALKPAGENAME', 'TALKPAGENAMEE', 'TALKSPACE',
+    'TALKSPACEE', 'anchorencode', 'canonicalurl', 'filepath', 'formatnum', 'fullurl', 'gender', 'grammar', 'int',
+    'lc', 'lcfirst', 'localurl', 'msg', 'msgnw', 'ns', 'nse', 'padleft', 'padright', 'plural', 'raw', 'safesubst',
+    'subst', 'uc', 'ucfirst', 'urlencode']
+
+# A [[...]] that starts with one of these is an external link in brackets, not a wikilink
+external_link_schemes = [
+    'bitcoin:', 'ftp://', 'ftps://', 'geo:', 'git://', 'gopher://', 'http://', 'https://', 'irc://', 'ircs://',
+    'magnet:', 'mailto:', 'mms://', 'news:', 'nntp://', 'redis://', 'sftp://', 'sip:', 'sips:', 'sms:', 'ssh://',
+    'svn://', 'tel:', 'telnet://', 'urn:', 'worldwind://', 'xmpp:']
+
+
+def _alternatives(names):
+    # Longest names first, so that e.g. PAGENAMEE is not matched as PAGENAME
+    return b'(?:' + b'|'.join(re.escape(v.encode()) for v in sorted(names, key=len, reverse=True)) + b')'
+
+
+def _tag_content(group):
+    return (rb'(?=[\s>/])[^>]*+(?>(?<=/)>|>(?P<' + group + rb'_content>.*?)</(?P=' + group + rb')\s*+>)')
+
+
+re_tag_extensions = re.compile(
+    rb'<(?>(?P<comment>!--.*?(?>-->|\Z))'
+    rb'|(?P<unparsable>(?P<u>' + _alternatives(unparsable_tags) + rb')' + _tag_content(b'u') + rb')'
+    rb'|(?P<parsable>(?P<p>' + _alternatives(parsable_tags) + rb')' + _tag_content(b'p') + rb'))',
+    re.DOTALL | re.IGNORECASE)
+
+title_chars = rb'[^|{}\[\]\x02\x03<>\r\n]*+'
+template_args = rb'(?:\|(?>[^{}]++|\{(?!\{)|\}(?!\}))*+)?+'
+
+# Template parameters {{{...}}} and wikilinks
+re_links_and_params = re.compile(
+    rb'(?P<link>\[\['
+    rb'(?![ ]*+\b' + _alternatives(external_link_schemes) + rb'[^ \t\r\n"<>\[\]]++)' + title_chars +
+    rb'(?:\|\[?\]?[^\[\]|]*+(?:\[[^\[\]|]*+\](?!\]\]\])[^\[\]|]*+)?)*'
+    rb'\]\])'
+    rb'|(?P<param>\{\{\{(?>[^{}]++|(?<!\})\}(?!\})|(?<!\{)\{(?!\{))++\}\}\})')
+
+re_templates = re.compile(
+    rb'\{\{(?>'
+    rb'[\s\x00]*+(?>\#[^{}\s:|]++|' + _alternatives(parser_functions) + rb')'
+    rb'(?::(?>[^{}]*+|\}(?!\})|\{(?!\{))*+)?+\}\}(?P<function>)'
+    rb'|[\s\x00_]*+' + template_args + rb'\}\}(?P<invalid>)'
+    rb'|[\s\x00]*+' + title_chars + rb'[\s\x00]*+' + template_args + rb'\}\})')
+
+re_argument = re.compile(
+    rb'\|(?P<name>(?:[^=]*+(?:(?<=[\r\n\x0b\x0c\x85])\x00*+(?P<equals>={1,6})[^\r\n]+?(?P=equals)'
+    rb'[ \t\x00]*+(?:\r\n|[\n\x0b\x0c\r\x85]))?+)*+)(?:\Z|(?P<eq>=).*+)',
+    re.DOTALL)
+
+# Wikilinks and parsable tag extensions do not contain separators of the templates around them
+markup_mask = bytes.maketrans(b"=|[]'{}", b'\x01_\x02\x03___')
+
+
+def remove_disabled_parts(text: str) -> str:
+    """Remove comments, and nowiki, pre, includeonly and syntaxhighlight tags with their content"""
+    if '<' not in text:
+        return text
+    text = re_comment.sub('', text)
+    for regex in re_disabled_tags:
+        text = regex.sub('', text)
+    return text
+
+
+def extract_templates_and_params(text: str, remove_disabled: bool = True,
+                                 strip: bool = True) -> List[Tuple[str, OrderedDict]]:
+    """
+    Return a (name, params) tuple for each template in the text, including the nested ones, in the order
+    of their start. Positional parameters are numbered from '1', and only the last value is kept
+    for a repeated parameter. With strip, parameter names and the values of the named parameters are stripped.
+    """
+    if remove_disabled:
+        text = remove_disabled_parts(text)
+    if '{{' not in text:
+        return []
+    # Non-ASCII characters become '?', so positions in the shadow are the same as in the text
+    shadow = bytearray(text, 'ascii', 'replace')
+    templates = []
+    _find_tag_extensions(shadow, 0, len(shadow), templates)
+    _find_templates(shadow, 0, len(shadow), templates)
+    templates.sort(key=lambda v: v[0])
+    return [_parse_template(text, start, template_shadow, strip) for start, template_shadow in templates]
+
+
+def _find_tag_extensions(shadow, start, end, templates):
+    for match in list(re_tag_extensions.finditer(shadow, start, end)):
+        s, e = match.span()
+        if match['comment'] is not None:
+            shadow[s:e] = b'\x00' * (e - s)
+        elif match['unparsable'] is not None:
+            shadow[s:e] = b'_' * (e - s)
+        else:
+            cs, ce = match.span('p_content')
+            if cs != -1:
+                _find_tag_extensions(shadow, cs, ce, templates)
+            _find_templates(shadow, s, e, templates)
+            shadow[s:e] = shadow[s:e].translate(markup_mask)
+
+
+def _find_templates(shadow, start, end, templates):
+    """Finds and masks the innermost constructs until no more templates are found, adds (start, shadow) of each"""
+    while True:
+        # Found links and parameters are masked, so any [[ or {{{ left is a candidate that did not match yet
+        while shadow.find(b'[[', start, end) != -1 or shadow.find(b'{{{', start, end) != -1:
+            matches = _find_links_and_params(shadow, start, end)
+            if not matches:
+                break
+            for match in matches:
+                s, e = match.span()
+                if match['link'] is not None:
+                    _find_templates(shadow, s + 2, e - 2, templates)
+                    shadow[s:e] = shadow[s:e].translate(markup_mask)
+                else:
+                    _find_templates(shadow, s + 3, e - 3, templates)
+                    shadow[s:e] = b'_' * (e - s)
+        if shadow.find(b'{{', start, end) == -1:
+            break
+        matches = list(re_templates.finditer(shadow, start, end))
+        if not matches:
+            break
+        for match in matches:
+            s, e = match.span()
+            if match['invalid'] is not None:
+                shadow[s:e] = b'_' * (e - s)
+                shadow[s + 1] = ord('{')
+                continue
+            if match['function'] is None:
+                templates.append((s, bytes(shadow[s:e])))
+            shadow[s:e] = b'X' * (e - s)
+
+
+def _find_links_and_params(shadow, start, end):
+    matches = []
+    pos = start
+    while True:
+        match = re_links_and_params.search(shadow, pos, end)
+        if match is None:
+            return matches
+        s = match.start()
+        if match['link'] is not None:
+            # A wikilink cannot be preceded by an odd number of [
+            brackets = s
+            while brackets > 0 and shadow[brackets - 1] == 91:  # '['
+                brackets -= 1
+            if (s - brackets) % 2:
+                pos = s + 1
+                continue
+        matches.append(match)
+        pos = match.end()
+
+
+def _parse_template(text, start, shadow, strip):
+    separators = []
+    pos = shadow.find(b'|', 2, len(shadow) - 2)
+    while pos != -1:
+        separators.append(pos)
+        pos = shadow.find(b'|', pos + 1, len(shadow) - 2)
+    separators.append(len(shadow) - 2)
+    name = text[start + 2:start + separators[0]]
+    params = OrderedDict()
+    position = 1
+    for arg_start, arg_end in zip(separators, separators[1:]):
+        arg = shadow[arg_start:arg_end]
+        match = re_argument.fullmatch(arg) if b'=' in arg else None
+        if match and match['eq'] is not None:
+            key = text[start + arg_start + 1:start + arg_start + match.end('name')]
+            value = text[start + arg_start + match.end('eq'):start + arg_end]
+            if strip:
+                key = key.strip()
+                value = value.strip()
+        else:
+            key = str(position)
+            value = text[start + arg_start + 1:start + arg_end]
+        if match is None:
+            position += 1
+        params[key] = value
+    return name.strip(), params
+
+
+def compare_with_pywikibot(pages: Dict[str, str]) -> List[str]:
+    """Compare the results and the speed with pywikibot's textlib, return the titles of pages that differ"""
+    from pywikibot import textlib
+    expected = []
+    start = time.perf_counter()
+    for text in pages.values():
+        expected.append(textlib.extract_templates_and_params(text, True, True))
+    pywikibot_time = time.perf_counter() - start
+    actual = []
+    start = time.perf_counter()
+    for text in pages.values():
+        actual.append(extract_templates_and_params(text))
+    own_time = time.perf_counter() - start
+
+    differences = []
+    for title, exp, act in zip(pages, expected, actual):
+        exp = [(t, list(p.items())) for t, p in exp]
+        act = [(t, list(p.items())) for t, p in act]
+        if exp != act:
+            print(f'#### {title}')
+            for template in exp:
+                if template not in act:
+                    print(f'  pywikibot: {template}')
+            for template in act:
+                if template not in exp:
+                    print(f'  wikitext:  {template}')
+            differences.append(title)
+    print(f'{len(differences)} of {len(pages)} pages differ, '
+          f'pywikibot took {pywikibot_time:.2f}s, wikitext took {own_time:.2f}s')
+    return differences
+
+
+def download_pages(filename: str):
+    """Save the title and the content of the latest revision of all description pages as JSON Lines"""
+    from .CacheInstances import Caches
+    from .utils import get_osm_site, batches
+
+    caches = Caches(get_osm_site(), use_bot_limits=False)
+    fetcher = caches.fetcher
+
+    def fetch(batch):
+        pages = fetcher.query_pages(prop='revisions', rvprop='content', titles=batch)
+        return [{'title': page.title, 'content': page.revisions[0].content} for page in pages
+                if 'revisions' in page and 'content' in page.revisions[0]]
+
+    titles = sorted(caches.description.get_all_relevant_pages())
+    fetcher.write_jsonl(filename, fetcher.map(fetch, batches(titles, 50)))
+
+
+if __name__ == '__main__':
+    import json
+    import os
+    filename = sys.argv[1] if len(sys.argv) > 1 else '_cache/wiki_raw_pages.json'
+    if not os.path.isfile(filename):
+        download_pages(filename)
+    pages = OrderedDict()
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.strip():
+                page = json.loads(line)
+                pages[page['title']] = page['content']
+    sys.exit(1 if compare_with_pywikibot(pages) else 0)
@@ -0,0 +1,54 @@
+import pytest
+import requests
+import responses
+from pywikiapi import ApiError, Site
+
+from metabot.Fetcher import Fetcher
+
+
+@pytest.mark.parametrize('err, retry_after, expected', [
+    # Site.request() raises these for HTTP errors
+    (ApiError('Call failed', {'status_code': 503, 'text_body': 'Service Unavailable'}), '30', 30),
+    (ApiError('Call failed', {'status_code': 429, 'json_body': {}}), None, 0),
+    (ApiError('Call failed', {'status_code': 429, 'json_body': {}}), 'soon', 0),
+    (ApiError('Call failed', {'status_code': 404, 'text_body': 'Not Found'}), '30', None),
+    # Site.__call__() raises these for API errors, including maxlag when its own retries are disabled
+    (ApiError('Server API Error', {'code': 'maxlag', 'info': 'Waiting for db: 6 seconds lagged', 'lag': 6}),
+     '5', 5),
+    (ApiError('Server API Error', {'code': 'maxlag', 'lag': 6}), None, 5),
+    (ApiError('Server API Error', {'code': 'ratelimited'}), '60', 60),
+    (ApiError('Server API Error', {'code': 'badtoken'}), '5', None),
+    (requests.ConnectionError(), None, 0),
+    (requests.ReadTimeout(), None, 0),
+    (requests.exceptions.RetryError(), None, 0),
+    (ValueError('maxlag'), None, None),
+])
+def test_retry_delay(err, retry_after, expected):
+    assert Fetcher.get_retry_delay(err, retry_after) == expected
+
+
+@pytest.mark.parametrize('err, expected', [
+    (requests.ReadTimeout(), None),
+    (requests.ConnectionError(), None),
+    (requests.ConnectTimeout(), 0),
+    (ApiError('Server API Error', {'code': 'maxlag'}), 5),
+])
+def test_retry_delay_not_idempotent(err, expected):
+    assert Fetcher.get_retry_delay(err, idempotent=False) == expected
+
+
+@responses.activate
+def test_server_errors_pause_all_workers(monkeypatch):
+    url = 'https://wiki.example.org/w/api.php'
+    responses.get(url, status=503, body='Service Unavailable', headers={'Retry-After': '7'})
+    responses.get(url, json={'error': {'code': 'maxlag', 'info': 'lagged', 'lag': 6}}, headers={'Retry-After': '3'})
+    responses.get(url, json={'batchcomplete': True, 'query': {'general': {}}})
+    sleeps = []
+    monkeypatch.setattr('metabot.Fetcher.time.sleep', sleeps.append)
+    monkeypatch.setattr('metabot.Fetcher.time.monotonic', lambda: sum(sleeps))
+
+    fetcher = Fetcher(Site(url))
+    assert fetcher('query', meta='siteinfo')['query'] == {'general': {}}
+    assert len(responses.calls) == 3
+    # The maxlag Retry-After of 3 seconds is less than the growing backoff
+    assert sleeps == [7, 4]
@@ -0,0 +1,32 @@
+import pytest
+
+from metabot.wikitext import extract_templates_and_params
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('no templates', []),
+    ('{{a}}', [('a', [])]),
+    ('{{a\n|b = c\n|d = e\n}}', [('a', [('b', 'c'), ('d', 'e')])]),
+    # Nested templates are returned after the templates that contain them
+    ('{{a|{{b|x=1}}|y=2}}', [('a', [('1', '{{b|x=1}}'), ('y', '2')]), ('b', [('x', '1')])]),
+    ('{{a|b=[[c]]{{d}}}}', [('a', [('b', '[[c]]{{d}}')]), ('d', [])]),
+    ('{{a|<ref>{{b|c=d}}</ref>}}', [('a', [('1', '<ref>{{b|c=d}}</ref>')]), ('b', [('c', 'd')])]),
+    # Parser functions are not templates, but the templates inside them are
+    ('{{#if:x|{{b}}|y}}', [('b', [])]),
+    # Template parameters and links do not split the parameters of the template around them
+    ('{{a|{{{param|x}}}|k={{{p|d}}}}}', [('a', [('1', '{{{param|x}}}'), ('k', '{{{p|d}}}')])]),
+    ('{{a|[[link|a=b]]|c=d}}', [('a', [('1', '[[link|a=b]]'), ('c', 'd')])]),
+    # Comments and nowiki are removed before parsing
+    ('{{a|x=1<!-- |y=2 -->|z=3}}', [('a', [('x', '1'), ('z', '3')])]),
+    ('{{a|<nowiki>|b=c</nowiki>|d=e}}', [('a', [('1', ''), ('d', 'e')])]),
+    ('<pre>{{a}}</pre>{{b}}', [('b', [])]),
+    # Positional parameters are numbered separately from the named ones, the last value wins
+    ('{{a|x|1=y|z}}', [('a', [('1', 'y'), ('2', 'z')])]),
+    ('{{a|1=y|x}}', [('a', [('1', 'x')])]),
+    ('{{a|x=1|x=2}}', [('a', [('x', '2')])]),
+    # Named values are stripped and may contain =, positional values are kept as is
+    ('{{a| b = c | d }}', [('a', [('b', 'c'), ('1', ' d ')])]),
+    ('{{a|b=c=d}}', [('a', [('b', 'c=d')])]),
+])
+def test_extract_templates_and_params(text, expected):
+    assert [(t, list(p.items())) for t, p in extract_templates_and_params(text)] == expected
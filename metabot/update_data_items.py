@@ -6,8 +6,6 @@ if __name__ != "__main__":
 
 from os import environ
 from pathlib import Path
-from pywikibot import Site as PWB_Site
-from metabot.OsmFamily import OsmFamily
 from metabot import Caches
 from metabot.Properties import P_WIKI_PAGES
 from metabot.Processor import Processor
@@ -20,13 +18,12 @@ try:
 
     site = get_osm_site()
     use_bot_limits = False
-    pwb_site = PWB_Site(fam=OsmFamily(), user='Yurikbot')
     password = environ.get('YURIKBOT_PASSWORD') or Path('./password').read_text().strip()
     site.login(user='Yurikbot', password=password, on_demand=True)
 
-    caches = Caches(site, pwb_site, use_bot_limits=False)
-    caches.data_items.regenerate()
-    caches.description.regenerate()
+    caches = Caches(site, use_bot_limits=False)
+    caches.data_items.sync()
+    caches.description.sync()
     caches.descriptionParsed.regenerate()
     caches.wikiPageTitles.regenerate()
 
@@ -44,7 +41,7 @@ try:
     print(f'\n********** Initial start complete, monitoring user changes...\n')
     proc = Processor(dict(throw=False), caches, site)
     while True:
-        last_change, todo_items = get_recently_changed_items(site, last_change, grace_period, caches)
+        last_change, todo_items = get_recently_changed_items(caches.fetcher, last_change, grace_period, caches)
         if todo_items:
             proc.run(todo_items)
 
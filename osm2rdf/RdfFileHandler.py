@@ -6,6 +6,7 @@ from multiprocessing import Process, Queue
 from datetime import datetime
 
 import osmutils
+from profiler import Profiler
 from utils import format_date
 from RdfHandler import RdfHandler
 
@@ -13,13 +14,27 @@ log = logging.getLogger('osm2rdf')
 
 
 def writer_thread(worker_id, queue, options):
+    write = write_file
+    profiler = None
+    if getattr(options, 'profile', None):
+        profiler = Profiler(f'writer-{worker_id}', options.profile, options.profile_sample_rate)
+        profiler.patch(osmutils, ['toStrings'])
+        profiler.patch(gzip.GzipFile, ['write', 'close'], 'gzip.')
+        get = profiler.wrap('queue.get', queue.get)
+        write = profiler.wrap('write_file', write_file)
+        profiler.start()
+    else:
+        get = queue.get
+
     while True:
-        ts, file_id, data, last_timestamp, stats_str = queue.get()
+        ts, file_id, data, last_timestamp, stats_str = get()
         if ts is None:
             log.debug(f'Exiting worker #{worker_id}')
+            if profiler:
+                profiler.dump()
             return
 
-        write_file(ts, worker_id, options, file_id, data, last_timestamp, stats_str)
+        write(ts, worker_id, options, file_id, data, last_timestamp, stats_str)
 
 
 def write_file(ts_enqueue, worker_id, options, file_id, data, last_timestamp, stats_str):
@@ -3,14 +3,27 @@ import logging
 import datetime as dt
 from datetime import datetime
 
+import metrics
 import osmutils
 from utils import set_status_query, query_status
 from RdfHandler import RdfHandler
-from osmium.replication.server import ReplicationServer
+from replicationMirror import make_replication_server, LocalReplicationServer
 from sparql import Sparql
 
 log = logging.getLogger('osm2rdf')
 
+seqid_gauge = metrics.gauge('osm2rdf_seqid', 'Last replication sequence ID stored in the database')
+available_seqid_gauge = metrics.gauge('osm2rdf_available_seqid', 'Latest sequence ID published by the replication server')
+lag_gauge = metrics.gauge('osm2rdf_replication_lag_seconds', 'Age of the last stored replication diff')
+diffs_counter = metrics.counter('osm2rdf_diffs_total', 'Replication diffs applied')
+diff_bytes_counter = metrics.counter('osm2rdf_diff_bytes_total', 'Downloaded replication diff size')
+inserted_counter = metrics.counter('osm2rdf_statements_inserted_total', 'Statements inserted')
+cleared_counter = metrics.counter('osm2rdf_subjects_cleared_total',
+                                  'Subjects whose old statements were deleted before re-inserting')
+deleted_counter = metrics.counter('osm2rdf_objects_deleted_total', 'OSM objects deleted', ['type'])
+pending_diffs_gauge = metrics.gauge('osm2rdf_pending_diffs', 'Published diffs that have not been applied yet')
+pending_statements_gauge = metrics.gauge('osm2rdf_pending_statements', 'Statements waiting for the next flush')
+
 
 class RdfUpdateHandler(RdfHandler):
     def __init__(self, options):
@@ -18,6 +31,10 @@ class RdfUpdateHandler(RdfHandler):
         self.pending = {}
         self.pendingCounter = 0
         self.rdf_server = Sparql(self.options.rdf_url, self.options.dry_run)
+        # Cumulative time spent generating and running SPARQL updates, and the total size of the updates
+        self.sparql_seconds = 0.0
+        self.commit_seconds = 0.0
+        self.payload_bytes = 0
 
     def finalize_object(self, obj, statements, obj_type):
         super(RdfUpdateHandler, self).finalize_object(obj, statements, obj_type)
@@ -35,12 +52,15 @@ class RdfUpdateHandler(RdfHandler):
         else:
             self.pending[prefixed_id] = False
             self.pendingCounter += 1
+        pending_statements_gauge.set(self.pendingCounter)
 
         if self.pendingCounter > 5000:
             self.flush()
 
     def flush(self, seqid=0):
+        start = time.perf_counter()
         sparql = ''
+        inserted = 0
 
         if self.pending:
             # Remove all statements with these subjects
@@ -52,7 +72,9 @@ WHERE {{
   FILTER (osmm:task != ?p)
 }};'''
             # flatten list of lists, and if sublist is truthy, use it
-            insert_sparql = '\n'.join([v for sublist in self.pending.values() if sublist for v in sublist])
+            insert_lines = [v for sublist in self.pending.values() if sublist for v in sublist]
+            inserted = len(insert_lines)
+            insert_sparql = '\n'.join(insert_lines)
             if insert_sparql:
                 sparql += f'INSERT {{ {insert_sparql} }} WHERE {{}};\n'
 
@@ -63,7 +85,14 @@ WHERE {{
 
         if sparql:
             sparql = '\n'.join(osmutils.prefixes) + '\n\n' + sparql
+            generated = time.perf_counter()
             self.rdf_server.run('update', sparql)
+            self.sparql_seconds += generated - start
+            self.commit_seconds += time.perf_counter() - generated
+            self.payload_bytes += len(sparql.encode('utf-8'))
+            inserted_counter.inc(inserted)
+            cleared_counter.inc(len(self.pending))
+            pending_statements_gauge.set(0)
             self.pendingCounter = 0
             self.pending = {}
         elif self.pendingCounter != 0:
@@ -88,7 +117,10 @@ WHERE {{
         return None
 
     def run(self):
-        repserv = ReplicationServer(self.options.osm_updater_url)
+        repserv = make_replication_server(self.options.osm_updater_url)
+        # Replaying locally stored diffs - process them as fast as possible, and stop at the end
+        replay = isinstance(repserv, LocalReplicationServer)
+        report = ReplayReport(self.options.replay_report) if replay else None
         last_time = datetime.utcnow()
         if self.options.seqid:
             seqid = self.options.seqid
@@ -98,6 +130,7 @@ WHERE {{
                 raise Exception('Unable to determine sequence ID')
 
         log.info(f'Initial sequence id: {seqid}')
+        seqid_gauge.set(seqid - 1)
         state = None
         last_seqid = seqid
 
@@ -109,6 +142,8 @@ WHERE {{
             sleep = True
             if state is None:
                 state = repserv.get_state_info()
+                if state is not None:
+                    available_seqid_gauge.set(state.sequence)
                 if state is not None and seqid + 2 < state.sequence:
                     log.info(f'Replication server has data up to #{state.sequence}')
 
@@ -122,16 +157,37 @@ WHERE {{
                 if len(diffdata) > 0:
                     log.debug("Downloaded change %d. (size=%d)" % (seqid, len(diffdata)))
 
+                    deleted = (self.deleted_nodes, self.deleted_ways, self.deleted_rels)
+                    before = (time.perf_counter(), self.sparql_seconds, self.commit_seconds, self.payload_bytes)
                     if self.options.addWayLoc:
                         self.apply_buffer(diffdata, repserv.diff_type, locations=True, idx=self.get_index_string())
                     else:
                         self.apply_buffer(diffdata, repserv.diff_type)
+                    parsed = (time.perf_counter(), self.sparql_seconds, self.commit_seconds)
 
                     self.flush(seqid)
 
+                    if report:
+                        # Batches flushed while parsing are not counted towards the parsing time
+                        parse_time = parsed[0] - before[0] - (parsed[1] - before[1]) - (parsed[2] - before[2])
+                        report.add(seqid, len(diffdata), parse_time, self.sparql_seconds - before[1],
+                                   self.commit_seconds - before[2], self.payload_bytes - before[3])
+
+                    diffs_counter.inc()
+                    diff_bytes_counter.inc(len(diffdata))
+                    for obj_type, old, new in zip(('node', 'way', 'relation'), deleted,
+                                                  (self.deleted_nodes, self.deleted_ways, self.deleted_rels)):
+                        deleted_counter.labels(obj_type).inc(new - old)
+                    seqid_gauge.set(seqid)
+
                     seqid += 1
                     sleep = False
 
+            if state is not None:
+                pending_diffs_gauge.set(max(0, state.sequence - seqid + 1))
+            if self.last_timestamp.year >= 2000:
+                lag_gauge.set((datetime.now(dt.timezone.utc) - self.last_timestamp).total_seconds())
+
             seconds_since_last = (datetime.utcnow() - last_time).total_seconds()
             if seconds_since_last > 60:
                 log.info(f'Processed {seqid - last_seqid - 1}, ' +
@@ -142,5 +198,42 @@ WHERE {{
             if state is not None and seqid > state.sequence:
                 state = None  # Refresh state
 
+            if replay and sleep:
+                report.close()
+                return
+
             if sleep:
                 time.sleep(60)
+
+
+class ReplayReport:
+    """Per-seqid timings when replaying local diffs, logged and optionally saved as a CSV file"""
+
+    def __init__(self, filename=None):
+        self.rows = []
+        self.file = None
+        if filename:
+            self.file = open(filename, 'w')
+            print('seqid,diff_bytes,parse_sec,sparql_sec,commit_sec,payload_bytes', file=self.file)
+
+    def add(self, seqid, diff_bytes, parse, sparql, commit, payload):
+        self.rows.append((parse, sparql, commit, payload))
+        log.info(f'#{seqid}: {diff_bytes:,} bytes diff, parse {parse:.3f}s, sparql {sparql:.3f}s, '
+                 f'commit {commit:.3f}s, {payload:,} bytes payload')
+        if self.file:
+            print(f'{seqid},{diff_bytes},{parse:.4f},{sparql:.4f},{commit:.4f},{payload}', file=self.file)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if not self.rows:
+            log.info('Replay finished, nothing was processed')
+            return
+        count = len(self.rows)
+        parse, sparql, commit, payload = [sum(v) for v in zip(*self.rows)]
+        commits = sorted(v[2] for v in self.rows)
+        total = parse + sparql + commit
+        log.info(f'Replayed {count} diffs in {total:.1f}s ({count / total if total else 0:.1f} diffs/s): '
+                 f'parse {parse:.1f}s, sparql {sparql:.1f}s, commit {commit:.1f}s '
+                 f'(median {commits[count // 2]:.3f}s, max {commits[-1]:.3f}s), {payload:,} bytes payload')
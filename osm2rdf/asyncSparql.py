@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+import aiohttp
+
+from sparql import request_seconds, payload_bytes, request_errors
+
+
+class AsyncSparql:
+    """
+    asyncio version of Sparql with the same run() semantics. At most max_concurrent requests
+    are sent to the server at the same time, the rest wait for their turn.
+    """
+
+    def __init__(self, rdf_url, dry_run, max_concurrent=4):
+        self.rdf_url = rdf_url
+        self.dry_run = dry_run
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def run(self, queryType, sparql, timeout=None):
+        """Returns the bindings of a query, or the server's response text for an update"""
+        if self.dry_run and self.dry_run != queryType:
+            return None
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        headers = {'Accept': 'application/sparql-results+json'}
+        if timeout:
+            headers['X-BIGDATA-MAX-QUERY-MILLIS'] = str(int(timeout * 1000))
+        async with self.semaphore:
+            payload_bytes.labels(queryType).observe(len(sparql.encode('utf-8')))
+            start = time.perf_counter()
+            try:
+                async with self.session.post(self.rdf_url, data={queryType: sparql}, headers=headers,
+                                             timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                    if not r.ok:
+                        request_errors.labels(queryType).inc()
+                        print(r.reason)
+                        print(sparql)
+                        raise Exception(r.reason)
+                    if queryType == 'query':
+                        return (await r.json(content_type=None))['results']['bindings']
+                    return await r.text()
+            finally:
+                request_seconds.labels(queryType).observe(time.perf_counter() - start)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+
+from .synthetic import SyntheticData
+from .runner import run_all
+
+# Metrics compared against the baseline. True if a bigger value is better.
+tracked_metrics = {
+    'objects_per_sec': True,
+    'statements_per_sec': True,
+    'diffs_per_sec': True,
+    'bytes_written': False,
+    'sparql_bytes': False,
+    'sparql_requests': False,
+}
+
+
+class Benchmark(object):
+    def __init__(self):
+
+        self.log = logging.getLogger('osm2rdf')
+        self.log.setLevel(logging.INFO)
+
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.log.addHandler(ch)
+
+        parser = argparse.ArgumentParser(
+            description='Measures osm2rdf parsing and updating throughput on reproducible synthetic data',
+            usage='python3 -m benchmark <command> [command_specific_arguments]'
+        )
+        subparsers = parser.add_subparsers(help='command', title='Commands', dest='command')
+
+        parser_gen = subparsers.add_parser('generate', help='Generate a synthetic PBF file and OSC diffs')
+        parser_gen.add_argument('data_dir', help='Directory to store the generated data')
+        parser_gen.add_argument('--seed', action='store', type=int, default=42,
+                                help='Random seed, same seed produces identical data (default: %(default)s)')
+        parser_gen.add_argument('--nodes', action='store', type=int, default=200000,
+                                help='Number of nodes (default: %(default)s)')
+        parser_gen.add_argument('--ways', action='store', type=int, default=30000,
+                                help='Number of ways (default: %(default)s)')
+        parser_gen.add_argument('--relations', action='store', type=int, default=2000,
+                                help='Number of relations (default: %(default)s)')
+        parser_gen.add_argument('--diffs', action='store', type=int, default=30,
+                                help='Number of minute diffs (default: %(default)s)')
+        parser_gen.add_argument('--diff-size', action='store', dest='diff_size', type=int, default=1000,
+                                help='Number of changed objects per diff (default: %(default)s)')
+
+        parser_run = subparsers.add_parser('run', help='Run all benchmarks against the generated data')
+        parser_run.add_argument('data_dir', help='Directory with the generated data')
+        parser_run.add_argument('--skip-way-geo', action='store_false', dest='addWayLoc',
+                                help='Do not calculate way centroids')
+        parser_run.add_argument('--workers', action='store', dest='worker_count', default=2, type=int,
+                                help='Number of writer processes (default: %(default)s)')
+        parser_run.add_argument('--max-statements', dest='maxStatementsPerFile', action='store', type=int,
+                                default=1000, help='Statements, in thousands, per output file (default: %(default)s)')
+        parser_run.add_argument('--baseline', action='store', dest='baseline',
+                                default=os.path.join(os.path.dirname(__file__), 'baseline.json'),
+                                help='Baseline results file (default: %(default)s)')
+        parser_run.add_argument('--save-baseline', action='store_true', dest='save_baseline',
+                                help='Store the results as the new baseline')
+        parser_run.add_argument('--tolerance', action='store', type=float, default=0.1,
+                                help='Relative change that is reported as a regression (default: %(default)s)')
+        parser_run.add_argument('--output', action='store', default=None,
+                                help='Also write the results as JSON to this file')
+
+        opts = parser.parse_args()
+        if not opts.command:
+            parser.print_help()
+            exit(1)
+        self.options = opts
+        exit(getattr(self, opts.command)())
+
+    def generate(self):
+        opts = self.options
+        data = SyntheticData(opts.seed, opts.nodes, opts.ways, opts.relations)
+        os.makedirs(opts.data_dir, exist_ok=True)
+        pbf_file = os.path.join(opts.data_dir, 'synthetic.osm.pbf')
+        self.log.info(f'Generating {pbf_file}')
+        data.write_pbf(pbf_file)
+        diffs_dir = os.path.join(opts.data_dir, 'diffs')
+        self.log.info(f'Generating {opts.diffs} diffs in {diffs_dir}')
+        data.write_diffs(diffs_dir, opts.diffs, opts.diff_size)
+        with open(os.path.join(opts.data_dir, 'params.json'), 'w') as file:
+            json.dump(vars(opts), file, indent=2)
+        self.log.info('done')
+        return 0
+
+    def run(self):
+        opts = self.options
+        results = run_all(opts.data_dir, opts.addWayLoc, opts.worker_count, opts.maxStatementsPerFile)
+        self.print_results(results)
+
+        if opts.output:
+            with open(opts.output, 'w') as file:
+                json.dump(results, file, indent=2)
+
+        regressions = 0
+        if os.path.isfile(opts.baseline):
+            with open(opts.baseline) as file:
+                baseline = json.load(file)
+            regressions = self.compare(baseline, results, opts.tolerance)
+        else:
+            self.log.info(f'No baseline found at {opts.baseline}')
+
+        if opts.save_baseline:
+            with open(opts.baseline, 'w') as file:
+                json.dump(results, file, indent=2)
+            self.log.info(f'Saved baseline to {opts.baseline}')
+            return 0
+
+        return 1 if regressions else 0
+
+    @staticmethod
+    def print_results(results):
+        for name, values in results.items():
+            print(f'{name}:')
+            for key, value in values.items():
+                print(f'  {key:24} {value:16,.1f}' if isinstance(value, float) else f'  {key:24} {value:16,}')
+
+    def compare(self, baseline, results, tolerance):
+        regressions = 0
+        for name, values in results.items():
+            for key, higher_is_better in tracked_metrics.items():
+                if key not in values or key not in baseline.get(name, {}):
+                    continue
+                old, new = baseline[name][key], values[key]
+                if not old:
+                    continue
+                change = (new - old) / old
+                if (change < -tolerance) if higher_is_better else (change > tolerance):
+                    regressions += 1
+                    self.log.warning(f'REGRESSION {name}.{key}: {old:,.1f} -> {new:,.1f} ({change:+.1%})')
+                elif abs(change) > tolerance:
+                    self.log.info(f'Improved {name}.{key}: {old:,.1f} -> {new:,.1f} ({change:+.1%})')
+        if not regressions:
+            self.log.info(f'No regressions compared to the baseline (tolerance {tolerance:.0%})')
+        return regressions
+
+
+if __name__ == '__main__':
+    # Run from the osm2rdf directory:  python3 -m benchmark generate /tmp/bench && python3 -m benchmark run /tmp/bench
+    Benchmark()
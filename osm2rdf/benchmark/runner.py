@@ -0,0 +1,153 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+from argparse import Namespace
+
+import osmutils
+from RdfFileHandler import RdfFileHandler
+from RdfHandler import RdfHandler
+from RdfUpdateHandler import RdfUpdateHandler
+from localSparql import LocalSparqlServer
+from replicationMirror import replication_path, read_state
+
+
+class CollectingHandler(RdfHandler):
+    """Parses a file without writing anything, keeping the statements for the toStrings benchmark"""
+
+    def __init__(self, options, keep=200000):
+        super(CollectingHandler, self).__init__(options)
+        self.keep = keep
+        self.statements = []
+
+    def finalize_object(self, obj, statements, obj_type):
+        super(CollectingHandler, self).finalize_object(obj, statements, obj_type)
+        if statements and len(self.statements) < self.keep:
+            self.statements.append(statements)
+
+
+def make_options(**kwargs):
+    return Namespace(**{
+        'addWayLoc': True,
+        'cacheFile': None,
+        'cacheType': 'sparse',
+        'verbose': False,
+        'maxStatementsPerFile': 1000,
+        'worker_count': 2,
+        'dry_run': False,
+        **kwargs,
+    })
+
+
+def object_count(handler):
+    return handler.added_nodes + handler.skipped_nodes + handler.added_ways + handler.added_rels + \
+           handler.deleted_nodes + handler.deleted_ways + handler.deleted_rels
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0
+
+
+def bench_parse(pbf_file, add_way_loc):
+    handler = CollectingHandler(make_options(addWayLoc=add_way_loc))
+    start = time.perf_counter()
+    if add_way_loc:
+        handler.apply_file(pbf_file, locations=True, idx=handler.get_index_string())
+    else:
+        handler.apply_file(pbf_file)
+    seconds = time.perf_counter() - start
+    objects = object_count(handler)
+    return handler.statements, {
+        'seconds': seconds,
+        'objects': objects,
+        'statements': handler.new_statements,
+        'objects_per_sec': rate(objects, seconds),
+        'statements_per_sec': rate(handler.new_statements, seconds),
+    }
+
+
+def bench_to_strings(statements, repeat=3):
+    count = sum(len(s) for s in statements) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for stmts in statements:
+            osmutils.toStrings(stmts)
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'statements': count,
+        'statements_per_sec': rate(count, seconds),
+    }
+
+
+def bench_file_handler(pbf_file, add_way_loc, workers, max_statements):
+    output_dir = tempfile.mkdtemp(prefix='osm2rdf-bench-')
+    try:
+        options = make_options(addWayLoc=add_way_loc, output_dir=output_dir,
+                               worker_count=workers, maxStatementsPerFile=max_statements)
+        start = time.perf_counter()
+        with RdfFileHandler(options) as handler:
+            handler.run(pbf_file)
+        seconds = time.perf_counter() - start
+        files = glob.glob(os.path.join(output_dir, '*.ttl.gz'))
+        written = sum(os.path.getsize(f) for f in files)
+        objects = object_count(handler)
+        return {
+            'seconds': seconds,
+            'objects': objects,
+            'statements': handler.new_statements,
+            'objects_per_sec': rate(objects, seconds),
+            'statements_per_sec': rate(handler.new_statements, seconds),
+            'files': len(files),
+            'bytes_written': written,
+            'bytes_per_sec': rate(written, seconds),
+        }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def bench_update_handler(diffs_dir):
+    last_seqid = read_state(os.path.join(diffs_dir, 'state.txt')).sequence
+    with LocalSparqlServer() as server:
+        options = make_options(addWayLoc=False, rdf_url=server.url)
+        handler = RdfUpdateHandler(options)
+        start = time.perf_counter()
+        diffs = 0
+        for seqid in range(1, last_seqid + 1):
+            filename = replication_path(diffs_dir, seqid, '.osc.gz')
+            if not os.path.isfile(filename):
+                continue
+            with open(filename, 'rb') as file:
+                data = file.read()
+            handler.apply_buffer(data, 'osc.gz')
+            handler.flush(seqid)
+            diffs += 1
+        seconds = time.perf_counter() - start
+        sizes = sorted(r.size for r in server.requests if r.query_type == 'update')
+
+    objects = object_count(handler)
+    return {
+        'seconds': seconds,
+        'diffs': diffs,
+        'objects': objects,
+        'statements': handler.new_statements,
+        'objects_per_sec': rate(objects, seconds),
+        'statements_per_sec': rate(handler.new_statements, seconds),
+        'diffs_per_sec': rate(diffs, seconds),
+        'sparql_requests': len(sizes),
+        'sparql_bytes': sum(sizes),
+        'sparql_payload_median': sizes[len(sizes) // 2] if sizes else 0,
+        'sparql_payload_max': sizes[-1] if sizes else 0,
+    }
+
+
+def run_all(data_dir, add_way_loc=True, workers=2, max_statements=1000):
+    pbf_file = os.path.join(data_dir, 'synthetic.osm.pbf')
+    results = {}
+    statements, results['parse'] = bench_parse(pbf_file, add_way_loc)
+    results['toStrings'] = bench_to_strings(statements)
+    del statements
+    results['RdfFileHandler'] = bench_file_handler(pbf_file, add_way_loc, workers, max_statements)
+    results['RdfUpdateHandler'] = bench_update_handler(os.path.join(data_dir, 'diffs'))
+    return results
@@ -0,0 +1,188 @@
+import datetime as dt
+import os
+import random
+
+import osmium
+from osmium.osm.mutable import Node, Way, Relation
+
+from replicationMirror import replication_path, write_state
+
+# Rough shape of the planet: most nodes are untagged way members, a small share of nodes carry tags,
+# almost all ways and relations do. Weights are relative frequencies of the keys among tagged objects.
+NODE_TAGGED_FRACTION = 0.07
+
+node_keys = [
+    ('name', 30), ('amenity', 12), ('highway', 10), ('shop', 6), ('natural', 8), ('barrier', 5),
+    ('power', 9), ('addr:housenumber', 15), ('addr:street', 15), ('wikidata', 2), ('wikipedia', 1),
+    ('created_by', 3), ('source', 6), ('ref', 5), ('opening_hours', 2), ('name:en', 2),
+]
+way_keys = [
+    ('building', 45), ('highway', 25), ('name', 18), ('surface', 10), ('landuse', 6), ('natural', 5),
+    ('waterway', 4), ('oneway', 6), ('maxspeed', 4), ('lanes', 3), ('source', 8), ('ref', 3),
+    ('wikidata', 1), ('wikipedia', 1), ('building:levels', 4), ('addr:housenumber', 6), ('Bad Key!', 0.1),
+]
+relation_keys = [
+    ('type', 100), ('name', 60), ('route', 25), ('boundary', 20), ('admin_level', 20), ('network', 15),
+    ('ref', 15), ('operator', 8), ('wikidata', 12), ('wikipedia', 10), ('restriction', 20),
+]
+
+values = {
+    'amenity': ['parking', 'bench', 'restaurant', 'school', 'place_of_worship', 'cafe', 'fuel'],
+    'highway': ['residential', 'service', 'track', 'footway', 'unclassified', 'primary', 'crossing'],
+    'building': ['yes', 'house', 'residential', 'garage', 'apartments'],
+    'natural': ['tree', 'water', 'wood', 'scrub', 'peak'],
+    'surface': ['asphalt', 'unpaved', 'gravel', 'paved', 'ground'],
+    'landuse': ['residential', 'farmland', 'grass', 'meadow', 'forest'],
+    'waterway': ['stream', 'ditch', 'river', 'drain'],
+    'barrier': ['gate', 'fence', 'bollard', 'wall'],
+    'power': ['tower', 'pole', 'line'],
+    'shop': ['convenience', 'supermarket', 'clothes', 'hairdresser'],
+    'oneway': ['yes', 'no', '-1'],
+    'type': ['multipolygon', 'route', 'restriction', 'boundary', 'associatedStreet'],
+    'route': ['bus', 'road', 'bicycle', 'hiking'],
+    'boundary': ['administrative', 'postal_code', 'protected_area'],
+    'restriction': ['no_left_turn', 'no_u_turn', 'only_straight_on'],
+    'source': ['bing', 'survey', 'Bing;survey', 'local knowledge'],
+    'created_by': ['JOSM', 'Potlatch 0.10f', 'iD'],
+}
+
+words = ['Main', 'Oak', 'Church', 'Station', 'Lake', 'Hill', 'Park', 'Mill', 'North', 'Бульвар', 'Straße',
+         'École', '東京', 'Rue de la Paix', 'Saint "Quoted"']
+wiki_langs = ['en', 'de', 'fr', 'ru', 'es', 'it', 'ja', 'zh-yue']
+roles = ['outer', 'inner', '', 'stop', 'platform', 'from', 'to', 'via', 'forward']
+
+
+class SyntheticData:
+    """Reproducible synthetic OSM data - the same seed always produces the same objects"""
+
+    def __init__(self, seed=42, nodes=100000, ways=15000, relations=1000,
+                 start=dt.datetime(2020, 1, 1, tzinfo=dt.timezone.utc)):
+        self.seed = seed
+        self.node_count = nodes
+        self.way_count = ways
+        self.relation_count = relations
+        self.start = start
+
+    @staticmethod
+    def pick_keys(rnd, keys, count):
+        population = [k for k, _ in keys]
+        weights = [w for _, w in keys]
+        return set(rnd.choices(population, weights=weights, k=count))
+
+    @staticmethod
+    def make_value(rnd, key):
+        if key in values:
+            return rnd.choice(values[key])
+        if key == 'wikidata':
+            return 'Q' + str(rnd.randint(1, 90000000))
+        if key == 'wikipedia':
+            return rnd.choice(wiki_langs) + ':' + ' '.join(rnd.sample(words, rnd.randint(1, 3)))
+        if key in ('lanes', 'building:levels', 'admin_level', 'maxspeed', 'addr:housenumber'):
+            return str(rnd.randint(1, 120))
+        if key == 'ref':
+            return rnd.choice('ABMN') + str(rnd.randint(1, 999))
+        return ' '.join(rnd.sample(words, rnd.randint(1, 3)))
+
+    def make_tags(self, rnd, keys, avg_count):
+        count = max(1, int(rnd.expovariate(1 / avg_count)))
+        return {k: self.make_value(rnd, k) for k in self.pick_keys(rnd, keys, count)}
+
+    def timestamp(self, rnd):
+        return self.start - dt.timedelta(seconds=rnd.randint(0, 10 * 365 * 24 * 3600))
+
+    def meta(self, rnd, version=None):
+        return dict(version=version or rnd.randint(1, 12), changeset=rnd.randint(1, 90000000),
+                    uid=rnd.randint(1, 10000000), user='user' + str(rnd.randint(1, 5000)),
+                    timestamp=self.timestamp(rnd))
+
+    def location(self, rnd):
+        return rnd.uniform(-180, 180), rnd.uniform(-85, 85)
+
+    def node(self, rnd, node_id, **meta):
+        tags = self.make_tags(rnd, node_keys, 2.5) if rnd.random() < NODE_TAGGED_FRACTION else {}
+        return Node(id=node_id, location=self.location(rnd), tags=tags, **(meta or self.meta(rnd)))
+
+    def way(self, rnd, way_id, **meta):
+        size = min(self.node_count, max(2, int(rnd.expovariate(1 / 9))))
+        first = rnd.randint(1, self.node_count - size + 1)
+        node_ids = list(range(first, first + size))
+        if rnd.random() < 0.4:
+            node_ids.append(first)  # closed way
+        return Way(id=way_id, nodes=node_ids, tags=self.make_tags(rnd, way_keys, 3), **(meta or self.meta(rnd)))
+
+    def relation(self, rnd, rel_id, **meta):
+        members = []
+        for _ in range(max(1, int(rnd.expovariate(1 / 12)))):
+            typ = rnd.choices('nwr', weights=[30, 65, 5])[0]
+            if typ == 'n':
+                ref = rnd.randint(1, self.node_count)
+            elif typ == 'w':
+                ref = rnd.randint(1, self.way_count)
+            else:
+                ref = rnd.randint(1, max(1, rel_id - 1))
+            members.append((typ, ref, rnd.choice(roles)))
+        return Relation(id=rel_id, members=members, tags=self.make_tags(rnd, relation_keys, 4),
+                        **(meta or self.meta(rnd)))
+
+    def write_pbf(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        rnd = random.Random(self.seed)
+        writer = osmium.SimpleWriter(filename)
+        try:
+            for i in range(1, self.node_count + 1):
+                writer.add_node(self.node(rnd, i))
+            for i in range(1, self.way_count + 1):
+                writer.add_way(self.way(rnd, i))
+            for i in range(1, self.relation_count + 1):
+                writer.add_relation(self.relation(rnd, i))
+        finally:
+            writer.close()
+
+    def write_diffs(self, directory, count, changes_per_diff=500, first_seqid=1):
+        """
+        Write `count` OSC files in the replication server layout (000/000/001.osc.gz + .state.txt),
+        plus the top-level state.txt. Each diff contains creates, modifies and deletes of existing objects.
+        """
+        rnd = random.Random(self.seed + 1)
+        next_ids = {'n': self.node_count + 1, 'w': self.way_count + 1, 'r': self.relation_count + 1}
+        makers = {'n': self.node, 'w': self.way, 'r': self.relation}
+        adders = {'n': 'add_node', 'w': 'add_way', 'r': 'add_relation'}
+        totals = {'n': self.node_count, 'w': self.way_count, 'r': self.relation_count}
+        seqid = first_seqid
+        timestamp = self.start
+        for seqid in range(first_seqid, first_seqid + count):
+            timestamp = self.start + dt.timedelta(minutes=seqid)
+            filename = replication_path(directory, seqid, '.osc.gz')
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            if os.path.exists(filename):
+                os.remove(filename)
+            changes = []
+            for _ in range(changes_per_diff):
+                typ = rnd.choices('nwr', weights=[60, 35, 5])[0]
+                action = rnd.choices(['create', 'modify', 'delete'], weights=[25, 65, 10])[0]
+                meta = self.meta(rnd)
+                meta['timestamp'] = timestamp - dt.timedelta(seconds=rnd.randint(0, 59))
+                if action == 'create':
+                    obj_id = next_ids[typ]
+                    next_ids[typ] += 1
+                    meta['version'] = 1
+                else:
+                    obj_id = rnd.randint(1, totals[typ])
+                    meta['version'] = rnd.randint(2, 20)
+                obj = makers[typ](rnd, obj_id, **meta)
+                if action == 'delete':
+                    obj.visible = False
+                    obj.tags = {}
+                changes.append((typ, obj_id, obj))
+            # osmChange files are sorted by type and id
+            changes.sort(key=lambda v: ('nwr'.index(v[0]), v[1]))
+            writer = osmium.SimpleWriter(filename)
+            try:
+                for typ, _, obj in changes:
+                    getattr(writer, adders[typ])(obj)
+            finally:
+                writer.close()
+            write_state(replication_path(directory, seqid, '.state.txt'), seqid, timestamp)
+        write_state(os.path.join(directory, 'state.txt'), seqid, timestamp)
+
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Copyright Yuri Astrakhan <YuriAstrakhan@gmail.com>
+
+import argparse
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import osmutils
+
+EMPTY_RESULT = {'head': {'vars': []}, 'results': {'bindings': []}}
+
+# Prefixes that Blazegraph has pre-declared for Sophox, and that the updater scripts use without declaring
+known_prefixes = {
+    **{p.split(' ')[1][:-1]: p.split(' ')[2][1:-1] for p in osmutils.prefixes},
+    'osmd': 'http://wiki.openstreetmap.org/entity/',
+    'osmdt': 'http://wiki.openstreetmap.org/prop/direct/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+}
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+class SparqlRequest:
+    def __init__(self, query_type, sparql, elapsed, ok=True):
+        self.query_type = query_type
+        self.size = len(sparql.encode('utf-8'))
+        self.elapsed = elapsed
+        self.ok = ok
+
+
+class LocalSparqlServer:
+    """
+    Minimal stand-in for the Blazegraph SPARQL endpoint. Accepts the same query=/update= form posts
+    as Sparql.run, and records every request so that payload sizes and counts can be inspected.
+    Optionally delays each request and fails a fraction of them to simulate a loaded server.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bigdata/namespace/wdq/sparql'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+
+    def record(self, query_type, sparql, elapsed, ok):
+        with self._lock:
+            self.requests.append(SparqlRequest(query_type, sparql, elapsed, ok))
+
+    def execute(self, query_type, sparql):
+        with self._lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.failure_rate and self.random.random() < self.failure_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise InjectedFailure('Injected failure')
+        return self.evaluate(query_type, sparql)
+
+    def evaluate(self, query_type, sparql):
+        """Returns (content type, response body). Derived classes run the request against a real store"""
+        if query_type == 'query':
+            return 'application/sparql-results+json', json.dumps(EMPTY_RESULT)
+        return 'text/html', '<html><body><p>COMMIT: totalElapsed=0ms, commitTime=0, mutationCount=0</p></body></html>'
+
+
+class RdflibSparqlServer(LocalSparqlServer):
+    """
+    Stand-in endpoint backed by an in-process rdflib triple store, so that updates actually change data
+    and queries return real results. Requires rdflib (pip install rdflib).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RdflibSparqlServer, self).__init__(*args, **kwargs)
+        import rdflib
+        self.graph = rdflib.Graph()
+        for prefix, uri in known_prefixes.items():
+            self.graph.bind(prefix, uri)
+        self._store_lock = threading.Lock()
+
+    def load(self, filename):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as file:
+            with self._store_lock:
+                self.graph.parse(file, format='turtle')
+
+    def evaluate(self, query_type, sparql):
+        with self._store_lock:
+            if query_type == 'query':
+                result = self.graph.query(sparql, initNs=known_prefixes)
+                return 'application/sparql-results+json', result.serialize(format='json').decode('utf-8')
+            before = len(self.graph)
+            self.graph.update(sparql, initNs=known_prefixes)
+            mutations = abs(len(self.graph) - before)
+        return 'text/html', f'<html><body><p>COMMIT: mutationCount={mutations}</p></body></html>'
+
+
+def _make_handler(server: LocalSparqlServer):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.handle_params(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self.handle_params(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+        def handle_params(self, params):
+            if 'update' in params:
+                query_type = 'update'
+            elif 'query' in params:
+                query_type = 'query'
+            else:
+                self.send_error(400, 'Expected a query= or update= parameter')
+                return
+            sparql = params[query_type][0]
+            start = time.perf_counter()
+            try:
+                content_type, body = server.execute(query_type, sparql)
+            except InjectedFailure as err:
+                server.record(query_type, sparql, time.perf_counter() - start, False)
+                self.send_error(503, str(err))
+                return
+            except Exception as err:
+                server.record(query_type, sparql, time.perf_counter() - start, False)
+                self.send_error(500, str(err).split('\n')[0])
+                return
+            server.record(query_type, sparql, time.perf_counter() - start, True)
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+class LocalSparql(object):
+    def __init__(self):
+
+        self.log = logging.getLogger('osm2rdf')
+        self.log.setLevel(logging.INFO)
+
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.log.addHandler(ch)
+
+        parser = argparse.ArgumentParser(
+            description='Runs a local SPARQL endpoint for offline testing and profiling of the updaters',
+            usage='python3 %(prog)s [options]'
+        )
+
+        parser.add_argument('--host', action='store', default='127.0.0.1',
+                            help='Interface to listen on. Default: %(default)s')
+        parser.add_argument('--port', action='store', type=int, default=9999,
+                            help='Port to listen on. Default: %(default)s')
+        parser.add_argument('--store', action='store', choices=['rdflib', 'none'], default='rdflib',
+                            help='Backing store. "none" only records requests. Default: %(default)s')
+        parser.add_argument('--load', action='append', default=[],
+                            help='Turtle file or directory of .ttl/.ttl.gz files to load at startup. Can be repeated.')
+        parser.add_argument('--latency', action='store', type=float, default=0,
+                            help='Delay each request by this many seconds. Default: %(default)s')
+        parser.add_argument('--jitter', action='store', type=float, default=0,
+                            help='Add up to this many random seconds to each delay. Default: %(default)s')
+        parser.add_argument('--failure-rate', action='store', dest='failure_rate', type=float, default=0,
+                            help='Fraction of requests to fail with HTTP 503. Default: %(default)s')
+        parser.add_argument('--seed', action='store', type=int, default=None,
+                            help='Random seed for the injected latency and failures')
+        opts = parser.parse_args()
+        if opts.load and opts.store == 'none':
+            parser.error('--load requires --store rdflib')
+
+        cls = RdflibSparqlServer if opts.store == 'rdflib' else LocalSparqlServer
+        server = cls(opts.host, opts.port, opts.latency, opts.jitter, opts.failure_rate, opts.seed)
+
+        for path in opts.load:
+            path = Path(path)
+            files = sorted(list(path.glob('*.ttl')) + list(path.glob('*.ttl.gz'))) if path.is_dir() else [path]
+            for file in files:
+                self.log.info(f'Loading {file}')
+                server.load(str(file))
+        if opts.store == 'rdflib':
+            self.log.info(f'Store contains {len(server.graph)} statements')
+
+        self.log.info(f'Listening on {server.url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    LocalSparql()
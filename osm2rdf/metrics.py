@@ -0,0 +1,186 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default buckets, in seconds for latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Default buckets for payload sizes, in bytes
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 5e7)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escape = lambda v: str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = self.new_child()
+
+    def labels(self, *values, **kwargs):
+        key = tuple(values) if values else tuple(kwargs[n] for n in self.label_names)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = self.new_child()
+            return self._children[key]
+
+    def new_child(self):
+        raise NotImplementedError()
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            lines.extend(child.collect(self.name, self.label_names, key))
+        return lines
+
+    def __getattr__(self, item):
+        # Metrics without labels proxy inc/set/observe directly to their only child
+        if item.startswith('_') or self.label_names:
+            raise AttributeError(item)
+        return getattr(self._children[()], item)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self, name, label_names, key):
+        return [f'{name}{format_labels(label_names, key)} {format_value(self.value)}']
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def collect(self, name, label_names, key):
+        lines = []
+        total = 0
+        with self._lock:
+            counts, value_sum = list(self.counts), self.sum
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            labels = format_labels(label_names, key, [('le', format_value(bound))])
+            lines.append(f'{name}_bucket{labels} {total}')
+        lines.append(f'{name}_sum{format_labels(label_names, key)} {format_value(value_sum)}')
+        lines.append(f'{name}_count{format_labels(label_names, key)} {total}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_child(self):
+        return _Value()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.bucket_bounds = buckets
+        super(Histogram, self).__init__(name, help, labels)
+
+    def new_child(self):
+        return _Histogram(self.bucket_bounds)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Re-registering returns the existing metric, so that modules can declare metrics independently
+            return self.metrics.setdefault(metric.name, metric)
+
+    def exposition(self):
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for m in metrics for line in m.collect()) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def add_metrics_argument(parser):
+    parser.add_argument('--metrics-port', action='store', dest='metrics_port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics (default: disabled)')
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Serves the registry in the Prometheus text format from a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            data = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -7,6 +7,8 @@ import argparse
 import logging
 import os
 
+from metrics import add_metrics_argument, start_metrics_server
+from profiler import Profiler, clear_profiles, merge_profiles
 from RdfFileHandler import RdfFileHandler
 from RdfUpdateHandler import RdfUpdateHandler
 
@@ -36,6 +38,15 @@ class Osm2rdf(object):
                             default='dense', help='Which node strategy to use (default: %(default)s)')
         parser.add_argument('-v', action='store_true', dest='verbose', default=False,
                             help='Enable verbose output.')
+        add_metrics_argument(parser)
+        parser.add_argument('--profile', action='store', dest='profile', default=None, metavar='DIR',
+                            help='Time each processing stage, including the writer processes, and save '
+                                 'per-process results, a merged report, and collapsed stacks into this directory')
+        parser.add_argument('--profile-sample-rate', action='store', dest='profile_sample_rate', type=int,
+                            default=0, help='With --profile, also sample call stacks this many times per second '
+                                            'in each process (default: %(default)s, disabled)')
+        parser.add_argument('--profile-per-process', action='store_true', dest='profile_per_process',
+                            default=False, help='With --profile, also report the stage times of each process')
 
         subparsers = parser.add_subparsers(help='command', title='Commands', dest='command')
 
@@ -53,12 +64,15 @@ class Osm2rdf(object):
                                    help='Start updating from this sequence ID. By default, gets it from RDF server')
         parser_update.add_argument('--update-url', action='store', dest='osm_updater_url',
                                    default='http://planet.openstreetmap.org/replication/minute',
-                                   help='Source of the minute data. Default: %(default)s')
+                                   help='Source of the minute data. Use file://<dir> to replay diffs stored by '
+                                        'replicationMirror.py as fast as possible. Default: %(default)s')
         parser_update.add_argument('--host', action='store', dest='rdf_url',
                                    default='http://localhost:9999/bigdata/namespace/wdq/sparql',
                                    help='Host URL to upload data. Default: %(default)s')
         parser_update.add_argument('--max-download', action='store', dest='change_size', default=5 * 1024, type=int,
                                    help='Maxium size in kB for changes to download at once (default: %(default)s)')
+        parser_update.add_argument('--replay-report', action='store', dest='replay_report', default=None,
+                                   help='When replaying local diffs, save per-seqid timings to this CSV file')
         parser_update.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', default=False,
                                    help='Do not modify RDF database.')
 
@@ -77,6 +91,10 @@ class Osm2rdf(object):
             if opts.cacheFile and not os.path.isfile(opts.cacheFile):
                 self.parse_fail(parser, 'Node cache file does not exist. Was it specified during the "parse" phase?')
 
+        if opts.metrics_port:
+            start_metrics_server(opts.metrics_port)
+            self.log.info(f'Serving metrics on port {opts.metrics_port}')
+
         self.options = opts
         getattr(self, opts.command)()
 
@@ -88,13 +106,35 @@ class Osm2rdf(object):
 
     def parse(self):
         input_file = self.options.input_file
+        profiler = self.start_profiler()
         with RdfFileHandler(self.options) as handler:
+            if profiler:
+                profiler.instrument_handler(handler)
             handler.run(input_file)
+        self.stop_profiler(profiler)
         self.log.info('done')
 
     def update(self):
-        with RdfUpdateHandler(self.options) as handler:
-            handler.run()
+        profiler = self.start_profiler()
+        try:
+            with RdfUpdateHandler(self.options) as handler:
+                if profiler:
+                    profiler.instrument_handler(handler)
+                handler.run()
+        finally:
+            self.stop_profiler(profiler)
+
+    def start_profiler(self):
+        if not self.options.profile:
+            return None
+        clear_profiles(self.options.profile)
+        return Profiler('main', self.options.profile, self.options.profile_sample_rate).start()
+
+    def stop_profiler(self, profiler):
+        if profiler:
+            profiler.dump()
+            for line in merge_profiles(self.options.profile, self.options.profile_per_process):
+                self.log.info(line)
 
 
 if __name__ == '__main__':
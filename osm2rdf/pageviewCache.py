@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import metrics
+
+log = logging.getLogger('osm2rdf')
+
+CHUNK_SIZE = 256 * 1024
+
+cache_counter = metrics.counter('osm2rdf_pageviews_cache_total', 'Pageview file cache lookups', ['result'])
+cache_bytes_gauge = metrics.gauge('osm2rdf_pageviews_cache_bytes', 'Size of the pageview file cache')
+
+
+class PageviewMissing(Exception):
+    """The file is not available (yet), not an error"""
+    pass
+
+
+class PageviewError(Exception):
+    pass
+
+
+class PageviewCache:
+    """
+    Streams compressed hourly pageview files, keeping a copy of each downloaded file in cache_dir.
+    Partially downloaded files are kept as .part and resumed with an HTTP Range request, and every
+    completed download is validated against the md5sums.txt published next to the dumps.
+    When the cache exceeds max_bytes, the least recently used files are deleted.
+    In offline mode only the cached files are used, without any network access.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None, offline=False):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.md5sums = {}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        elif offline:
+            raise ValueError('Offline mode requires a cache directory')
+
+    async def read(self, session, url):
+        """Async generator of the compressed file content"""
+        if not self.cache_dir:
+            async with session.get(url) as response:
+                self.check_status(response, url)
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    yield chunk
+            return
+
+        filename = self.cache_dir / url.rsplit('/', 1)[1]
+        if filename.is_file():
+            cache_counter.labels('hit').inc()
+            os.utime(filename)  # mark as recently used
+            for chunk in self.read_file(filename):
+                yield chunk
+            return
+
+        if self.offline:
+            cache_counter.labels('offline_miss').inc()
+            raise PageviewMissing(f'{filename.name} is not in the cache')
+
+        cache_counter.labels('miss').inc()
+        expected = await self.get_md5(session, url)
+        part = filename.with_name(filename.name + '.part')
+        offset = part.stat().st_size if part.is_file() else 0
+        md5 = hashlib.md5()
+
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        async with session.get(url, headers=headers) as response:
+            if offset and response.status in (206, 416):
+                # Resuming - the beginning of the file is already on disk. 416 means it was complete.
+                log.info(f'Resuming {url} from {offset:,} bytes')
+                for chunk in self.read_file(part):
+                    md5.update(chunk)
+                    yield chunk
+            else:
+                self.check_status(response, url)
+                offset = 0
+            if response.status != 416:
+                with part.open('ab' if offset else 'wb') as file:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        file.write(chunk)
+                        md5.update(chunk)
+                        yield chunk
+
+        if expected and md5.hexdigest() != expected:
+            part.unlink()
+            raise PageviewError(f'Checksum mismatch for {url}: expected {expected}, got {md5.hexdigest()}')
+        os.replace(part, filename)
+        self.evict()
+
+    @staticmethod
+    def check_status(response, url):
+        if response.status == 404:
+            raise PageviewMissing(f'{url} is not available yet')
+        if response.status != 200:
+            raise PageviewError(f'{url} returned {response.status} {response.reason}')
+
+    @staticmethod
+    def read_file(filename):
+        with open(filename, 'rb') as file:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def get_md5(self, session, url):
+        md5_url, name = url.rsplit('/', 1)
+        md5_url += '/md5sums.txt'
+        if name not in self.md5sums.get(md5_url, {}):
+            # Checksums are published together with the files, so reload them whenever a new file is needed
+            try:
+                async with session.get(md5_url) as response:
+                    self.check_status(response, md5_url)
+                    text = await response.text()
+                self.md5sums[md5_url] = {v[1]: v[0] for v in (line.split() for line in text.splitlines())
+                                         if len(v) == 2}
+            except Exception as err:
+                log.warning(f'Unable to get checksums from {md5_url}, not validating {name}: {err}')
+                return None
+        result = self.md5sums[md5_url].get(name)
+        if result is None:
+            log.warning(f'{md5_url} has no checksum for {name}, not validating it')
+        return result
+
+    def evict(self):
+        files = [(f.stat(), f) for f in self.cache_dir.glob('*.gz')]
+        total = sum(st.st_size for st, _ in files)
+        if self.max_bytes:
+            for st, filename in sorted(files, key=lambda v: v[0].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                log.info(f'Removing {filename.name} from the cache')
+                filename.unlink()
+                total -= st.st_size
+        cache_bytes_gauge.set(total)
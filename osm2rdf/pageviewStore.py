@@ -0,0 +1,259 @@
+import datetime as dt
+import json
+import logging
+import mmap
+import os
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+HOUR_FORMAT = '%Y%m%d-%H'
+
+log = logging.getLogger('osm2rdf')
+
+
+class MappedArray:
+    """Memory-mapped array of unsigned 64-bit integers stored in a file, grows as needed"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        if not os.path.isfile(filename):
+            with open(filename, 'wb') as file:
+                file.truncate(1024 * 8)
+        self.file = open(filename, 'r+b')
+        self._map()
+
+    def _map(self):
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        self.values = memoryview(self.mmap).cast('Q')
+
+    def _unmap(self):
+        self.values.release()
+        self.mmap.close()
+
+    def ensure(self, length):
+        current = len(self.values)
+        if length > current:
+            self._unmap()
+            self.file.truncate(max(length, current * 2) * 8)
+            self._map()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, item):
+        return self.values[item]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.flush()
+        self._unmap()
+        self.file.close()
+
+
+class PageviewStore:
+    """
+    Local storage of hourly pageview counts, used to compute rolling windows of pageviews.
+
+    Every sitelink is interned as a small integer ID (sitelinks.txt, line number = ID). Each hour is stored
+    in hours/<hour>.bin as two columns - sitelink IDs and counts. For each window, the totals are kept in a
+    memory-mapped array indexed by sitelink ID, and updated incrementally - by adding the hours that entered
+    the window and subtracting the ones that left it. Another array per output predicate mirrors the values
+    that have been written to the database, so that only the changed totals need to be uploaded.
+
+    The state is marked as dirty before the totals are modified, and hour files are only deleted once the new
+    state has been saved. If the process is stopped during an update, the totals are recomputed on the next start
+    from the hour files of the included hours.
+    """
+
+    def __init__(self, directory, windows=(7, 30, 365)):
+        self.directory = Path(directory)
+        self.hours_dir = self.directory / 'hours'
+        os.makedirs(self.hours_dir, exist_ok=True)
+        self.windows = sorted(windows)
+
+        self.names = []
+        self.ids = {}
+        sitelinks_file = self.directory / 'sitelinks.txt'
+        if sitelinks_file.is_file():
+            with sitelinks_file.open(encoding='utf-8') as file:
+                for line in file:
+                    self.ids[line.rstrip('\n')] = len(self.names)
+                    self.names.append(line.rstrip('\n'))
+        self.sitelinks_file = sitelinks_file.open('a', encoding='utf-8')
+
+        self.state_file = self.directory / 'state.json'
+        if self.state_file.is_file():
+            with self.state_file.open() as file:
+                self.state = json.load(file)
+        else:
+            self.state = {'latest': None, 'included': {}, 'cleaned': [], 'dirty': False}
+        for window in self.windows:
+            self.state['included'].setdefault(str(window), [])
+
+        self.totals = {w: MappedArray(self.directory / f'window-{w}d.bin') for w in self.windows}
+        # Output predicate -> (window, array of the values stored in the database)
+        # pvstat: without a suffix mirrors the longest window, for the existing queries
+        self.outputs = {f'pvstat:{w}d': (w, MappedArray(self.directory / f'written-{w}d.bin')) for w in self.windows}
+        self.outputs['pvstat:'] = (self.windows[-1], MappedArray(self.directory / 'written.bin'))
+        if self.state.get('dirty'):
+            self.rebuild_totals()
+
+    @property
+    def latest(self):
+        latest = self.state['latest']
+        return datetime.strptime(latest, HOUR_FORMAT).replace(tzinfo=dt.timezone.utc) if latest else None
+
+    def intern(self, sitelink):
+        result = self.ids.get(sitelink)
+        if result is None:
+            result = len(self.names)
+            self.ids[sitelink] = result
+            self.names.append(sitelink)
+            self.sitelinks_file.write(sitelink + '\n')
+        return result
+
+    def hour_file(self, key):
+        return self.hours_dir / (key + '.bin')
+
+    def write_hour(self, key, counts):
+        pairs = sorted((self.intern(sitelink), count) for sitelink, count in counts.items())
+        ids = array('I', (v[0] for v in pairs))
+        values = array('I', (v[1] for v in pairs))
+        self.sitelinks_file.flush()
+        tmp = self.hour_file(key + '.tmp')
+        with tmp.open('wb') as file:
+            file.write(len(ids).to_bytes(8, 'little'))
+            ids.tofile(file)
+            values.tofile(file)
+        os.replace(tmp, self.hour_file(key))
+
+    def read_hour(self, key):
+        with self.hour_file(key).open('rb') as file:
+            count = int.from_bytes(file.read(8), 'little')
+            ids = array('I')
+            ids.fromfile(file, count)
+            values = array('I')
+            values.fromfile(file, count)
+        return ids, values
+
+    def apply_hour(self, window, key, sign):
+        try:
+            ids, values = self.read_hour(key)
+        except FileNotFoundError:
+            log.warning(f'Pageviews of {key} are missing, ignoring them in the {window}d window')
+            return
+        totals = self.totals[window]
+        totals.ensure(len(self.names))
+        for sitelink_id, count in zip(ids, values):
+            totals[sitelink_id] += sign * count
+
+    def add_hour(self, hour, counts):
+        """Store the counts for the given hour and update all windows"""
+        key = hour.strftime(HOUR_FORMAT)
+        self.mark_dirty()
+        # Re-processing the same hour replaces its previous counts
+        for window in self.windows:
+            included = self.state['included'][str(window)]
+            if key in included:
+                self.apply_hour(window, key, -1)
+                included.remove(key)
+        self.write_hour(key, counts)
+        if self.latest is None or hour > self.latest:
+            self.state['latest'] = key
+        self.update_windows()
+
+    def update_windows(self):
+        latest = self.latest
+        if latest is None:
+            return
+        available = {f.stem for f in self.hours_dir.glob('*.bin') if '.' not in f.stem}
+        previous = {}
+        for window in self.windows:
+            first = (latest - dt.timedelta(days=window)).strftime(HOUR_FORMAT)
+            last = latest.strftime(HOUR_FORMAT)
+            previous[window] = set(self.state['included'][str(window)])
+            self.state['included'][str(window)] = sorted(key for key in available if first < key <= last)
+        # Saving the new included hours first allows rebuild_totals() to recover if the update is interrupted
+        self.mark_dirty()
+        for window in self.windows:
+            desired = set(self.state['included'][str(window)])
+            for key in desired - previous[window]:
+                self.apply_hour(window, key, 1)
+            for key in previous[window] - desired:
+                self.apply_hour(window, key, -1)
+        self.state['dirty'] = False
+        self.save_state()
+
+        # Hours outside of the longest window are no longer needed
+        oldest = (latest - dt.timedelta(days=self.windows[-1])).strftime(HOUR_FORMAT)
+        for key in available:
+            if key <= oldest:
+                self.hour_file(key).unlink()
+
+    def mark_dirty(self):
+        self.state['dirty'] = True
+        self.save_state()
+
+    def rebuild_totals(self):
+        """Recomputes all window totals from the hour files, after an update was interrupted"""
+        log.warning('The previous pageview store update was interrupted, recomputing window totals')
+        for window in self.windows:
+            totals = self.totals[window]
+            totals.values[:] = memoryview(bytes(len(totals) * 8)).cast('Q')
+            for key in self.state['included'][str(window)]:
+                self.apply_hour(window, key, 1)
+        self.state['dirty'] = False
+        self.save_state()
+
+    def save_state(self):
+        for totals in self.totals.values():
+            totals.flush()
+        for _, written in self.outputs.values():
+            written.flush()
+        tmp = self.state_file.with_name(self.state_file.name + '.tmp')
+        with tmp.open('w') as file:
+            json.dump(self.state, file)
+        os.replace(tmp, self.state_file)
+
+    def changes(self, block=4096):
+        """Yields (predicate, sitelink ID, value in the database, new value) for every total that has changed"""
+        for predicate, (window, written) in self.outputs.items():
+            totals = self.totals[window]
+            totals.ensure(len(self.names))
+            written.ensure(len(self.names))
+            for start in range(0, len(self.names), block):
+                end = min(start + block, len(self.names))
+                if totals[start:end] == written[start:end]:
+                    continue
+                for sitelink_id in range(start, end):
+                    if totals[sitelink_id] != written[sitelink_id]:
+                        yield predicate, sitelink_id, written[sitelink_id], totals[sitelink_id]
+
+    def mark_written(self, changes):
+        for predicate, sitelink_id, _, value in changes:
+            self.outputs[predicate][1][sitelink_id] = value
+
+    def uncleaned_predicates(self):
+        """Predicates that might still have values in the database not written by this store"""
+        return [p for p in self.outputs if p not in self.state['cleaned']]
+
+    def mark_cleaned(self, predicates):
+        for predicate in predicates:
+            written = self.outputs[predicate][1]
+            written.values[:] = memoryview(bytes(len(written) * 8)).cast('Q')
+            self.state['cleaned'].append(predicate)
+        self.save_state()
+
+    def close(self):
+        self.save_state()
+        for totals in self.totals.values():
+            totals.close()
+        for _, written in self.outputs.values():
+            written.close()
+        self.sitelinks_file.close()
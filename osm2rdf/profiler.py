@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import pstats
+import signal
+import time
+from collections import defaultdict
+from pathlib import Path
+
+log = logging.getLogger('osm2rdf')
+
+
+class Profiler:
+    """
+    Per-stage timers for the parsing pipeline, plus an optional sampling profiler.
+    Each process (main and every writer) has its own instance, and dumps its results into a shared
+    directory as <name>.json (wall time), <name>.prof (stage times in the pstats format) and <name>.collapsed.
+    Stage times are exclusive - time spent in a nested stage is not counted towards the outer one,
+    so all stages add up to the wall time.
+    """
+
+    def __init__(self, name, output_dir, sample_rate=0):
+        self.name = name
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        # stage -> [calls, inclusive seconds, exclusive seconds]
+        self.stages = {}
+        self.stacks = defaultdict(int)
+        self._child = 0.0
+        self._started = None
+        self.wall = 0.0
+
+    def wrap(self, stage, func):
+        func = getattr(func, '__wrapped__', func)
+        stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            outer_child = self._child
+            self._child = 0.0
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += elapsed - self._child
+                self._child = outer_child + elapsed
+
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def patch(self, obj, names, prefix=''):
+        """Replace methods or module functions with timed versions. The stage name is prefix + method name"""
+        for name in names:
+            setattr(obj, name, self.wrap(prefix + name, getattr(obj, name)))
+
+    def proxy(self, obj, names, prefix=''):
+        """Returns an object that times the given methods of obj, for objects that cannot be patched"""
+        return _Proxy(obj, {name: self.wrap(prefix + name, getattr(obj, name)) for name in names})
+
+    def instrument_handler(self, handler):
+        import osmutils
+        self.patch(handler, ['node', 'way', 'relation'], 'callback.')
+        self.patch(handler, ['parse_tags', 'finalize_object', 'flush'])
+        handler.wkbfab = self.proxy(handler.wkbfab, ['create_point', 'create_linestring'], 'geometry.')
+        self.patch(osmutils, ['toStrings'])
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.sample_rate > 0:
+            signal.signal(signal.SIGPROF, self._sample)
+            interval = 1.0 / self.sample_rate
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        return self
+
+    def stop(self):
+        if self.sample_rate > 0:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        if self._started is not None:
+            self.wall += time.perf_counter() - self._started
+            self._started = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def create_stats(self):
+        # Called by pstats.Stats(self). Each stage is stored like a builtin function, with ('~', 0, stage) as key
+        self.stats = {('~', 0, stage): (calls, calls, own, total, {})
+                      for stage, (calls, total, own) in self.stages.items() if calls}
+
+    def dump(self):
+        self.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, self.name + '.json'), 'w') as file:
+            json.dump({'name': self.name, 'wall': self.wall}, file)
+        if any(calls for calls, _, _ in self.stages.values()):
+            pstats.Stats(self).dump_stats(os.path.join(self.output_dir, self.name + '.prof'))
+        if self.stacks:
+            with open(os.path.join(self.output_dir, self.name + '.collapsed'), 'w') as file:
+                for stack, count in sorted(self.stacks.items()):
+                    print(f'{stack} {count}', file=file)
+
+
+class _Proxy:
+    def __init__(self, obj, methods):
+        self.__dict__.update(methods)
+        self._obj = obj
+
+    def __getattr__(self, item):
+        return getattr(self._obj, item)
+
+
+def clear_profiles(output_dir):
+    for pattern in ('*.json', '*.prof', '*.collapsed', 'report.txt'):
+        for filename in Path(output_dir).glob(pattern):
+            filename.unlink()
+
+
+def merge_profiles(output_dir, per_process=False):
+    """
+    Combine the stage times of all processes in output_dir with pstats, and save the total per stage into
+    report.txt, followed by a table for each process if per_process is set. Collapsed stacks are merged into
+    merged.collapsed. Returns the report lines.
+    """
+    output_dir = Path(output_dir)
+    processes = []
+    for filename in sorted(output_dir.glob('*.json')):
+        with filename.open() as file:
+            proc = json.load(file)
+        # pstats cannot load an empty profile, so it is not saved by processes without any timed calls
+        prof = filename.with_suffix('.prof')
+        proc['stats'] = pstats.Stats(str(prof)) if prof.is_file() else pstats.Stats()
+        processes.append(proc)
+
+    total = pstats.Stats()
+    for proc in processes:
+        total.add(proc['stats'])
+    wall = sum(proc['wall'] for proc in processes)
+    lines = [f'all {len(processes)} processes: {wall:.2f}s wall time']
+    lines.extend(_stage_table(total, wall))
+    if per_process:
+        for proc in processes:
+            lines.append(f'{proc["name"]}: {proc["wall"]:.2f}s wall time')
+            lines.extend(_stage_table(proc['stats'], proc['wall']))
+
+    with (output_dir / 'report.txt').open('w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    with (output_dir / 'merged.collapsed').open('w') as merged:
+        for filename in sorted(output_dir.glob('*.collapsed')):
+            if filename.name == 'merged.collapsed':
+                continue
+            with filename.open() as file:
+                for line in file:
+                    merged.write(filename.stem + ';' + line)
+
+    return lines
+
+
+def _stage_table(stats, wall):
+    # pstats keys stages as ('~', 0, stage), and stores (calls, calls, self seconds, total seconds, callers)
+    rows = sorted(((key[2], v[1], v[3], v[2]) for key, v in stats.stats.items()), key=lambda v: -v[3])
+    attributed = sum(v[3] for v in rows)
+    rows.append(('(unattributed)', 0, max(0.0, wall - attributed), max(0.0, wall - attributed)))
+    lines = [f'  {"stage":28} {"calls":>12} {"total s":>10} {"self s":>10} {"self %":>7}']
+    for stage, calls, total, own in rows:
+        lines.append(f'  {stage:28} {calls:12,} {total:10.2f} {own:10.2f} {own / wall if wall else 0:7.1%}')
+    return lines
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Copyright Yuri Astrakhan <YuriAstrakhan@gmail.com>
+
+import argparse
+import logging
+import os
+from collections import namedtuple
+from pathlib import Path
+from urllib.parse import urlparse
+
+from osmium.replication.server import ReplicationServer
+
+from utils import parse_date
+
+State = namedtuple('State', ['sequence', 'timestamp'])
+
+
+def replication_path(directory, seqid, suffix):
+    seq = f'{seqid:09}'
+    return os.path.join(directory, seq[0:3], seq[3:6], seq[6:9] + suffix)
+
+
+def write_state(filename, seqid, timestamp):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as file:
+        file.write(f'sequenceNumber={seqid}\n')
+        file.write(f'timestamp={timestamp:%Y-%m-%dT%H\\:%M\\:%SZ}\n')
+
+
+def read_state(filename):
+    values = {}
+    with open(filename) as file:
+        for line in file:
+            if '=' in line and not line.startswith('#'):
+                key, value = line.strip().split('=', 1)
+                values[key] = value.replace('\\', '')
+    return State(int(values['sequenceNumber']), parse_date(values['timestamp']))
+
+
+class LocalReplicationServer:
+    """
+    Reads diffs from a local directory with the replication server layout (e.g. created by this script),
+    implementing the subset of the ReplicationServer API used by RdfUpdateHandler.
+    """
+
+    def __init__(self, url, diff_type='osc.gz'):
+        self.directory = urlparse(url).path if url.startswith('file://') else url
+        self.diff_type = diff_type
+
+    def get_state_info(self, seq=None):
+        filename = os.path.join(self.directory, 'state.txt') if seq is None \
+            else replication_path(self.directory, seq, '.state.txt')
+        try:
+            return read_state(filename)
+        except FileNotFoundError:
+            return None
+
+    def get_diff_block(self, seq):
+        with open(replication_path(self.directory, seq, '.' + self.diff_type), 'rb') as file:
+            return file.read()
+
+    def timestamp_to_sequence(self, timestamp):
+        last = self.get_state_info()
+        if last is None:
+            return None
+        seqid = last.sequence
+        while seqid > 0:
+            state = self.get_state_info(seqid - 1)
+            if state is None or state.timestamp < timestamp:
+                break
+            seqid -= 1
+        return seqid
+
+
+def make_replication_server(url):
+    if url.startswith('file://'):
+        return LocalReplicationServer(url)
+    return ReplicationServer(url)
+
+
+class ReplicationMirror(object):
+    def __init__(self):
+
+        self.log = logging.getLogger('osm2rdf')
+        self.log.setLevel(logging.INFO)
+
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.log.addHandler(ch)
+
+        parser = argparse.ArgumentParser(
+            description='Copies a range of replication diffs into a local directory, so that they can be '
+                        'replayed with  osm2rdf.py update --update-url file://<dir>',
+            usage='python3 %(prog)s [options] output_dir'
+        )
+
+        parser.add_argument('output_dir', help='Directory to store the diffs')
+        parser.add_argument('--update-url', action='store', dest='osm_updater_url',
+                            default='http://planet.openstreetmap.org/replication/minute',
+                            help='Source of the minute data. Default: %(default)s')
+        parser.add_argument('--start', action='store', dest='start', type=int, required=True,
+                            help='First sequence ID to copy')
+        parser.add_argument('--end', action='store', dest='end', type=int, default=None,
+                            help='Last sequence ID to copy (inclusive). By default, the latest available')
+        opts = parser.parse_args()
+
+        repserv = ReplicationServer(opts.osm_updater_url)
+        end = opts.end
+        if end is None:
+            end = repserv.get_state_info().sequence
+
+        output = Path(opts.output_dir)
+        self.log.info(f'Copying {end - opts.start + 1} diffs #{opts.start}..#{end} into {output}')
+        last_state = None
+        for seqid in range(opts.start, end + 1):
+            diff_file = replication_path(output, seqid, '.' + repserv.diff_type)
+            state_file = replication_path(output, seqid, '.state.txt')
+            if os.path.isfile(diff_file) and os.path.isfile(state_file):
+                last_state = read_state(state_file)
+                continue
+            state = repserv.get_state_info(seqid)
+            if state is None:
+                self.log.error(f'Unable to get state #{seqid}, stopping')
+                break
+            data = repserv.get_diff_block(seqid)
+            os.makedirs(os.path.dirname(diff_file), exist_ok=True)
+            with open(diff_file + '.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(diff_file + '.tmp', diff_file)
+            write_state(state_file, state.sequence, state.timestamp)
+            last_state = state
+            self.log.info(f'#{seqid} {state.timestamp}  {len(data):,} bytes')
+
+        if last_state:
+            write_state(str(output / 'state.txt'), last_state.sequence, last_state.timestamp)
+        self.log.info('done')
+
+
+if __name__ == '__main__':
+    ReplicationMirror()
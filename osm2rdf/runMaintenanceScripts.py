@@ -2,15 +2,89 @@
 
 # Copyright Yuri Astrakhan <YuriAstrakhan@gmail.com>
 
+import json
 import logging
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 import argparse
 import time
 from pathlib import Path
 
+import metrics
 from sparql import Sparql
 
+log = logging.getLogger('osm2rdf')
+
+runs_counter = metrics.counter('osm2rdf_maintenance_runs_total', 'Maintenance script runs', ['script', 'status'])
+duration_gauge = metrics.gauge('osm2rdf_maintenance_duration_seconds', 'Duration of the last run', ['script'])
+rows_gauge = metrics.gauge('osm2rdf_maintenance_rows', 'Rows changed by the last run', ['script'])
+running_gauge = metrics.gauge('osm2rdf_maintenance_running', 'Maintenance scripts currently running')
+
+TEST_SUFFIX = '-test'
+HEADER_RE = re.compile(r'^#\s*@\s*([a-z_]+)\s*:\s*(.*?)\s*$')
+SIDECAR_RE = re.compile(r'^\s*([a-z_]+)\s*:\s*(.*?)\s*$')
+MUTATION_RE = re.compile(r'mutationCount=(\d+)')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """Parses '90', '90s', '15m', '6h' or '1d' into seconds"""
+    value = value.strip().lower()
+    if value and value[-1] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+
+@dataclass
+class Script:
+    """
+    A maintenance query with its schedule. Settings are read from "#@ key: value" comment lines
+    in the query, or from a <name>.meta sidecar file with the same "key: value" lines, e.g.
+        #@ interval: 6h
+        #@ timeout: 30m
+        #@ concurrency: 1
+        #@ priority: 10
+    Scripts with a lower priority value are started first when several are due.
+    """
+    name: str
+    query: str
+    test: str = None
+    interval: float = 600
+    timeout: float = None
+    concurrency: int = 1
+    priority: int = 0
+    mtime: float = 0
+    running: int = 0
+    last_start: float = 0
+    durations: list = field(default_factory=list)
+
+    def configure(self, lines, source, pattern=HEADER_RE):
+        for line in lines:
+            m = pattern.match(line)
+            if not m:
+                continue
+            key, value = m.groups()
+            try:
+                if key == 'interval':
+                    self.interval = parse_duration(value)
+                elif key == 'timeout':
+                    self.timeout = parse_duration(value)
+                elif key == 'concurrency':
+                    self.concurrency = max(1, int(value))
+                elif key == 'priority':
+                    self.priority = int(value)
+                else:
+                    log.warning(f'{source}: unknown setting {key}')
+            except ValueError:
+                log.warning(f'{source}: invalid value for {key}: {value}')
+
+    def is_due(self, now):
+        return self.running < self.concurrency and now >= self.last_start + self.interval
+
 
 class SparqlMaintainer(object):
     def __init__(self):
@@ -24,7 +98,7 @@ class SparqlMaintainer(object):
 
         # create the top-level parser
         parser = argparse.ArgumentParser(
-            description='Download and update stats',
+            description='Periodically run SPARQL maintenance scripts',
             usage='python3 %(prog)s [options]'
         )
 
@@ -33,39 +107,150 @@ class SparqlMaintainer(object):
                             help='Host URL to upload data. Default: %(default)s')
         parser.add_argument('-d', '--queries-dir', action='store', dest='queries_dir',
                             default=str(Path(os.path.dirname(__file__)) / 'maintenance'),
-                            help='Do not modify RDF database.')
+                            help='Directory with the *.sparql maintenance scripts. Default: %(default)s')
+        parser.add_argument('--history', action='store', dest='history',
+                            default=str(Path(os.path.dirname(__file__)) / 'maintenance-history.jsonl'),
+                            help='File to record the duration and changed rows of every run. Default: %(default)s')
+        parser.add_argument('--max-concurrent', action='store', dest='max_concurrent', type=int, default=2,
+                            help='Maximum number of scripts running at the same time. Default: %(default)s')
+        parser.add_argument('--default-interval', action='store', dest='default_interval', type=parse_duration,
+                            default=600,
+                            help='Seconds between runs of scripts that do not set an interval. Default: %(default)s')
+        parser.add_argument('--tick', action='store', dest='tick', type=float, default=10,
+                            help='Seconds between checks for due scripts. Default: %(default)s')
         parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', default=False,
                             help='Do not modify RDF database.')
+        metrics.add_metrics_argument(parser)
         opts = parser.parse_args()
 
         self.options = opts
         self.rdf_server = Sparql(opts.rdf_url, opts.dry_run)
+        if opts.metrics_port:
+            metrics.start_metrics_server(opts.metrics_port)
 
-    def run(self):
-        dir = Path(self.options.queries_dir)
-        self.log.info(f'Running scripts from {dir}')
-        while True:
-            queries = {}
-            for file in dir.glob('*.sparql'):
-                with file.open() as f:
-                    queries[file.stem] = f.read()
-
-            suffix = '-test'
-            for filename in sorted(queries.keys()):
-                if filename.endswith(suffix):
-                    if filename[:-len(suffix)] not in queries:
-                        self.log.warning(f'File {filename} has no matching query (without the "{suffix}" suffix)')
+        self.scripts = {}
+        self.lock = threading.Lock()
+        self.load_history()
+
+    def load_history(self):
+        """Restore the last start time of every script, so that a restart does not run everything at once"""
+        self.last_starts = {}
+        self.history_durations = {}
+        if not os.path.isfile(self.options.history):
+            return
+        with open(self.options.history) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
                     continue
-                testfile = filename + suffix
-                if testfile in queries:
-                    if not self.rdf_server.run('query', queries[testfile]):
-                        self.log.info(f'Skipping {filename} (test is negative)')
-                        continue
-                self.log.info(f'Executing {filename}')
-                self.rdf_server.run('update', queries[filename])
-                self.log.info(f'Done running {filename}')
-
-            time.sleep(600)
+                self.last_starts[entry['script']] = entry['start']
+                if entry['status'] == 'ok':
+                    self.history_durations.setdefault(entry['script'], []).append(entry['duration'])
+        self.log.info(f'Loaded run history of {len(self.last_starts)} scripts from {self.options.history}')
+
+    def record(self, entry):
+        try:
+            with open(self.options.history, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+        except OSError as err:
+            self.log.warning(f'Unable to write history to {self.options.history}: {err}')
+
+    def load_scripts(self):
+        """(Re)load scripts whose query or sidecar file has changed, keeping their run state"""
+        directory = Path(self.options.queries_dir)
+        files = {f.stem: f for f in directory.glob('*.sparql')}
+        for name in list(self.scripts):
+            if name not in files:
+                self.log.info(f'Script {name} was removed')
+                del self.scripts[name]
+
+        for name, file in sorted(files.items()):
+            if name.endswith(TEST_SUFFIX):
+                if name[:-len(TEST_SUFFIX)] not in files:
+                    self.log.warning(f'File {name} has no matching query (without the "{TEST_SUFFIX}" suffix)')
+                continue
+            test_file = files.get(name + TEST_SUFFIX)
+            meta_file = file.with_suffix('.meta')
+            mtime = max(f.stat().st_mtime for f in (file, test_file, meta_file) if f and f.exists())
+            old = self.scripts.get(name)
+            if old and old.mtime == mtime:
+                continue
+
+            script = Script(name, file.read_text(), interval=self.options.default_interval, mtime=mtime)
+            if test_file:
+                script.test = test_file.read_text()
+            script.configure(script.query.splitlines(), file.name)
+            if meta_file.exists():
+                script.configure(meta_file.read_text().splitlines(), meta_file.name, SIDECAR_RE)
+            if old:
+                # Update the existing object in place, a running execute() still holds it
+                with self.lock:
+                    old.query, old.test, old.mtime = script.query, script.test, script.mtime
+                    old.interval, old.timeout = script.interval, script.timeout
+                    old.concurrency, old.priority = script.concurrency, script.priority
+                script = old
+            else:
+                script.last_start = self.last_starts.get(name, 0)
+                script.durations = self.history_durations.get(name, [])[-10:]
+                self.scripts[name] = script
+            self.log.info(f'{"Reloaded" if old else "Loaded"} {name}: every {script.interval:.0f}s, '
+                          f'timeout {script.timeout or "none"}, concurrency {script.concurrency}, '
+                          f'priority {script.priority}')
+
+    def run(self):
+        self.log.info(f'Running scripts from {self.options.queries_dir}')
+        with ThreadPoolExecutor(self.options.max_concurrent) as executor:
+            while True:
+                self.load_scripts()
+                now = time.time()
+                with self.lock:
+                    running = sum(s.running for s in self.scripts.values())
+                    # Most urgent first: lowest priority value, then the longest overdue
+                    due = sorted((s for s in self.scripts.values() if s.is_due(now)),
+                                 key=lambda s: (s.priority, s.last_start + s.interval))
+                    slots = max(0, self.options.max_concurrent - running)
+                    for script in due[:slots]:
+                        script.running += 1
+                        script.last_start = now
+                        executor.submit(self.execute, script)
+                    for script in due[slots:]:
+                        self.log.debug(f'{script.name} is due, waiting for a free slot')
+                    running_gauge.set(running + len(due[:slots]))
+                time.sleep(self.options.tick)
+
+    def execute(self, script):
+        start = time.time()
+        entry = {'script': script.name, 'start': start, 'duration': 0, 'rows': None, 'status': 'ok'}
+        try:
+            if script.test and not self.rdf_server.run('query', script.test, script.timeout):
+                self.log.info(f'Skipping {script.name} (test is negative)')
+                entry['status'] = 'skipped'
+            else:
+                expected = sum(script.durations) / len(script.durations) if script.durations else None
+                self.log.info(f'Executing {script.name}' +
+                              (f', usually takes {expected:.1f}s' if expected is not None else ''))
+                result = self.rdf_server.run('update', script.query, script.timeout)
+                m = MUTATION_RE.search(result or '')
+                if m:
+                    entry['rows'] = int(m.group(1))
+                    rows_gauge.labels(script.name).set(entry['rows'])
+        except Exception as err:
+            entry['status'] = 'error'
+            entry['error'] = str(err)
+            self.log.error(f'{script.name} failed: {err}')
+        finally:
+            entry['duration'] = time.time() - start
+            with self.lock:
+                script.running -= 1
+                if entry['status'] == 'ok':
+                    script.durations = (script.durations + [entry['duration']])[-10:]
+            runs_counter.labels(script.name, entry['status']).inc()
+            duration_gauge.labels(script.name).set(entry['duration'])
+            self.record(entry)
+        if entry['status'] == 'ok':
+            rows = f', {entry["rows"]:,} rows changed' if entry['rows'] is not None else ''
+            self.log.info(f'Done running {script.name} in {entry["duration"]:.1f}s{rows}')
 
 
 if __name__ == '__main__':
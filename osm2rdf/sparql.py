@@ -1,22 +1,39 @@
+import time
+
 import requests
 
+import metrics
+
+request_seconds = metrics.histogram('osm2rdf_sparql_request_seconds', 'SPARQL request latency', ['type'])
+payload_bytes = metrics.histogram('osm2rdf_sparql_payload_bytes', 'SPARQL request size', ['type'],
+                                  metrics.SIZE_BUCKETS)
+request_errors = metrics.counter('osm2rdf_sparql_errors_total', 'Failed SPARQL requests', ['type'])
+
 
 class Sparql:
     def __init__(self, rdf_url, dry_run):
         self.rdf_url = rdf_url
         self.dry_run = dry_run
 
-    def run(self, queryType, sparql):
+    def run(self, queryType, sparql, timeout=None):
+        """Returns the bindings of a query, or the server's response text for an update"""
         if not self.dry_run or self.dry_run == queryType:
-            r = requests.post(self.rdf_url,
-                              data={queryType: sparql},
-                              headers={'Accept': 'application/sparql-results+json'})
+            payload_bytes.labels(queryType).observe(len(sparql.encode('utf-8')))
+            start = time.perf_counter()
+            headers = {'Accept': 'application/sparql-results+json'}
+            if timeout:
+                # Ask Blazegraph to abort the operation too, not just stop waiting for it
+                headers['X-BIGDATA-MAX-QUERY-MILLIS'] = str(int(timeout * 1000))
+            r = requests.post(self.rdf_url, data={queryType: sparql}, headers=headers, timeout=timeout)
             try:
                 if not r.ok:
+                    request_errors.labels(queryType).inc()
                     print(r.reason)
                     print(sparql)
                     raise Exception(r.reason)
                 if queryType == 'query':
                     return r.json()['results']['bindings']
+                return r.text
             finally:
+                request_seconds.labels(queryType).observe(time.perf_counter() - start)
                 r.close()
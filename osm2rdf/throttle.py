@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+
+import metrics
+
+log = logging.getLogger('osm2rdf')
+
+rate_gauge = metrics.gauge('osm2rdf_throttle_rate', 'Currently allowed SPARQL updates per second', ['name'])
+backoff_counter = metrics.counter('osm2rdf_throttle_backoffs_total', 'Times the update rate was reduced', ['name'])
+
+
+def add_throttle_arguments(parser):
+    parser.add_argument('--max-rate', action='store', dest='max_rate', type=float, default=10,
+                        help='Maximum number of SPARQL updates per second (default: %(default)s)')
+    parser.add_argument('--latency-target', action='store', dest='latency_target', type=float, default=5,
+                        help='Slow down when a SPARQL update takes longer than this many seconds '
+                             '(default: %(default)s)')
+
+
+class AdaptiveThrottle:
+    """
+    Paces a sequence of SPARQL updates based on how the server responds (additive increase,
+    multiplicative decrease). While updates finish within latency_target, the allowed rate grows by
+    rate_step updates per second after each one, up to max_rate. A slow update halves the rate, and
+    a failed one is retried after an exponentially growing pause, so a struggling server gets
+    progressively more breathing room.
+    """
+
+    def __init__(self, name, max_rate=10.0, latency_target=5.0, min_rate=0.01, initial_rate=1.0, rate_step=0.1,
+                 max_retries=6, max_backoff=600):
+        self.name = name
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.latency_target = latency_target
+        self.min_rate = min_rate
+        self.rate = min(initial_rate, max_rate)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.next_time = time.monotonic()
+        self.started = None
+        self.updates = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.failures = 0
+        rate_gauge.labels(name).set(self.rate)
+
+    @classmethod
+    def from_options(cls, name, opts):
+        return cls(name, opts.max_rate, opts.latency_target)
+
+    def run(self, func, *args, rows=0):
+        """Calls func(*args) when the current rate allows it, retrying on errors"""
+        attempt = 0
+        while True:
+            self.wait()
+            start = time.monotonic()
+            try:
+                result = func(*args)
+            except Exception as err:
+                attempt += 1
+                self.failures += 1
+                self.slow_down()
+                if attempt > self.max_retries:
+                    raise
+                pause = min(self.max_backoff, 2 ** attempt)
+                log.warning(f'{self.name}: update failed ({err}), retry #{attempt} in {pause}s')
+                time.sleep(pause)
+                continue
+            self.record(time.monotonic() - start, rows)
+            return result
+
+    async def run_async(self, func, *args, rows=0):
+        """Same as run(), for coroutine functions. Concurrent callers share the same rate"""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.reserve())
+            start = time.monotonic()
+            try:
+                result = await func(*args)
+            except Exception as err:
+                attempt += 1
+                self.failures += 1
+                self.slow_down()
+                if attempt > self.max_retries:
+                    raise
+                pause = min(self.max_backoff, 2 ** attempt)
+                log.warning(f'{self.name}: update failed ({err}), retry #{attempt} in {pause}s')
+                await asyncio.sleep(pause)
+                continue
+            self.record(time.monotonic() - start, rows)
+            return result
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+    def reserve(self):
+        """Reserves the next update slot, and returns how many seconds to wait for it"""
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        start = max(now, self.next_time)
+        self.next_time = start + 1 / self.rate
+        return start - now
+
+    def record(self, seconds, rows=0):
+        self.updates += 1
+        self.rows += rows
+        self.busy += seconds
+        if seconds > self.latency_target:
+            self.slow_down()
+        else:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+            rate_gauge.labels(self.name).set(self.rate)
+
+    def slow_down(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.next_time = time.monotonic() + 1 / self.rate
+        rate_gauge.labels(self.name).set(self.rate)
+        backoff_counter.labels(self.name).inc()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        if not elapsed or not self.updates:
+            return 'no updates yet'
+        return (f'{self.updates / elapsed:.2f} updates/s, {self.rows / elapsed:,.0f} rows/s, '
+                f'{self.busy / self.updates:.2f}s avg latency, {self.busy / elapsed:.0%} server busy, '
+                f'allowed rate {self.rate:.2f}/s, {self.failures} failures')
@@ -5,25 +5,144 @@
 import argparse
 import asyncio
 import datetime as dt
-import gzip
 import logging
-import time
+import os
+import zlib
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from hashlib import blake2b
+from pathlib import Path
+from urllib.parse import unquote
 
 import aiohttp
 # import async_timeout
 import re
 import shapely.speedups
 
-from utils import query_status, make_wiki_url, chunks, set_status_query
-from sparql import Sparql
+import metrics
+from throttle import AdaptiveThrottle, add_throttle_arguments
+from pageviewCache import PageviewCache, PageviewMissing
+from pageviewStore import PageviewStore
+from utils import status_query, parse_status, make_wiki_url, chunks, set_status_query
+from asyncSparql import AsyncSparql
 
 if shapely.speedups.available:
     shapely.speedups.enable()
 
 reWikiLanguage = re.compile(r'^[-a-z]+$')
 
+log = logging.getLogger('osm2rdf')
+
+# Decompressed data is split into blocks of about this size, and each block is parsed by a worker process
+BLOCK_SIZE = 8 * 1024 * 1024
+
+lag_gauge = metrics.gauge('osm2rdf_pageviews_lag_seconds', 'Age of the last pageview file stored in the database')
+files_counter = metrics.counter('osm2rdf_pageviews_files_total', 'Processed pageview files', ['result'])
+file_seconds = metrics.histogram('osm2rdf_pageviews_file_seconds', 'Time to download and parse one pageview file')
+pending_gauge = metrics.gauge('osm2rdf_pageviews_pending_stats', 'Changed pageview totals waiting to be saved')
+saved_counter = metrics.counter('osm2rdf_pageviews_saved_total', 'Pageview totals saved')
+sitelinks_gauge = metrics.gauge('osm2rdf_pageviews_known_sitelinks', 'Sitelinks used by the pageview filter')
+
+osmt_prefix = 'https://wiki.openstreetmap.org/wiki/Key:'
+reSitelink = re.compile(r'^https://([-a-z0-9]+)\.wikipedia\.org/wiki/(.+)$')
+
+
+class SitelinkFilter:
+    """
+    Compact set of (language, title) pairs that exist in the database, stored as a sorted array
+    of 64-bit hashes (8 bytes per sitelink). Lookups work on the raw bytes of a pageview line,
+    so that unknown pages are rejected before any decoding or URL quoting.
+    """
+
+    def __init__(self, hashes):
+        self.hashes = array('Q', sorted(set(hashes)))
+
+    @staticmethod
+    def hash(lang, title):
+        # lang and title are bytes, title uses underscores instead of spaces, same as the pageview dumps
+        return int.from_bytes(blake2b(lang + b':' + title, digest_size=8).digest(), 'little')
+
+    @classmethod
+    def from_urls(cls, urls):
+        hashes = []
+        for url in urls:
+            match = reSitelink.match(url)
+            if match:
+                title = unquote(match.group(2)).replace(' ', '_')
+                hashes.append(cls.hash(match.group(1).encode('utf-8'), title.encode('utf-8')))
+        return cls(hashes)
+
+    def __contains__(self, item):
+        value = self.hash(*item)
+        pos = bisect_left(self.hashes, value)
+        return pos < len(self.hashes) and self.hashes[pos] == value
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+# Set in each worker process by the pool initializer
+sitelink_filter = None
+
+
+def set_sitelink_filter(value):
+    global sitelink_filter
+    sitelink_filter = value
+
+
+def page_url(prefix, title):
+    parts = prefix.split('.', 1)
+
+    if len(parts) == 1:
+        site = '.wikipedia.org/wiki/'
+    # elif parts[1] == 'b':
+    #     site = '.wikibooks.org/wiki/'
+    # elif parts[1] == 'd':
+    #     site = '.wiktionary.org/wiki/'
+    # elif parts[1] == 'n':
+    #     site = '.wikinews.org/wiki/'
+    # elif parts[1] == 'q':
+    #     site = '.wikiquote.org/wiki/'
+    # elif parts[1] == 's':
+    #     site = '.wikisource.org/wiki/'
+    # elif parts[1] == 'v':
+    #     site = '.wikiversity.org/wiki/'
+    # elif parts[1] == 'voy':
+    #     site = '.wikivoyage.org/wiki/'
+    else:
+        return None
+
+    if not reWikiLanguage.match(parts[0]):
+        if parts[0] != 'test2':  # This is the only number-containing prefix so far
+            log.error(f'Skipping unexpected language prefix "{parts[0]}"')
+        return None
+
+    return make_wiki_url(parts[0], site, title)
+
+
+def parse_block(block):
+    """Runs in a worker process. Returns pageview counts per sitelink and the lines that could not be parsed"""
+    counts = defaultdict(int)
+    errors = []
+    known = sitelink_filter
+    for line in block.splitlines():
+        try:
+            if known is not None:
+                parts = line.split(b' ', 2)
+                if (parts[0], parts[1]) not in known:
+                    continue
+            parts = line.decode('utf-8', 'strict').split(' ')
+            url = page_url(parts[0], parts[1])
+            if url:
+                count = int(parts[2])
+                counts[url] += count
+        except:
+            errors.append(line)
+    return counts, errors
+
 
 class UpdatePageViewStats(object):
     def __init__(self):
@@ -51,10 +170,39 @@ class UpdatePageViewStats(object):
                             help='Go back up to (maxfiles) and exit')
         parser.add_argument('-m', '--maxfiles', action='store', dest='max_files', default=1, type=int,
                             help='Maximum number of pageview stat files to process at once')
+        parser.add_argument('-w', '--workers', action='store', dest='workers', default=os.cpu_count(), type=int,
+                            help='Number of processes parsing the pageview files (default: %(default)s)')
+        parser.add_argument('--no-sitelink-filter', action='store_false', dest='use_filter', default=True,
+                            help='Count pageviews of all pages, not just the ones linked from OSM wikipedia tags')
+        parser.add_argument('--cache-dir', action='store', dest='cache_dir', default=None,
+                            help='Keep downloaded pageview files in this directory, and resume partial downloads')
+        parser.add_argument('--cache-size', action='store', dest='cache_size', default=50, type=float,
+                            help='Maximum size of the cache directory in GB, least recently used files are deleted '
+                                 'first (default: %(default)s)')
+        parser.add_argument('--offline', action='store_true', dest='offline', default=False,
+                            help='Only use files in the --cache-dir without downloading anything, e.g. to quickly '
+                                 'reprocess history with --go-backwards')
+        parser.add_argument('--store-dir', action='store', dest='store_dir',
+                            default=str(Path(os.path.dirname(__file__)) / 'pageviews'),
+                            help='Directory with the hourly counts and window totals (default: %(default)s)')
+        parser.add_argument('--windows', action='store', dest='windows', default='7,30,365',
+                            help='Comma-separated sizes of the rolling windows in days, stored as pvstat:<n>d. '
+                                 'pvstat: has the same value as the longest one. (default: %(default)s)')
+        parser.add_argument('--max-concurrent', action='store', dest='max_concurrent', type=int, default=4,
+                            help='Maximum number of SPARQL requests running at the same time (default: %(default)s)')
+        add_throttle_arguments(parser)
+        metrics.add_metrics_argument(parser)
         opts = parser.parse_args()
+        if opts.offline and not opts.cache_dir:
+            parser.error('--offline requires --cache-dir')
+        if opts.metrics_port:
+            metrics.start_metrics_server(opts.metrics_port)
 
         self.options = opts
-        self.rdf_server = Sparql(opts.rdf_url, opts.dry_run)
+        self.throttle = AdaptiveThrottle.from_options('pageviews', opts)
+        self.store = PageviewStore(opts.store_dir, [int(v) for v in opts.windows.split(',')])
+        self.cache = PageviewCache(opts.cache_dir, int(opts.cache_size * 1024 ** 3), opts.offline)
+        self.rdf_server = AsyncSparql(opts.rdf_url, opts.dry_run, opts.max_concurrent)
         self.pvstat = '<https://dumps.wikimedia.org/other/pageviews/>'
         self.stats_url = 'https://dumps.wikimedia.org/other/pageviews/{0:%Y}/{0:%Y-%m}/pageviews-{0:%Y%m%d-%H}0000.gz'
 
@@ -64,42 +212,69 @@ class UpdatePageViewStats(object):
     async def run(self):
         backwards = self.options.go_backwards
         while True:
-            ver = query_status(self.rdf_server, self.pvstat)
+            ver = parse_status(await self.rdf_server.run('query', status_query(self.pvstat)))
             if ver is None:
                 self.log.info(f'schema:dateModified is not set for {self.pvstat}')
                 # Calculate last valid file. Assume current data will not be available for at least a few hours
                 ver = datetime.utcnow() + dt.timedelta(minutes=50) - dt.timedelta(hours=5)
                 ver = datetime(ver.year, ver.month, ver.day, ver.hour, tzinfo=dt.timezone.utc)
+            else:
+                lag_gauge.set((datetime.now(dt.timezone.utc) - ver).total_seconds())
             self.log.info(f'Processing {"backwards" if backwards else "forward"} from {ver}')
-            stats, timestamp = await self.process_files(ver, backwards)
-            if timestamp is not None and len(stats) > 0:
-                self.log.info(f'Updating {len(stats)} stats')
-                self.save_stats(stats, timestamp)
+            known = await self.load_sitelinks() if self.options.use_filter else None
+            timestamp = await self.process_files(ver, backwards, known)
+            if timestamp is not None:
+                await self.save_stats(timestamp)
             if backwards:
                 # Do a single iteration only
                 return
             self.log.info('Pausing...')
-            time.sleep(1000)
-
-    async def process_files(self, last_processed, backwards):
-        stats = defaultdict(int)
+            await asyncio.sleep(1000)
+
+    async def load_sitelinks(self):
+        # tagToStr() converts the values of all keys containing "wikipedia" (brand:wikipedia, subject:wikipedia, ...)
+        # into article IRIs, not just the ones of the wikipedia key.
+        # Blazegraph answers a distinct predicate query from its index, without visiting every statement.
+        result = await self.rdf_server.run('query', 'SELECT DISTINCT ?p WHERE { ?s ?p ?o }')
+        predicates = sorted(v['p']['value'] for v in result
+                            if v['p']['value'].startswith(osmt_prefix) and 'wikipedia' in v['p']['value'])
+        query = f'''# Get all wikipedia sitelinks
+SELECT DISTINCT ?sitelink WHERE {{
+  VALUES ?p {{ {' '.join(f'<{p}>' for p in predicates)} }}
+  ?s ?p ?sitelink .
+  FILTER (isIRI(?sitelink))
+}}'''
+        result = await self.rdf_server.run('query', query)
+        known = SitelinkFilter.from_urls(v['sitelink']['value'] for v in result)
+        sitelinks_gauge.set(len(known))
+        self.log.info(f'Loaded {len(known):,} sitelinks, ignoring pageviews of all other pages')
+        return known
+
+    async def process_files(self, last_processed, backwards, known=None):
+        """Adds the counts of each hour to the store as soon as its file is processed, returns the latest hour"""
         new_last = None
 
         conn = aiohttp.TCPConnector(limit=3)
         timeout = aiohttp.ClientTimeout(total=None, connect=None, sock_read=60, sock_connect=60)
-        async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
-            futures = []
-            for date in self.iterate_hours(last_processed, self.options.max_files, backwards):
-                futures.append(self.process_file(session, date, stats))
-            if futures:
-                done, _ = await asyncio.wait(futures)
-                for fut in done:
-                    date, ok = fut.result()
-                    # always find the latest possible timestamp even if going backwards
-                    if ok and (new_last is None or date > new_last):
-                        new_last = date
-
-        return stats, new_last
+        # Limit the number of blocks waiting to be parsed, so that the memory usage stays bounded
+        # no matter how many files are downloaded at once
+        blocks_limit = asyncio.Semaphore(self.options.workers * 2)
+        with ProcessPoolExecutor(max_workers=self.options.workers, initializer=set_sitelink_filter,
+                                 initargs=(known,)) as executor:
+            async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
+                futures = []
+                for date in self.iterate_hours(last_processed, self.options.max_files, backwards):
+                    futures.append(asyncio.ensure_future(
+                        self.process_file(session, executor, blocks_limit, date)))
+                if futures:
+                    done, _ = await asyncio.wait(futures)
+                    for fut in done:
+                        date, ok = fut.result()
+                        # always find the latest possible timestamp even if going backwards
+                        if ok and (new_last is None or date > new_last):
+                            new_last = date
+
+        return new_last
 
     def iterate_hours(self, last_processed, max_count, backwards=True):
         delta = dt.timedelta(hours=(-1 if backwards else 1))
@@ -115,90 +290,124 @@ class UpdatePageViewStats(object):
             done += 1
             current += delta
 
-    async def process_file(self, session, date, stats):
+    async def process_file(self, session, executor, blocks_limit, date):
         url = self.stats_url.format(date)
         try:
-            async with session.get(url) as response:
-                start = datetime.utcnow()
-                if response.status != 200:
-                    self.log.warning(f'Url {url} returned {response.status}')
-                    return date, False
-                for line in gzip.decompress(await response.read()).splitlines():
-                    try:
-                        parts = line.decode('utf-8', 'strict').split(' ')
-                        page_url = self.page_url(parts[0], parts[1])
-                        if page_url:
-                            stats[page_url] += int(parts[2])
-                    except:
-                        self.log.error(f'Error parsing {url} line "{line}"')
-                self.log.info(f'Finished processing {url} in {(datetime.utcnow() - start).total_seconds():.1f} seconds')
+            start = datetime.utcnow()
+            # Counts are stored only once the whole file has been processed,
+            # so that a failed download does not leave partial data behind
+            file_stats = defaultdict(int)
+            parsing = set()
+            async for block in self.iterate_blocks(self.cache.read(session, url)):
+                await blocks_limit.acquire()
+                task = asyncio.ensure_future(self.parse_block(executor, blocks_limit, block, url, file_stats))
+                parsing.add(task)
+                task.add_done_callback(parsing.discard)
+            if parsing:
+                await asyncio.gather(*parsing)
+            self.store.add_hour(date, file_stats)
+            seconds = (datetime.utcnow() - start).total_seconds()
+            self.log.info(f'Finished processing {url} in {seconds:.1f} seconds')
+            file_seconds.observe(seconds)
+            files_counter.labels('ok').inc()
             return date, True
-        except:
-            self.log.warning(f'Failed to process {url}')
+        except PageviewMissing as err:
+            self.log.warning(str(err))
+            files_counter.labels('missing').inc()
+            return date, False
+        except Exception as err:
+            self.log.warning(f'Failed to process {url}: {type(err).__name__} {err}')
+            files_counter.labels('error').inc()
             return date, False
 
-
-    def page_url(self, prefix, title):
-        parts = prefix.split('.', 1)
-
-        if len(parts) == 1:
-            site = '.wikipedia.org/wiki/'
-        # elif parts[1] == 'b':
-        #     site = '.wikibooks.org/wiki/'
-        # elif parts[1] == 'd':
-        #     site = '.wiktionary.org/wiki/'
-        # elif parts[1] == 'n':
-        #     site = '.wikinews.org/wiki/'
-        # elif parts[1] == 'q':
-        #     site = '.wikiquote.org/wiki/'
-        # elif parts[1] == 's':
-        #     site = '.wikisource.org/wiki/'
-        # elif parts[1] == 'v':
-        #     site = '.wikiversity.org/wiki/'
-        # elif parts[1] == 'voy':
-        #     site = '.wikivoyage.org/wiki/'
-        else:
-            return None
-
-        if not reWikiLanguage.match(parts[0]):
-            if parts[0] != 'test2':  # This is the only number-containing prefix so far
-                self.log.error(f'Skipping unexpected language prefix "{parts[0]}"')
-            return None
-
-        return make_wiki_url(parts[0], site, title)
-
-    def save_stats(self, stats, timestamp):
-
-        # From https://stackoverflow.com/questions/46030514/update-or-create-numeric-counters-in-sparql-upsert/46042692
-
-        done = 0
-        last_print = datetime.utcnow()
-        for keys in chunks(stats.keys(), 1000):
-            # (<...> 10) (<...> 15) ...
-            values = ' '.join(['(' + k + ' ' + str(stats[k]) + ')' for k in keys])
-            sparql = f'''
-PREFIX pvstat: {self.pvstat}
-DELETE {{ ?sitelink pvstat: ?outdated }}
-INSERT {{ ?sitelink pvstat: ?updated }}
-WHERE {{
-    VALUES (?sitelink ?increment) {{ {values} }}
-    OPTIONAL {{?sitelink pvstat: ?outdated}}
-    BIND ((IF(BOUND(?outdated), ?outdated + ?increment, ?increment)) AS ?updated)
-}}'''
-            self.rdf_server.run('update', sparql)
-            done += len(keys)
-            if (datetime.utcnow() - last_print).total_seconds() > 60:
-                self.log.info(f'Imported {done} pageview stats, pausing for a few seconds...')
-                time.sleep(5000)
-                last_print = datetime.utcnow()
-
-        self.rdf_server.run('update', set_status_query(self.pvstat, timestamp))
-        self.log.info(f'Finished importing {done} pageview stats')
+    @staticmethod
+    async def iterate_blocks(compressed):
+        """Decompresses the file while it is being downloaded, yielding blocks of complete lines"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        buffer = b''
+        async for chunk in compressed:
+            while chunk:
+                buffer += decompressor.decompress(chunk)
+                chunk = b''
+                if decompressor.eof:
+                    # A gzip file may consist of several concatenated members
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if len(buffer) >= BLOCK_SIZE:
+                pos = buffer.rfind(b'\n') + 1
+                if pos > 0:
+                    yield buffer[:pos]
+                    buffer = buffer[pos:]
+        buffer += decompressor.flush()
+        if buffer:
+            yield buffer
+
+    async def parse_block(self, executor, blocks_limit, block, url, file_stats):
+        try:
+            counts, errors = await asyncio.get_event_loop().run_in_executor(executor, parse_block, block)
+        finally:
+            blocks_limit.release()
+        for page, count in counts.items():
+            file_stats[page] += count
+        for line in errors:
+            self.log.error(f'Error parsing {url} line "{line}"')
+
+    async def save_stats(self, timestamp):
+        # Totals are written as plain values, so the store must not contain any values it did not write
+        uncleaned = self.store.uncleaned_predicates()
+        if uncleaned:
+            self.log.info(f'Removing all existing {", ".join(uncleaned)} values')
+            for predicate in uncleaned:
+                sparql = f'PREFIX pvstat: {self.pvstat}\nDELETE {{ ?s {predicate} ?o }} WHERE {{ ?s {predicate} ?o }}'
+                await self.throttle.run_async(self.rdf_server.run, 'update', sparql)
+            self.store.mark_cleaned(uncleaned)
+
+        changes = list(self.store.changes())
+        self.log.info(f'Updating {len(changes):,} changed pageview totals')
+        pending_gauge.set(len(changes))
+
+        # Every (predicate, sitelink) pair is in exactly one batch, so the batches can run in any order.
+        # A few workers share the list of batches, so that the throttle can still adjust their pace.
+        self.saved = 0
+        self.last_print = datetime.utcnow()
+        batches = chunks(changes, 1000)
+
+        async def worker():
+            for batch in batches:
+                await self.save_batch(batch, len(changes))
+
+        await asyncio.gather(*(worker() for _ in range(self.options.max_concurrent)))
+        self.store.save_state()
+
+        await self.throttle.run_async(self.rdf_server.run, 'update', set_status_query(self.pvstat, timestamp))
+        lag_gauge.set((datetime.now(dt.timezone.utc) - timestamp).total_seconds())
+        self.log.info(f'Finished importing {self.saved} pageview stats;  {self.throttle.report()}')
+
+    async def save_batch(self, batch, total):
+        names = self.store.names
+        deletes = '\n'.join(f'{names[sid]} {pred} {old} .' for pred, sid, old, new in batch if old)
+        inserts = '\n'.join(f'{names[sid]} {pred} {new} .' for pred, sid, old, new in batch if new)
+        sparql = f'PREFIX pvstat: {self.pvstat}\n'
+        if deletes:
+            sparql += f'DELETE DATA {{\n{deletes}\n}};\n'
+        if inserts:
+            sparql += f'INSERT DATA {{\n{inserts}\n}};\n'
+        await self.throttle.run_async(self.rdf_server.run, 'update', sparql, rows=len(batch))
+        self.store.mark_written(batch)
+        self.saved += len(batch)
+        saved_counter.inc(len(batch))
+        pending_gauge.set(total - self.saved)
+        if (datetime.utcnow() - self.last_print).total_seconds() > 60:
+            self.store.save_state()
+            self.log.info(f'Imported {self.saved} pageview stats;  {self.throttle.report()}')
+            self.last_print = datetime.utcnow()
 
 
 if __name__ == '__main__':
     updater = UpdatePageViewStats()
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(updater.run())
-    loop.close()
+    async def main():
+        async with updater.rdf_server:
+            await updater.run()
+
+    asyncio.run(main())
@@ -1,21 +1,26 @@
 # Copyright Yuri Astrakhan <YuriAstrakhan@gmail.com>
 
-import time
 import argparse
+import asyncio
 import logging
 
 import shapely.speedups
 from shapely.geometry import MultiPoint
 from shapely.wkt import loads
 
+import metrics
 import osmutils
 from utils import chunks
-from sparql import Sparql
+from asyncSparql import AsyncSparql
 import osmium
 
 if shapely.speedups.available:
     shapely.speedups.enable()
 
+pending_gauge = metrics.gauge('osm2rdf_relloc_pending_relations', 'Relations without osmm:loc waiting to be processed')
+updated_counter = metrics.counter('osm2rdf_relloc_updated_total', 'Relations that got a new osmm:loc')
+skipped_gauge = metrics.gauge('osm2rdf_relloc_skipped_relations', 'Relations that could not be processed')
+
 
 class UpdateRelLoc(object):
     def __init__(self):
@@ -41,13 +46,18 @@ class UpdateRelLoc(object):
                             default='dense', help='Which node strategy to use (default: %(default)s)')
         parser.add_argument('-c', '--nodes-file', action='store', dest='cacheFile',
                             default=None, help='File to store node cache.')
+        parser.add_argument('--max-concurrent', action='store', dest='max_concurrent', type=int, default=4,
+                            help='Maximum number of SPARQL requests running at the same time (default: %(default)s)')
         parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', default=False,
                             help='Do not modify RDF database.')
+        metrics.add_metrics_argument(parser)
 
         opts = parser.parse_args()
+        if opts.metrics_port:
+            metrics.start_metrics_server(opts.metrics_port)
 
         self.options = opts
-        self.rdf_server = Sparql(opts.rdf_url, opts.dry_run)
+        self.rdf_server = AsyncSparql(opts.rdf_url, opts.dry_run, opts.max_concurrent)
         self.skipped = []
 
         if self.options.cacheFile:
@@ -59,18 +69,19 @@ class UpdateRelLoc(object):
         else:
             self.nodeCache = None
 
-    def run(self):
-        while True:
-            self.run_once()
-            time.sleep(600)  # every 10 minutes
+    async def run(self):
+        async with self.rdf_server:
+            while True:
+                await self.run_once()
+                await asyncio.sleep(600)  # every 10 minutes
 
-    def run_once(self):
+    async def run_once(self):
         query = '''# Get relations without osmm:loc
 SELECT ?rel WHERE {
   ?rel osmm:type 'r' .
   FILTER NOT EXISTS { ?rel osmm:loc ?relLoc . }
 }'''  # LIMIT 100000
-        result = self.rdf_server.run('query', query)
+        result = await self.rdf_server.run('query', query)
         self.skipped = ['osmrel:' + i['rel']['value'][len('https://www.openstreetmap.org/relation/'):] for i in result]
 
         while True:
@@ -78,7 +89,10 @@ SELECT ?rel WHERE {
             self.skipped = []
             count = len(rel_ids)
             self.log.info(f'** Processing {count} relations')
-            self.run_list(rel_ids)
+            pending_gauge.set(count)
+            await self.run_list(rel_ids)
+            pending_gauge.set(0)
+            skipped_gauge.set(len(self.skipped))
             if len(self.skipped) >= count:
                 self.log.info(f'** Unable to process {len(self.skipped)} relations, exiting')
                 break
@@ -87,12 +101,22 @@ SELECT ?rel WHERE {
 
         self.log.info('done')
 
-    def run_list(self, rel_ids):
-        for chunk in chunks(rel_ids, 2000):
-            self.fix_relations(chunk)
+    async def run_list(self, rel_ids):
+        remaining = len(rel_ids)
+        # Chunks are independent, so several of them can be queried and updated at the same time
+        rel_chunks = chunks(rel_ids, 2000)
+
+        async def worker():
+            nonlocal remaining
+            for chunk in rel_chunks:
+                await self.fix_relations(chunk)
+                remaining -= len(chunk)
+                pending_gauge.set(remaining)
+
+        await asyncio.gather(*(worker() for _ in range(self.options.max_concurrent)))
 
-    def fix_relations(self, rel_ids):
-        pairs = self.get_relation_members(rel_ids)
+    async def fix_relations(self, rel_ids):
+        pairs = await self.get_relation_members(rel_ids)
 
         insert_statements = []
         for group in self.group_by_values(pairs):
@@ -104,10 +128,11 @@ SELECT ?rel WHERE {
             sparql += '\n'.join(insert_statements)
             sparql += '\n} WHERE {};'
 
-            self.rdf_server.run('update', sparql)
+            await self.rdf_server.run('update', sparql)
+            updated_counter.inc(len(insert_statements))
             self.log.info(f'Updated {len(insert_statements)} relations')
 
-    def get_relation_members(self, rel_ids):
+    async def get_relation_members(self, rel_ids):
         query = f'''# Get relation member's locations
 SELECT
   ?rel ?member ?loc
@@ -116,7 +141,7 @@ WHERE {{
   ?rel osmm:has ?member .
   OPTIONAL {{ ?member osmm:loc ?loc . }}
 }}'''
-        result = self.rdf_server.run('query', query)
+        result = await self.rdf_server.run('query', query)
 
         return [(
             'osmrel:' + i['rel']['value'][len('https://www.openstreetmap.org/relation/'):],
@@ -171,6 +196,6 @@ WHERE {{
 
 
 if __name__ == '__main__':
-    UpdateRelLoc().run()
+    asyncio.run(UpdateRelLoc().run())
     # UpdateRelLoc().fix_relations(['osmrel:13', 'osmrel:3344', 'osmrel:2938' ])
     # UpdateRelLoc().process_single_rel('osmrel:13', ['Point(-1.1729935 52.7200423)', 'Point(-1.1755875 52.7180761)'])
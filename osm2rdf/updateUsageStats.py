@@ -3,14 +3,18 @@
 # Copyright Yuri Astrakhan <YuriAstrakhan@gmail.com>
 import json
 import logging
+import os
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 
 import argparse
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-from utils import stringify, chunks, query_status, set_status_query, parse_utc
+import metrics
+from throttle import AdaptiveThrottle, add_throttle_arguments
+from utils import stringify, chunks, query_status, set_status_query, parse_utc, parse_date, format_date
 from sparql import Sparql
 
 info_keys = [
@@ -18,9 +22,18 @@ info_keys = [
     'count_relations', 'count_relations_fraction', 'values_all', 'users_all'
 ]
 
+lag_gauge = metrics.gauge('osm2rdf_usagestats_lag_seconds', 'Age of the taginfo data stored in the database')
+pending_gauge = metrics.gauge('osm2rdf_usagestats_pending_keys', 'Keys whose usage stats are not yet imported')
+saved_counter = metrics.counter('osm2rdf_usagestats_saved_total', 'Keys whose usage stats were imported')
+skipped_counter = metrics.counter('osm2rdf_usagestats_skipped_total', 'Keys whose usage stats did not change')
+unresolved_gauge = metrics.gauge('osm2rdf_usagestats_unresolved_keys', 'Keys without a data item')
+
+entity_prefix = 'http://wiki.openstreetmap.org/entity/'
+
 
 class UpdateUsageStats(object):
-    ids: Dict[str, str]
+    # key -> data item ID, or None if the key has no data item
+    ids: Dict[str, Optional[str]]
 
     def __init__(self):
 
@@ -43,14 +56,37 @@ class UpdateUsageStats(object):
                             help='Host URL to upload data. Default: %(default)s')
         parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', default=False,
                             help='Do not modify RDF database.')
+        parser.add_argument('--snapshot', action='store', dest='snapshot',
+                            default=os.path.join(os.path.dirname(__file__), 'usagestats.json'),
+                            help='File with the stats that are currently in the database, used to only update '
+                                 'the changed values. If missing, all stats are reloaded. Default: %(default)s')
+        parser.add_argument('--ids-cache', action='store', dest='ids_cache',
+                            default=os.path.join(os.path.dirname(__file__), 'usagestats-ids.json'),
+                            help='File to store the key to data item ID mapping. Default: %(default)s')
+        parser.add_argument('--ids-max-age', action='store', dest='ids_max_age', type=float, default=7,
+                            help='Reload the whole key to data item ID mapping after this many days, because '
+                                 'deleted data items are not found by the incremental updates. Default: %(default)s')
+        parser.add_argument('--resolve-workers', action='store', dest='resolve_workers', type=int, default=4,
+                            help='Number of parallel queries when resolving keys to data items. '
+                                 'Default: %(default)s')
+        add_throttle_arguments(parser)
+        metrics.add_metrics_argument(parser)
         opts = parser.parse_args()
+        if opts.metrics_port:
+            metrics.start_metrics_server(opts.metrics_port)
 
         self.options = opts
+        self.throttle = AdaptiveThrottle.from_options('usagestats', opts)
         self.rdf_server = Sparql(opts.rdf_url, 'query' if opts.dry_run else False)
         self.date_subject = '<https://taginfo.openstreetmap.org>'
         self.url_stats = 'https://taginfo.openstreetmap.org/api/4/key/stats'
         self.url_keys = ' https://taginfo.openstreetmap.org/api/4/keys/all'
         self.ids = {}
+        # Data items modified after this time have not been checked for key changes
+        self.ids_timestamp = None
+        # Time of the last full reload of the key to data item ID mapping
+        self.ids_loaded = None
+        self.load_ids()
 
     def run(self):
 
@@ -62,6 +98,9 @@ class UpdateUsageStats(object):
         ts_taginfo = self.get_current_ts()
         ts_db = query_status(self.rdf_server, self.date_subject) if not self.options.dry_run else None
 
+        if ts_db is not None:
+            lag_gauge.set((datetime.utcnow() - ts_db.replace(tzinfo=None)).total_seconds())
+
         if ts_taginfo is not None and ts_taginfo == ts_db:
             self.log.info(f'Data is up to date {ts_taginfo}, sleeping...')
             return
@@ -92,53 +131,190 @@ class UpdateUsageStats(object):
         return stats, ts
 
     def save_stats(self, stats, timestamp):
-        # Resolve keys to IDs
-        for keys in chunks([k for k in stats.keys() if k not in self.ids], 5000):
-            sparql = f'''
-SELECT ?key ?id WHERE {{
-  VALUES ?key {{{' '.join([stringify(k) for k in keys])}}}
-  ?id osmdt:P16 ?key.
-}}'''
-            res = self.rdf_server.run('query', sparql)
-            # http://wiki.openstreetmap.org/entity/Q103
-            self.ids.update(
-                {v['key']['value']: v['id']['value'][len('http://wiki.openstreetmap.org/entity/'):] for v in res})
+        complete = self.refresh_ids()
+        unseen = [k for k in stats.keys() if k not in self.ids]
+        if complete:
+            self.ids.update({k: None for k in unseen})
+            self.save_ids()
+        else:
+            self.resolve_ids(unseen)
 
-        self.log.info(f'Total resolved keys is {len(self.ids)}, updating...')
+        resolved = sum(1 for v in self.ids.values() if v)
+        self.log.info(f'Total resolved keys is {resolved}, updating...')
+        unresolved_gauge.set(sum(1 for k in stats if not self.ids.get(k)))
+        current = {k: (self.ids[k], v) for k, v in stats.items() if self.ids.get(k)}
 
-        # Delete all usage counters
-        sparql = f'''
+        previous = self.load_snapshot()
+        if previous is None:
+            # Without a snapshot, it is unknown what is in the database - start from scratch
+            sparql = f'''
 DELETE {{ ?s ?p ?o }} WHERE {{
   VALUES ?p {{ {' '.join([f'osmm:{k}' for k in info_keys])} }}
          ?s ?p ?o .
 }}'''
+            self.throttle.run(self.rdf_server.run, 'update', sparql)
+            self.log.info(f'Existing counts deleted, importing...')
+            previous = {}
 
-        self.rdf_server.run('update', sparql)
-        self.log.info(f'Existing counts deleted, importing...')
+        # key -> (statements to delete, statements to insert)
+        changes = {}
+        for key in previous.keys() - current.keys():
+            qid, values = previous[key]
+            changes[key] = ([f'osmd:{qid} osmm:{k} {v} .' for k, v in zip(info_keys, values)], [])
+        for key, (qid, values) in current.items():
+            old_qid, old_values = previous.get(key, (None, None))
+            if old_qid == qid and old_values == values:
+                continue
+            deletes, inserts = [], []
+            for i, k in enumerate(info_keys):
+                if old_qid == qid and old_values[i] == values[i]:
+                    continue
+                if old_qid is not None:
+                    deletes.append(f'osmd:{old_qid} osmm:{k} {old_values[i]} .')
+                inserts.append(f'osmd:{qid} osmm:{k} {values[i]} .')
+            changes[key] = (deletes, inserts)
+
+        skipped = len(current) - len(changes.keys() & current.keys())
+        skipped_counter.inc(skipped)
+        self.log.info(f'{len(changes)} keys changed, {skipped} unchanged keys skipped')
+        pending_gauge.set(len(changes))
 
         done = 0
         last_print = datetime.utcnow()
-        for keys in chunks(stats.keys(), 5000):
-            sparql = (
-                    'INSERT {\n' +
-                    '\n'.join([f'?id osmm:{k} ?{k}.' for k in info_keys]) +
-                    '\n} WHERE {\n' +
-                    f"VALUES (?id {' '.join([f'?{k}' for k in info_keys])}) {{\n" +
-                    '\n'.join([
-                        f"(osmd:{self.ids[k]} {' '.join([str(stats[k][i]) for i in range(len(info_keys))])})"
-                        for k in keys if k in self.ids
-                    ]) + '\n} }'
-            )
-
-            self.rdf_server.run('update', sparql)
+        for keys in chunks(list(changes.keys()), 5000):
+            deletes = '\n'.join(v for k in keys for v in changes[k][0])
+            inserts = '\n'.join(v for k in keys for v in changes[k][1])
+            sparql = ''
+            if deletes:
+                sparql += f'DELETE DATA {{\n{deletes}\n}};\n'
+            if inserts:
+                sparql += f'INSERT DATA {{\n{inserts}\n}};\n'
+
+            self.throttle.run(self.rdf_server.run, 'update', sparql, rows=len(keys))
             done += len(keys)
+            saved_counter.inc(len(keys))
+            pending_gauge.set(len(changes) - done)
             if (datetime.utcnow() - last_print).total_seconds() > 60:
-                self.log.info(f'Imported {done} pageview stats, pausing for a few seconds...')
-                time.sleep(60)
+                self.log.info(f'Imported {done} usage stats;  {self.throttle.report()}')
                 last_print = datetime.utcnow()
 
-        self.rdf_server.run('update', set_status_query(self.date_subject, timestamp))
-        self.log.info(f'Finished importing {done} pageview stats')
+        self.throttle.run(self.rdf_server.run, 'update', set_status_query(self.date_subject, timestamp))
+        self.save_snapshot(current)
+        lag_gauge.set((datetime.utcnow() - timestamp.replace(tzinfo=None)).total_seconds())
+        self.log.info(f'Finished importing {done} usage stats, skipped {skipped} unchanged;  '
+                      f'{self.throttle.report()}')
+
+    def load_ids(self):
+        if os.path.isfile(self.options.ids_cache):
+            with open(self.options.ids_cache, 'r') as f:
+                data = json.load(f)
+            self.ids = data['ids']
+            self.ids_timestamp = parse_date(data['timestamp']) if data['timestamp'] else None
+            self.ids_loaded = parse_date(data['loaded']) if data.get('loaded') else None
+            self.log.info(f'Loaded {len(self.ids)} cached key IDs, last checked {self.ids_timestamp}')
+
+    def save_ids(self):
+        with open(self.options.ids_cache + '.tmp', 'w') as f:
+            json.dump({
+                'timestamp': f'{self.ids_timestamp:%Y-%m-%dT%H:%M:%SZ}' if self.ids_timestamp else None,
+                'loaded': f'{self.ids_loaded:%Y-%m-%dT%H:%M:%SZ}' if self.ids_loaded else None,
+                'ids': self.ids,
+            }, f)
+        os.replace(self.options.ids_cache + '.tmp', self.options.ids_cache)
+
+    def get_items_modified_since(self, timestamp):
+        """
+        Returns key -> item ID for all key items modified after the timestamp, the IDs of all modified items,
+        including the ones that no longer have a key, and the newest modification time
+        """
+        if timestamp:
+            sparql = f'''
+SELECT ?key ?id ?modified WHERE {{
+  ?id schema:dateModified ?modified .
+  FILTER (?modified > {format_date(timestamp)} && STRSTARTS(STR(?id), "{entity_prefix}"))
+  OPTIONAL {{ ?id osmdt:P16 ?key . }}
+}}'''
+        else:
+            sparql = f'''
+SELECT ?key ?id ?modified WHERE {{
+  ?id osmdt:P16 ?key .
+  OPTIONAL {{ ?id schema:dateModified ?modified . }}
+}}'''
+        result = {}
+        modified_ids = set()
+        newest = timestamp
+        for v in self.rdf_server.run('query', sparql):
+            qid = v['id']['value'][len(entity_prefix):]
+            modified_ids.add(qid)
+            if 'key' in v:
+                result[v['key']['value']] = qid
+            if 'modified' in v:
+                modified = parse_date(v['modified']['value'])
+                if newest is None or modified > newest:
+                    newest = modified
+        return result, modified_ids, newest
+
+    def refresh_ids(self):
+        """
+        Update the cached entries of the data items that were changed since the last check.
+        Returns True if all key items were loaded, i.e. any key not in self.ids has no data item.
+        """
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        if self.ids_timestamp is None or self.ids_loaded is None or \
+                now - self.ids_loaded > timedelta(days=self.options.ids_max_age):
+            self.ids, _, self.ids_timestamp = self.get_items_modified_since(None)
+            self.ids_loaded = now
+            self.log.info(f'Loaded {len(self.ids)} key data items')
+            return True
+        changed, modified_ids, self.ids_timestamp = self.get_items_modified_since(self.ids_timestamp)
+        if modified_ids:
+            # A modified item might have had a different key before, or no longer have one
+            for key, qid in list(self.ids.items()):
+                if qid in modified_ids and changed.get(key) != qid:
+                    self.ids[key] = None
+            self.ids.update(changed)
+            self.log.info(f'Updated {len(changed)} keys of {len(modified_ids)} recently modified data items')
+        self.save_ids()
+        return False
+
+    def resolve_ids(self, keys):
+        """Resolve keys that have never been seen before, caching the keys without a data item too"""
+        if not keys:
+            return
+
+        def resolve(batch):
+            sparql = f'''
+SELECT ?key ?id WHERE {{
+  VALUES ?key {{{' '.join([stringify(k) for k in batch])}}}
+  ?id osmdt:P16 ?key.
+}}'''
+            return batch, self.rdf_server.run('query', sparql)
+
+        self.log.info(f'Resolving {len(keys)} new keys')
+        with ThreadPoolExecutor(max_workers=self.options.resolve_workers) as executor:
+            for batch, res in executor.map(resolve, chunks(keys, 5000)):
+                self.ids.update({k: None for k in batch})
+                # http://wiki.openstreetmap.org/entity/Q103
+                self.ids.update({v['key']['value']: v['id']['value'][len(entity_prefix):] for v in res})
+        self.save_ids()
+
+    def load_snapshot(self):
+        """Returns the stats saved after the last successful import, or None if they are unknown"""
+        filename = self.options.snapshot
+        if self.options.dry_run or not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        # If this run fails midway, the database would no longer match the snapshot
+        os.remove(filename)
+        return {k: (v[0], tuple(v[1])) for k, v in data.items()}
+
+    def save_snapshot(self, current):
+        if self.options.dry_run:
+            return
+        with open(self.options.snapshot + '.tmp', 'w') as f:
+            json.dump(current, f)
+        os.replace(self.options.snapshot + '.tmp', self.options.snapshot)
 
     def get_current_ts(self):
         ts_str = requests.get(self.url_stats).json()['data_until']
@@ -41,11 +41,15 @@ def chunks(values, max_count):
 
 
 def query_status(rdf_server, uri, field=None):
+    return parse_status(rdf_server.run('query', status_query(uri, field)), field)
+
+
+def status_query(uri, field=None):
     extra_cond = ''
     if field:
         extra_cond = f'OPTIONAL {{ {uri} schema:version ?{field} . }}'
 
-    sparql = f'''
+    return f'''
 SELECT ?dummy ?dateModified {'?' + field if field else ''} WHERE {{
  BIND( "42" as ?dummy )
  OPTIONAL {{ {uri} schema:dateModified ?dateModified . }}
@@ -53,7 +57,10 @@ SELECT ?dummy ?dateModified {'?' + field if field else ''} WHERE {{
 }}
 '''
 
-    result = rdf_server.run('query', sparql)[0]
+
+def parse_status(bindings, field=None):
+    """Parses the result of status_query()"""
+    result = bindings[0]
 
     if result['dummy']['value'] != '42':
         raise Exception('Failed to get a dummy value from RDF DB')